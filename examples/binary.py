@@ -7,7 +7,7 @@ from __future__ import print_function
 import sys
 sys.path.append("..")
 
-from luckylensing import rayshoot
+from luckylensing import rayshoot_many
 from PIL import Image
 import numpy
 
@@ -23,17 +23,18 @@ imgfile = "magpats/binary.png"
 shape = (len(mass_values) * (ypixels + 2 * margin),
          len(x_values) * (ypixels + 2 * margin), 3)
 buf = numpy.zeros(shape, numpy.uint8)
-for j, mass in enumerate(mass_values):
-    for i, x in enumerate(x_values):
-        print("Ray shooting for mass ratio %.2e and distance %.2f" % (mass, x))
-        sys.stdout.write("\033[F") # Cursor up one line
-        lenses = [(0.0, 0.0, 1.0), (x, 0.0, mass)]
-        magpat = rayshoot(lenses, region, xpixels, ypixels,
-                          density=1000, num_threads=2, verbose=0)
-        j0 = j * (ypixels + 2 * margin)
-        i0 = i * (xpixels + 2 * margin)
-        buf[j0:j0+ypixels, i0:i0+xpixels] = magpat.render_gradient(
-            min_mag=1.0, max_mag=120.0)
+params = [(mass, x) for mass in mass_values for x in x_values]
+configs = [dict(lenses=[(0.0, 0.0, 1.0), (x, 0.0, mass)], region=region,
+                xpixels=xpixels, ypixels=ypixels, density=1000)
+           for mass, x in params]
+for done, (n, magpat) in enumerate(rayshoot_many(configs)):
+    print("Ray shooting: %i of %i patterns done" % (done + 1, len(configs)))
+    sys.stdout.write("\033[F") # Cursor up one line
+    j, i = divmod(n, len(x_values))
+    j0 = j * (ypixels + 2 * margin)
+    i0 = i * (xpixels + 2 * margin)
+    buf[j0:j0+ypixels, i0:i0+xpixels] = magpat.render_gradient(
+        min_mag=1.0, max_mag=120.0)
 sys.stdout.write("\033[K") # Clear to the end of line
 print("Writing magnification patterns to", imgfile)
 Image.fromarray(buf).save(imgfile)
@@ -5,25 +5,16 @@
 import sys
 sys.path.append("..")
 
-from luckylensing import pipeline, globular_cluster, Rayshooter
+from luckylensing import globular_cluster, Rayshooter
 from imagewriter import save_img
-from math import log, exp
+from math import exp
 
-pipe = pipeline.Pipeline(globular_cluster, Rayshooter, save_img)
-for i in range(1000):
-    log_mass = -8.0 + 0.005*i
-    pipe.run(
-        # Parameters for the cluster generator:
-        num_stars = 1000,
-        total_mass = 1000 * exp(log_mass),
-        random_seed = 43,
-        # Parameters for the ray shooter:
-        region = (-1.6, -1.2, 1.6, 1.2),
-        xpixels = 1024,
-        ypixels = 768,
-        density = 15 * 1.5**(-log_mass),
-        num_threads = 2,
-        # Parameters for the image file writer:
-        min_mag = 1.2,
-        max_mag = 150.0,
-        imgfile = "magpats/collapse-%04i.png" % i)
+# Only the total mass of the cluster changes, so the deflection of the
+# stars is computed once and rescaled for each frame.
+lenses = globular_cluster(num_stars=1000, total_mass=1000, random_seed=43)
+scales = [exp(-8.0 + 0.005*i) for i in range(1000)]
+rs = Rayshooter(lenses, region=(-1.6, -1.2, 1.6, 1.2),
+                xpixels=1024, ypixels=768, density=100, num_threads=2)
+for i, magpat in enumerate(rs.mass_sweep(scales)):
+    save_img(magpat, "magpats/collapse-%04i.png" % i,
+             min_mag=1.2, max_mag=150.0)
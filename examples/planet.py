@@ -5,12 +5,14 @@
 import sys
 sys.path.append("..")
 
-from luckylensing import rayshoot
+from luckylensing import Rayshooter
 from imagewriter import save_img
 
-for i in range(120):
-    lenses = [(0., 0., 1.), (0.8 + i*0.005, 0., .0025)]
-    region = (-.4, -.25, .6, .25)
-    magpat = rayshoot(lenses, region, 1024, 512, num_threads=2)
+# The star is static; only the deflection of the planet is computed
+# for each frame.
+region = (-.4, -.25, .6, .25)
+rs = Rayshooter([(0., 0., 1.)], region, 1024, 512, num_threads=2)
+frames = [[(0.8 + i*0.005, 0., .0025)] for i in range(120)]
+for i, magpat in enumerate(rs.sweep(frames)):
     save_img(magpat, "magpats/planet-%03i.png" % i,
              min_mag=3.0, max_mag=3000.0)
@@ -11,6 +11,7 @@ class GllLensConfig(GllPlugin):
     def __init__(self, action=None):
         GllPlugin.__init__(self, action)
         self.lenses = []
+        self.components = []
         self.region = None
         self.main_widget = gtk.DrawingArea()
         self.main_widget.set_size_request(400, 300)
@@ -21,12 +22,26 @@ class GllLensConfig(GllPlugin):
         self.lenses = data["lenses"]
         if not isinstance(self.lenses, ll.LensConfig):
             self.lenses = ll.LensConfig(self.lenses)
+        self.components = data.get("components")
+        if self.components is None:
+            self.components = []
+        if not isinstance(self.components, ll.ComponentConfig):
+            self.components = ll.ComponentConfig(self.components)
         self.region = data.get("region")
         if self.region is not None:
             self.region = ll.rectangle(**self.region)
 
+    def _component_radii(self):
+        # Einstein radii of the components, and the truncation or core
+        # radii drawn as dashed circles
+        components = self.components
+        sis = components.type == ll.libll.component_types["sis"]
+        radius = numpy.where(sis, components.strength,
+                             numpy.sqrt(abs(components.strength)))
+        return radius, components.radius
+
     def draw(self, area, event):
-        if not len(self.lenses):
+        if not len(self.lenses) and not len(self.components):
             return
         pix_width, pix_height = area.window.get_size()
         cr = area.window.cairo_create()
@@ -39,11 +54,15 @@ class GllLensConfig(GllPlugin):
         cr.paint()
 
         # Transform to lens plane coordinates
-        sqrt_mass = numpy.sqrt(self.lenses.mass)
-        x0 = (self.lenses.x - sqrt_mass).min()
-        y0 = (self.lenses.y - sqrt_mass).min()
-        width = (self.lenses.x + sqrt_mass).max() - x0
-        height = (self.lenses.y + sqrt_mass).max() - y0
+        component_radius, outer_radius = self._component_radii()
+        radius = numpy.concatenate([numpy.sqrt(self.lenses.mass),
+                                    component_radius])
+        xs = numpy.concatenate([self.lenses.x, self.components.x])
+        ys = numpy.concatenate([self.lenses.y, self.components.y])
+        x0 = (xs - radius).min()
+        y0 = (ys - radius).min()
+        width = (xs + radius).max() - x0
+        height = (ys + radius).max() - y0
         x0 -= width * 0.05
         y0 -= height * 0.05
         width *= 1.1
@@ -69,6 +88,23 @@ class GllLensConfig(GllPlugin):
             cr.set_source_rgba(1.0, 0.8, 0.2, 1.0)
             cr.fill()
 
+        # Render the extended components
+        for component, radius, outer in zip(self.components,
+                                            component_radius, outer_radius):
+            x, y = component.x, component.y
+            cr.arc(x, y, radius, 0, 2.0 * numpy.pi)
+            cr.set_source_rgba(0.2, 0.9, 0.5, 0.1)
+            cr.fill_preserve()
+            cr.set_source_rgba(0.2, 0.9, 0.5, 0.9)
+            cr.stroke()
+            if outer > 0.0:
+                cr.set_dash([4.0 / scale])
+                cr.arc(x, y, outer, 0, 2.0 * numpy.pi)
+                cr.stroke()
+                cr.set_dash([])
+            cr.arc(x, y, min_radius, 0, 2.0 * numpy.pi)
+            cr.fill()
+
         # Render the rectangle corresponding to the magnification pattern
         if self.region is not None:
             cr.rectangle(*self.region)
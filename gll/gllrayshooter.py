@@ -35,7 +35,9 @@ class GllRayshooter(GllPlugin):
             "kernel", "Ray shooting kernel", "triangulated",
             [("Simple", "simple"),
              ("Bilinear", "bilinear"),
-             ("Triangulated", "triangulated")])
+             ("Triangulated", "triangulated"),
+             ("Triangulated (scanline)", "triangulated_scanline"),
+             ("Adaptive", "adaptive")])
         self.config_widget.add_toggle_group(
             "export_region", "Magnification pattern region", False,
             [("region_x0", "Left coordinate",  (-1.0, -1e10, 1e10, 0.01), 4),
@@ -9,22 +9,40 @@ WWW address: http://github.com/smarnach/luckylensing
 
 Classes:
 
+ComponentConfig   -- analytic extended lens components
+DeflectionCache   -- a cache of deflected ray grids shared by several runs
 LensConfig        -- a configuration of lenses in the lens plane
 LightCurve        -- a light curve
 Magpat            -- a magnification pattern
 Rayshooter        -- a class controlling a multi-threaded ray shooting run
+Trajectory        -- a parametric source trajectory with parallax and orbits
 
 Functions:
 
 binary_lenses     -- return a binary lens configuration
 convolve          -- convolve a magnification pattern with a source profile
+finite_source_light_curve
+                  -- compute a finite source light curve by contour integration
 globular_cluster  -- return a globular cluster lens configuration
 light_curve       -- extract a light curve from a magnification pattern
+light_curves      -- extract many light curves in a single call
+point_source_light_curve
+                  -- compute a point source light curve by finding images
+point_source_magpat
+                  -- compute a magnification pattern by finding images
 polygonal_lenses  -- return lenses arranged as a regular polygon
+random_light_curves
+                  -- extract light curves along random tracks
 rayshoot          -- generate a magnification pattern by ray shooting
+rayshoot_many     -- generate many magnification patterns concurrently
+rayshoot_mass_sweep
+                  -- generate patterns for a range of lens mass scales
 read_fits         -- read a magnification pattern from a FITS file
 rectangle         -- return a paraxial rectangle instance
+source_mask       -- mark the pattern pixels near tracks or in polygons
 source_profile    -- create a new source profile
+trajectory_light_curve
+                  -- sample a light curve along an arbitrary trajectory
 write_fits        -- write a magnification pattern to a FITS file
 
 Other:
@@ -32,6 +50,7 @@ Other:
 all_profile_types -- a dictionary of registered source profile types
 libll             -- a subpackage wrapping the C kernel of this library
 logger            -- the logging.Logger instance used by the library
+sharding          -- a module distributing ray shooting over worker processes
 stdout_handler    -- the default logging handler
 
 Example usage:
@@ -53,10 +72,15 @@ this pattern.
 
 from .utils import logger, stdout_handler, rectangle
 from .lensconfig import (
-    LensConfig, binary_lenses, globular_cluster, polygonal_lenses)
-from .magpat import Magpat, Rayshooter, rayshoot
+    LensConfig, ComponentConfig, binary_lenses, globular_cluster,
+    polygonal_lenses)
+from .magpat import (
+    DeflectionCache, Magpat, Rayshooter, rayshoot, rayshoot_many,
+    rayshoot_mass_sweep, point_source_magpat, source_mask)
 from .lightcurve import (
-    all_profile_types, source_profile, convolve, LightCurve, light_curve)
+    all_profile_types, source_profile, convolve, LightCurve, light_curve,
+    light_curves, random_light_curves, point_source_light_curve,
+    finite_source_light_curve, trajectory_light_curve, Trajectory)
 try:
     from .fits import write_fits, read_fits
 except ImportError:
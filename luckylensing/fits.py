@@ -4,6 +4,7 @@
 from __future__ import division, absolute_import
 from astropy.io import fits
 import numpy
+import os
 from . import lensconfig
 from . import magpat
 from . import utils
@@ -17,7 +18,13 @@ def write_fits(magpat, fits_output_file):
 
         MAGPATX0, MAGPATY0, MAGPATX1, MAGPATY1
 
-    The lens list is stored in a binary table HDU named "LENSES".
+    and the convergence of the smooth matter and the external shear in
+    KAPPA_C and GAMMA.
+    The lens list is stored in a binary table HDU named "LENSES", and
+    the extended lens components, if any, in one named "COMPONENTS".
+
+    Memory mapped patterns are written in bands of rows, so they are
+    not read into memory as a whole.
 
     Parameters:
 
@@ -25,27 +32,58 @@ def write_fits(magpat, fits_output_file):
         fits_output_file
                          file name of the output file
     """
-    img_hdu = fits.PrimaryHDU(magpat)
+    table_hdus = [fits.BinTableHDU(magpat.lenses, name="lenses")]
+    if len(magpat.components):
+        table_hdus.append(
+            fits.BinTableHDU(magpat.components, name="components"))
+    if magpat.is_memmap():
+        _write_fits_streaming(magpat, table_hdus, fits_output_file)
+    else:
+        img_hdu = fits.PrimaryHDU(magpat)
+        _update_header(img_hdu.header, magpat)
+        fits.HDUList([img_hdu] + table_hdus).writeto(fits_output_file,
+                                                     overwrite=True)
+    utils.logger.info("Wrote magnification pattern to %s", fits_output_file)
+
+def _update_header(header, magpat):
     region = magpat.region
-    img_hdu.header.update(ctype1=" ",
-                          crpix1=0.5,
-                          crval1=region.x,
-                          cdelt1=region.width / magpat.params.xpixels,
-                          ctype2=" ",
-                          crpix2=0.5,
-                          crval2=region.y,
-                          cdelt2=region.height / magpat.params.ypixels)
+    header.update(ctype1=" ",
+                  crpix1=0.5,
+                  crval1=region.x,
+                  cdelt1=region.width / magpat.params.xpixels,
+                  ctype2=" ",
+                  crpix2=0.5,
+                  crval2=region.y,
+                  cdelt2=region.height / magpat.params.ypixels)
     for s in ["x0", "y0", "x1", "y1"]:
-        img_hdu.header.update([("magpat" + s, getattr(region, s))])
-    lens_hdu = fits.BinTableHDU(magpat.lenses, name="lenses")
-    fits.HDUList([img_hdu, lens_hdu]).writeto(fits_output_file, overwrite=True)
-    utils.logger.info("Wrote magnification pattern to %s", fits_output_file)
+        header.update([("magpat" + s, getattr(region, s))])
+    header.update(kappa_c=magpat.kappa_c, gamma=magpat.gamma)
+
+def _write_fits_streaming(magpat, table_hdus, fits_output_file,
+                          band_rows=1024):
+    ypixels, xpixels = magpat.shape
+    header = fits.PrimaryHDU().header
+    header["bitpix"] = -32
+    header["naxis"] = 2
+    header.set("naxis1", xpixels, after="naxis")
+    header.set("naxis2", ypixels, after="naxis1")
+    header["extend"] = True
+    _update_header(header, magpat)
+    if os.path.exists(fits_output_file):
+        os.remove(fits_output_file)
+    img_hdu = fits.StreamingHDU(fits_output_file, header)
+    buf = magpat.view(numpy.ndarray)
+    for j0 in range(0, ypixels, band_rows):
+        img_hdu.write(buf[j0:j0+band_rows].astype(">f4"))
+    img_hdu.close()
+    for hdu in table_hdus:
+        fits.append(fits_output_file, hdu.data, hdu.header)
 
 def read_fits(fits_input_file):
     """Read a magnification pattern from a FITS file.
 
     The function returns a Magpat instance including the list of
-    lenses read from the file.
+    lenses and the extended lens components read from the file.
 
     Parameters:
 
@@ -58,9 +96,18 @@ def read_fits(fits_input_file):
     for s in ["x0", "y0", "x1", "y1"]:
         region_params[s] = hdus[0].header.get("magpat" + s, float(s[1]))
     region = utils.rectangle(**region_params)
-    if hdus[-1].name.lower() == "lenses":
-        lenses = lensconfig.LensConfig.fromarray(hdus[-1].data)
+    names = [hdu.name.lower() for hdu in hdus]
+    if "lenses" in names:
+        lenses = lensconfig.LensConfig.fromarray(
+            hdus[names.index("lenses")].data)
     else:
         lenses = None
+    components = None
+    if "components" in names:
+        components = lensconfig.ComponentConfig(
+            hdus[names.index("components")].data)
+    kappa_c = hdus[0].header.get("kappa_c", 0.0)
+    gamma = hdus[0].header.get("gamma", 0.0)
     utils.logger.info("Read magnification pattern from %s", fits_input_file)
-    return magpat.Magpat(xpixels, ypixels, lenses, region, buf)
+    return magpat.Magpat(xpixels, ypixels, lenses, region, buf,
+                         kappa_c=kappa_c, gamma=gamma, components=components)
@@ -84,6 +84,68 @@ class LensConfig(numpy.recarray):
             return cls(num_lenses=len(lenses), buf=lenses)
         return cls(lenses)
 
+# The C struct has padding after the type field.
+_component_dtype = numpy.dtype(
+    [(n, t._type_) for n, t in libll.Component._fields_], align=True)
+
+class ComponentConfig(numpy.recarray):
+    """An array of analytic extended lens components.
+
+    This is a NumPy recarray with fields and types of the records
+    inherited from the libll.Component structure:
+
+        components.type      profile of the components; 0 for singular
+                             isothermal spheres, 1 for Plummer spheres
+                             (see libll.component_types)
+        components.x         x-values of the centres
+        components.y         y-values of the centres
+        components.strength  Einstein radii of the isothermal spheres
+                             or masses of the Plummer spheres
+        components.radius    truncation radii of the isothermal
+                             spheres (0.0 for none) or core radii of
+                             the Plummer spheres
+
+    One component replaces the thousands of point lenses otherwise
+    needed to model a galaxy or dark matter clump.  The deflection by
+    all components is computed directly for each ray.
+
+    Constructor:
+
+        ComponentConfig(components=None, num_components=None, buf=None)
+
+        components       the components to store in this object; a list
+                         of sequences (type, x, y, strength, radius),
+                         where type may be given by its name "sis" or
+                         "plummer", or a NumPy array of records with
+                         these 5 fields
+        num_components   the number of components; if components is
+                         given, you don't need this parameter
+        buf              passed on to ndarray.__new__()
+
+    Examples:
+
+        >>> components = ComponentConfig([("sis", 0.0, 0.0, 0.5, 0.0),
+        ...                               ("plummer", 1.0, 0.0, 0.1, 0.2)])
+        >>> components.strength
+        array([ 0.5,  0.1])
+    """
+
+    arg_name = "components"
+
+    def __new__(cls, components=None, num_components=None, buf=None):
+        if num_components is None:
+            num_components = len(components)
+        obj = numpy.recarray.__new__(cls, num_components,
+                                     dtype=_component_dtype, buf=buf)
+        if components is not None:
+            if isinstance(components, numpy.ndarray):
+                for name in _component_dtype.names:
+                    obj[name] = components[name]
+            else:
+                obj[:] = [(libll.component_types.get(c[0], c[0]),) +
+                          tuple(c[1:]) for c in components]
+        return obj
+
 def binary_lenses(lens_distance, mass_ratio, total_mass=1.0):
     """Return a binary lens configuration.
 
@@ -14,9 +14,14 @@ Classes:
 
 Lens              -- coordinates and mass of a point lens
 Lenses            -- array of point lenses
+Component         -- an analytic extended lens component
+Components        -- array of extended lens components
 Rect              -- coordinates of a rectangle
 Patches           -- subpatch pattern for hierarchical ray shooting
+LensTree          -- quadtree of lenses for approximate deflection
+StaticField       -- cached deflection of static lenses on a ray lattice
 MagpatParams      -- parameters of a magnification pattern
+ImageLattice      -- cached ray lattice for rendering source images
 Progress          -- helper for some methods of BasicRayshooter
 BasicRayshooter   -- compute magnification patterns
 
@@ -42,15 +47,34 @@ from numpy.ctypeslib import ndpointer as _ndpointer
 _libll = _c.CDLL(_path.join(_path.dirname(__file__) or  ".", "libll.so"))
 _shoot_single_ray = _libll.ll_shoot_single_ray
 _rayshoot_rect = _libll.ll_rayshoot_rect
+_new_lens_tree = _libll.ll_new_lens_tree
+_free_lens_tree = _libll.ll_free_lens_tree
+_lens_tree_error = _libll.ll_lens_tree_error
 _get_subpatches = _libll.ll_get_subpatches
 _rayshoot_subpatches = _libll.ll_rayshoot_subpatches
 _finalise_subpatches = _libll.ll_finalise_subpatches
+_finalise_subpatches_parallel = _libll.ll_finalise_subpatches_parallel
 _rayshoot = _libll.ll_rayshoot
+_get_subpatches_parallel = _libll.ll_get_subpatches_parallel
+_rayshoot_subpatches_parallel = _libll.ll_rayshoot_subpatches_parallel
+_rayshoot_parallel = _libll.ll_rayshoot_parallel
+_rayshoot_rows = _libll.ll_rayshoot_rows
+_deflect_grid = _libll.ll_deflect_grid
+_get_subpatches_deflected = _libll.ll_get_subpatches_deflected
+_patch_grid_size = _libll.ll_patch_grid_size
+_deflect_patches = _libll.ll_deflect_patches
+_rayshoot_deflected = _libll.ll_rayshoot_deflected
+_deflect_rays = _libll.ll_deflect_rays
+_point_source_images = _libll.ll_point_source_images
+_finite_source_magnifications = _libll.ll_finite_source_magnifications
 _ray_hit_pattern = _libll.ll_ray_hit_pattern
 _source_images = _libll.ll_source_images
 _render_magpat_greyscale = _libll.ll_render_magpat_greyscale
 _render_magpat_gradient = _libll.ll_render_magpat_gradient
 _light_curve = _libll.ll_light_curve
+_light_curves = _libll.ll_light_curves
+_sample_magpat = _libll.ll_sample_magpat
+_render_source_images = _libll.ll_render_source_images
 del _libll
 
 class Lens(_c.Structure):
@@ -111,6 +135,65 @@ class Lenses(_c.Structure):
             n = len(lens_list)
             _c.Structure.__init__(self, n, (Lens*n)(*lens_list))
 
+class Component(_c.Structure):
+
+    """Store an analytic extended lens component in a C struct.
+
+    type     -- the profile of the component; one of the values of
+                component_types
+    x        -- x-coordinate of the centre in lens plane coordinates
+    y        -- y-coordinate of the centre in lens plane coordinates
+    strength -- for "sis", the Einstein radius of the singular
+                isothermal sphere; for "plummer", the Einstein radius
+                squared of the total mass, like the mass of a Lens
+    radius   -- for "sis", the truncation radius, outside of which the
+                sphere deflects like a point lens, or 0.0 for no
+                truncation; for "plummer", the core radius
+    """
+
+    _fields_ = [("type", _c.c_int),
+                ("x", _c.c_double),
+                ("y", _c.c_double),
+                ("strength", _c.c_double),
+                ("radius", _c.c_double)]
+
+    def __repr__(self):
+        return "%s.%s(%i, %0.5g, %0.5g, %0.5g, %0.5g)" % (
+            self.__class__.__module__, self.__class__.__name__,
+            self.type, self.x, self.y, self.strength, self.radius)
+
+component_types = {"sis": 0, "plummer": 1}
+
+class Components(_c.Structure):
+
+    """Store an C array of Component objects.
+
+    num_components -- number of Component objects in the array
+    component      -- the actual C array
+    """
+
+    _fields_ = [("num_components", _c.c_uint),
+                ("component", _c.POINTER(Component))]
+
+    def __init__(self, component_list=()):
+        """Initialise the C array from component_list.
+
+        The parameter works like the one of Lenses.__init__(), with
+        sequences of five numbers for the type, x, y, strength and
+        radius of the components.
+        """
+        if isinstance(component_list, Components):
+            _c.Structure.__init__(self, component_list.num_components,
+                                  component_list.component)
+        elif isinstance(component_list, _np.ndarray):
+            _c.Structure.__init__(
+                self, len(component_list),
+                component_list.ctypes.data_as(_c.POINTER(Component)))
+        else:
+            component_list = list(map(tuple, component_list))
+            n = len(component_list)
+            _c.Structure.__init__(self, n, (Component*n)(*component_list))
+
 class Rect(_c.Structure):
 
     """Store the coordinates of a rectangle in a C struct.
@@ -229,6 +312,86 @@ class Patches(_c.Structure):
         except ZeroDivisionError:
             pass
 
+class LensTree(object):
+
+    """A quadtree with multipole moments over an array of lenses.
+
+    If a MagpatParams instance refers to a lens tree, the deflection
+    of each ray is computed by a tree code instead of the direct sum
+    over all lenses.  The cost per ray grows roughly logarithmically
+    with the number of lenses, at the price of a small error in the
+    deflection.  The tree contains a copy of the lenses, so it does
+    not need to be updated if the original lenses are deleted, but
+    has to be rebuilt if they are changed.
+
+    lenses        -- anything suitable as argument to the Lenses
+                     constructor
+    opening_angle -- the multipole expansion of a tree node is used
+                     for a ray if the node's radius is less than
+                     opening_angle times its distance from the ray;
+                     smaller values are more accurate and slower
+    """
+
+    def __init__(self, lenses, opening_angle=0.5):
+        self.opening_angle = opening_angle
+        self.handle = _new_lens_tree(Lenses(lenses), opening_angle)
+
+    def __del__(self):
+        if self.handle:
+            _free_lens_tree(self.handle)
+            self.handle = None
+
+class StaticField(_c.Structure):
+
+    """Deflection of a set of static lenses on a lattice of rays.
+
+    If a MagpatParams instance refers to a static field, its rays are
+    deflected by the static lenses in addition to its own lenses.  The
+    deflection of the static lenses is computed once for each lattice
+    point hit by a ray and reused by all later runs, so a sequence of
+    patterns in which only a few lenses change costs about as much as
+    shooting the changing lenses.  Rays off the lattice are deflected
+    by the static lenses directly.  Patterns computed with a static
+    field are always shot in double precision and without far field
+    expansion.
+
+    lenses      -- the static lenses; a NumPy array is referenced, not
+                   copied
+    x, y        -- lens plane coordinates of the first lattice point
+    dx, dy      -- lattice spacings
+    width,      -- number of lattice points in each direction
+    height
+    tree        -- optional LensTree over the static lenses
+    scale       -- factor the static deflection is multiplied with
+    """
+
+    _fields_ = [("lenses", Lenses),
+                ("tree", _c.c_void_p),
+                ("x", _c.c_double),
+                ("y", _c.c_double),
+                ("dx", _c.c_double),
+                ("dy", _c.c_double),
+                ("width", _c.c_uint),
+                ("height", _c.c_uint),
+                ("deflection", _c.POINTER(_c.c_double)),
+                ("scale", _c.c_double)]
+
+    def __init__(self, lenses, x, y, dx, dy, width, height, tree=None,
+                 scale=1.0):
+        self.lens_array = lenses
+        self.lens_tree = tree
+        self.deflection_array = _np.empty((height, width, 2))
+        self.reset()
+        _c.Structure.__init__(
+            self, Lenses(lenses), tree and tree.handle, x, y, dx, dy,
+            width, height,
+            self.deflection_array.ctypes.data_as(_c.POINTER(_c.c_double)),
+            scale)
+
+    def reset(self):
+        """Forget the deflections computed so far."""
+        self.deflection_array.fill(_np.finfo(_np.float64).max)
+
 class MagpatParams(_c.Structure):
 
     """Parameters describing a magnification pattern.
@@ -245,6 +408,22 @@ class MagpatParams(_c.Structure):
                          up to date autommatically
     pixels_per_height -- ypixels/region.height; needed internally and kept
                          up to date autommatically
+    tree              -- handle of a LensTree used to compute the
+                         deflections, or None to sum over all lenses
+    far_field         -- pointer to the far field expansion of the
+                         current shooting patch; only used internally
+    static_field      -- pointer to a StaticField with further lenses,
+                         or None
+    kappa_c           -- convergence of the smooth matter
+    gamma             -- external shear along the x-axis; the lens
+                         equation for a ray (x, y) becomes
+                         (1-kappa_c-gamma)*x - alpha_x,
+                         (1-kappa_c+gamma)*y - alpha_y
+                         with the deflection alpha by the lenses
+    components        -- Components deflecting the rays in addition
+                         to the lenses
+    mask              -- pointer to the summed-area table of a source
+                         plane mask, or None; see set_mask()
     """
 
     _fields_ = [("lenses", Lenses),
@@ -252,10 +431,22 @@ class MagpatParams(_c.Structure):
                 ("xpixels", _c.c_uint),
                 ("ypixels", _c.c_uint),
                 ("pixels_per_width", _c.c_double),
-                ("pixels_per_height", _c.c_double)]
-
-    def __init__(self, lenses, region, xpixels, ypixels):
-        _c.Structure.__init__(self, Lenses(lenses), region, xpixels, ypixels)
+                ("pixels_per_height", _c.c_double),
+                ("tree", _c.c_void_p),
+                ("far_field", _c.c_void_p),
+                ("static_field", _c.POINTER(StaticField)),
+                ("kappa_c", _c.c_double),
+                ("gamma", _c.c_double),
+                ("components", Components),
+                ("mask", _c.POINTER(_c.c_uint32))]
+
+    def __init__(self, lenses, region, xpixels, ypixels,
+                 kappa_c=0.0, gamma=0.0, components=()):
+        _c.Structure.__init__(self, Lenses(lenses), region, xpixels, ypixels,
+                              kappa_c=kappa_c, gamma=gamma,
+                              components=Components(components))
+        # Keep the component array alive as long as it is in use.
+        self.components_ref = components
 
     # The following methods try to always keep the quotients
     # pixels_per_width and pixels_per_height consistens.  The same
@@ -284,6 +475,36 @@ class MagpatParams(_c.Structure):
         except ZeroDivisionError:
             pass
 
+    def set_static_field(self, field):
+        """Deflect the rays by the lenses of the given StaticField, too.
+
+        Pass None to remove the static field.  A reference to the field
+        is kept as long as it is in use.
+        """
+        self.static_field_ref = field
+        self.static_field = field and _c.pointer(field)
+
+    def set_mask(self, mask):
+        """Restrict ray shooting to a region of the source plane.
+
+        mask is a boolean array of shape (ypixels, xpixels) marking
+        the pattern pixels of interest.  Only the shooting patches
+        whose rays might hit a marked pixel are shot, so the cost
+        scales with the marked area.  The other pixels of the pattern
+        are incomplete.  Pass None to remove the mask.
+        """
+        if mask is None:
+            self.mask_ref = None
+            self.mask = None
+            return
+        mask = _np.asarray(mask, bool)
+        if mask.shape != (self.ypixels, self.xpixels):
+            raise ValueError("mask must have the shape (ypixels, xpixels)")
+        table = _np.zeros((self.ypixels + 1, self.xpixels + 1), _np.uint32)
+        table[1:, 1:] = mask.cumsum(0, _np.uint32).cumsum(1, _np.uint32)
+        self.mask_ref = table
+        self.mask = table.ctypes.data_as(_c.POINTER(_c.c_uint32))
+
     def shoot_single_ray(self, x, y):
         """Return the magnification pattern coordinates of a single ray.
 
@@ -301,6 +522,149 @@ class MagpatParams(_c.Structure):
         b = _shoot_single_ray(self, x, y, mag_x, mag_y) == 0x0F
         return mag_x.value, mag_y.value, b
 
+    def shoot_rays(self, x, y, out_x=None, out_y=None, num_threads=1):
+        """Deflect many rays at once.
+
+        The rays are deflected in C without any per-ray overhead,
+        split between num_threads threads.  The return value is a
+        tuple (source_x, source_y, hit) of arrays of the same shape as
+        x and y.  source_x and source_y are the source plane
+        coordinates of the deflected rays, and hit is a boolean array
+        telling whether they hit the magnification pattern region.
+
+        Parameters:
+
+            x, y             lens plane coordinates of the rays; arrays
+                             of the same shape
+            out_x, out_y     optional C contiguous float64 arrays of
+                             that shape to store the source plane
+                             coordinates in
+            num_threads      number of threads to use
+        """
+        x = _np.ascontiguousarray(x, _np.double)
+        y = _np.ascontiguousarray(y, _np.double)
+        if x.shape != y.shape:
+            raise ValueError("x and y must have the same shape")
+        if out_x is None:
+            out_x = _np.empty_like(x)
+        if out_y is None:
+            out_y = _np.empty_like(y)
+        if out_x.shape != x.shape or out_y.shape != x.shape:
+            raise ValueError("out_x and out_y must have the shape of x")
+        hit = _np.empty(x.shape, _c.c_int)
+        _deflect_rays(self, x.size, x, y, out_x, out_y, hit, num_threads)
+        return out_x, out_y, hit == 0x0F
+
+    def point_source_images(self, source_x, source_y, num_threads=1):
+        """Find the images and magnifications of point sources.
+
+        The lens equation for the point lenses and the smooth matter
+        convergence kappa_c is solved directly as a polynomial of
+        degree num_lenses**2 + 1, without any ray shooting.  This is
+        meant for systems with only a few lenses, like binary lenses;
+        the time per source grows with the fourth power of the number
+        of lenses.  gamma must be zero and there must not be any
+        components.
+
+        The return value is a tuple (image_x, image_y, image_mag,
+        magnification).  magnification is an array of the shape of
+        source_x and source_y containing the total magnifications.
+        The other three arrays have an additional last axis of length
+        num_lenses**2 + 1, containing the lens plane positions and the
+        signed magnifications of the images, padded with NaN.
+
+        Parameters:
+
+            source_x, source_y
+                             source plane coordinates of the sources;
+                             arrays of the same shape
+            num_threads      number of threads to use
+        """
+        if self.gamma or self.components.num_components:
+            raise ValueError("point source images can't be found with "
+                             "external shear or extended components")
+        if self.kappa_c == 1.0:
+            raise ValueError("kappa_c must not be 1")
+        source_x = _np.ascontiguousarray(source_x, _np.double)
+        source_y = _np.ascontiguousarray(source_y, _np.double)
+        if source_x.shape != source_y.shape:
+            raise ValueError("source_x and source_y must have the same shape")
+        max_images = self.lenses.num_lenses**2 + 1
+        shape = source_x.shape + (max_images,)
+        image_x = _np.empty(shape)
+        image_y = _np.empty(shape)
+        image_mag = _np.empty(shape)
+        num_images = _np.empty(source_x.shape, _c.c_uint)
+        magnification = _np.empty(source_x.shape)
+        _point_source_images(self, source_x.size, source_x, source_y,
+                             image_x, image_y, image_mag, num_images,
+                             magnification, num_threads)
+        padding = _np.arange(max_images) >= num_images[..., None]
+        for a in (image_x, image_y, image_mag):
+            a[padding] = _np.nan
+        return image_x, image_y, image_mag, magnification
+
+    def finite_source_magnifications(self, source_x, source_y, source_r,
+                                     limb_darkening=0.0, num_annuli=8,
+                                     tolerance=1e-4, num_threads=1):
+        """Compute the magnifications of circular sources.
+
+        The magnifications are computed by contour integration: the
+        images of the source boundary are found by solving the lens
+        equation like in point_source_images(), and the areas enclosed
+        by them are summed.  The boundary is sampled adaptively, more
+        densely where it crosses caustics.  The same restrictions as
+        for point_source_images() apply.  The return value is an array
+        of the shape of source_x and source_y.
+
+        Parameters:
+
+            source_x, source_y
+                             source plane coordinates of the centres of
+                             the sources; arrays of the same shape
+            source_r         radius of the sources
+            limb_darkening   linear limb darkening coefficient u; the
+                             intensity at the distance r from the
+                             centre is proportional to
+                             1 - u*(1 - sqrt(1 - r**2/source_r**2))
+            num_annuli       number of annuli of constant intensity
+                             approximating a limb darkened source
+            tolerance        relative error of the image areas
+            num_threads      number of threads to use
+        """
+        if self.gamma or self.components.num_components:
+            raise ValueError("finite source magnifications can't be "
+                             "computed with external shear or extended "
+                             "components")
+        if self.kappa_c == 1.0:
+            raise ValueError("kappa_c must not be 1")
+        if source_r <= 0.0:
+            raise ValueError("source_r must be positive")
+        source_x = _np.ascontiguousarray(source_x, _np.double)
+        source_y = _np.ascontiguousarray(source_y, _np.double)
+        if source_x.shape != source_y.shape:
+            raise ValueError("source_x and source_y must have the same shape")
+        magnification = _np.empty(source_x.shape)
+        _finite_source_magnifications(
+            self, source_x.size, source_x, source_y, source_r,
+            limb_darkening, num_annuli, tolerance, magnification,
+            num_threads)
+        return magnification
+
+    def lens_tree_error(self, rect, xrays=16, yrays=16):
+        """Return the error introduced by the lens tree.
+
+        The deflection of xrays x yrays rays in the centres of a
+        regular grid over rect is computed both with the lens tree and
+        by direct summation.  The return value is a pair (max_error,
+        mean_error) of the distances between the results in
+        magnification pattern pixels.
+        """
+        max_error = _c.c_double()
+        mean_error = _c.c_double()
+        _lens_tree_error(self, rect, xrays, yrays, max_error, mean_error)
+        return max_error.value, mean_error.value
+
     def rayshoot_rect(self, magpat, rect, xrays, yrays):
         _rayshoot_rect(self, magpat, rect, xrays, yrays)
 
@@ -315,6 +679,162 @@ class MagpatParams(_c.Structure):
     def light_curve(self, magpat, curve, x0, y0, x1, y1):
         _light_curve(self, magpat, curve, curve.size, x0, y0, x1, y1)
 
+    def sample_magpat(self, magpat, x, y, interpolation="bilinear",
+                      num_threads=1):
+        """Sample magpat at arbitrary source plane points.
+
+        Returns a float32 array of the shape of x and y with the
+        interpolated magnifications, and NaN for points outside the
+        pattern region.  The pixel values are the magnifications at
+        the pixel centres; beyond the outermost centres, the edge
+        pixels are repeated.
+
+        Parameters:
+
+            magpat           the magnification pattern, a C contiguous
+                             float32 array of shape (ypixels, xpixels)
+            x, y             source plane coordinates of the points;
+                             arrays of the same shape
+            interpolation    "bilinear", or "bicubic" for the
+                             Catmull-Rom spline through the 4 x 4
+                             nearest pixels, which is smooth but may
+                             overshoot next to caustics
+            num_threads      number of threads to use
+        """
+        if interpolation not in all_interpolations.values():
+            try:
+                interpolation = all_interpolations[
+                    interpolation.strip().lower()]
+            except KeyError:
+                raise ValueError("Unknown interpolation '%s'" % interpolation)
+        x = _np.ascontiguousarray(x, _np.double)
+        y = _np.ascontiguousarray(y, _np.double)
+        if x.shape != y.shape:
+            raise ValueError("x and y must have the same shape")
+        values = _np.empty(x.shape, _np.float32)
+        _sample_magpat(self, magpat, x.size, x, y, interpolation, values,
+                       num_threads)
+        return values
+
+    def light_curves(self, magpat, curves, x0, y0, x1, y1, samples=None,
+                     num_threads=1):
+        """Extract many light curves from magpat in a single call.
+
+        Curve i runs from (x0[i], y0[i]) to (x1[i], y1[i]) and is
+        stored in the row curves[i] of the two-dimensional float32
+        array curves.  If samples is given, curve i has samples[i]
+        samples and the rest of its row is filled with NaN; otherwise
+        the curves fill their rows.
+        """
+        x0, y0, x1, y1 = [_np.ascontiguousarray(a, _np.double)
+                          for a in (x0, y0, x1, y1)]
+        if not x0.shape == y0.shape == x1.shape == y1.shape:
+            raise ValueError("x0, y0, x1 and y1 must have the same shape")
+        if (not isinstance(curves, _np.ndarray) or
+            curves.dtype != _np.float32 or curves.ndim != 2 or
+            not curves.flags.c_contiguous):
+            raise ValueError("curves must be a C contiguous two-dimensional "
+                             "float32 array")
+        if len(curves) < x0.size:
+            raise ValueError("curves must have at least one row per curve")
+        samples_ptr = None
+        if samples is not None:
+            samples = _np.ascontiguousarray(samples, _c.c_uint)
+            if samples.shape != x0.shape:
+                raise ValueError("samples must have the shape of x0")
+            samples_ptr = samples.ctypes.data_as(_c.POINTER(_c.c_uint))
+        _light_curves(self, magpat, x0.size, x0, y0, x1, y1, samples_ptr,
+                      curves.shape[1], curves, num_threads)
+
+# Constants to select the interpolation of MagpatParams.sample_magpat().
+# These are enum constants in C.
+all_interpolations = {"bilinear": 0, "bicubic": 1}
+
+class ImageLattice(object):
+
+    """A cached lattice of rays for rendering images of sources.
+
+    The lattice covers the lens plane rectangle rect with xrays x yrays
+    image pixels, each sampled by refine x refine rays.  The rays are
+    deflected once when the lattice is created, and their source plane
+    coordinates are kept, so rendering the images of a source at any
+    number of positions only looks up the cached coordinates.  The
+    time per frame is dominated by reading the lattice, not by
+    deflecting rays.
+
+    Constructor:
+
+        ImageLattice(params, rect, xrays, yrays, refine=1, num_threads=1)
+
+        params           the MagpatParams with the lenses deflecting
+                         the rays
+        rect             lens plane rectangle of the images
+        xrays, yrays     number of image pixels
+        refine           number of rays per image pixel in x and
+                         y-direction
+        num_threads      number of threads for deflecting the rays
+
+    The coordinates of the rays of pixel (i, j) are stored in
+    source_x[j, i] and source_y[j, i], which are arrays of shape
+    (yrays, xrays, refine*refine).
+    """
+
+    def __init__(self, params, rect, xrays, yrays, refine=1, num_threads=1):
+        self.rect = Rect(*rect)
+        self.xrays = xrays
+        self.yrays = yrays
+        self.refine = refine
+        x = self.rect.x + (_np.arange(xrays * refine) *
+                           (self.rect.width/xrays/refine))
+        y = self.rect.y + (_np.arange(yrays * refine) *
+                           (self.rect.height/yrays/refine))
+        x = x.reshape(1, xrays, 1, refine)
+        y = y.reshape(yrays, 1, refine, 1)
+        shape = (yrays, xrays, refine, refine)
+        self.source_x, self.source_y = params.shoot_rays(
+            _np.broadcast_to(x, shape), _np.broadcast_to(y, shape),
+            num_threads=num_threads)[:2]
+        self.source_x.shape = self.source_y.shape = (yrays, xrays, -1)
+        self.bbox = _np.stack([self.source_x.min(axis=2),
+                               self.source_y.min(axis=2),
+                               self.source_x.max(axis=2),
+                               self.source_y.max(axis=2)], axis=2)
+
+    def render(self, source_x, source_y, source_r, out=None, num_threads=1):
+        """Render the images of circular sources.
+
+        The source positions and radii are given in source plane
+        coordinates as scalars or one-dimensional arrays of frames,
+        which are broadcast against each other.  The return value is
+        a uint8 array of shape (frames, yrays, xrays) containing the
+        fraction of the rays of each image pixel hitting the source,
+        scaled to 255 and rounded down (255 for all rays).
+
+        Parameters:
+
+            source_x, source_y
+                             centres of the sources
+            source_r         radii of the sources
+            out              optional C contiguous uint8 array of the
+                             result shape to render into
+            num_threads      number of threads to use
+        """
+        frames = _np.broadcast_arrays(*[
+            _np.ascontiguousarray(_np.atleast_1d(a), _np.double)
+            for a in (source_x, source_y, source_r)])
+        frames = [_np.ascontiguousarray(a) for a in frames]
+        num_frames = len(frames[0])
+        shape = (num_frames, self.yrays, self.xrays)
+        if out is None:
+            out = _np.empty(shape, _np.uint8)
+        elif out.shape != shape:
+            raise ValueError("out must have the shape %r" % (shape,))
+        _render_source_images(self.source_x, self.source_y, self.bbox,
+                              self.xrays * self.yrays, self.refine**2,
+                              num_frames, frames[0], frames[1], frames[2],
+                              out, num_threads)
+        return out
+
 Progress = _c.c_double
 """Type for the progress argument of some methods of BasicRayshooter.
 
@@ -324,26 +844,70 @@ The current value can be extracted by reading the attribute 'value'.
 # ctypes module, so we expose this type
 
 # Constants to select a ray shooting kernel.  These are enum constants in C.
-all_kernels = {"simple": 0, "bilinear": 1, "triangulated": 2}
+all_kernels = {"simple": 0, "bilinear": 1, "triangulated": 2,
+               "triangulated_scanline": 3, "adaptive": 4}
+
+# The kernels that directly compute float magnifications instead of
+# counting rays.
+area_kernels = (all_kernels["triangulated"],
+                all_kernels["triangulated_scanline"],
+                all_kernels["adaptive"])
+
+# Constants to select the floating point precision of the finest
+# shooting level.  These are enum constants in C.
+all_precisions = {"double": 0, "single": 1}
 
 class BasicRayshooter(_c.Structure):
 
-    """A class controlling the ray shooting process."""
+    """A class controlling the ray shooting process.
+
+    If far_field_angle is positive, the lenses are split into near and
+    far lenses for each patch of the shooting hierarchy.  The
+    deflection of the far lenses is approximated by a Taylor
+    polynomial about the patch centre, which is computed once per
+    patch and shared by all rays in the patch.  A lens counts as far
+    away if the radius of the patch is less than far_field_angle times
+    the lens' distance from the patch centre.  A value of about 0.3
+    keeps the relative error of the far field below 1e-5.
+
+    If precision is "single", the rays of the finest shooting level
+    are deflected in single precision, using coordinates relative to
+    the corner of the current patch.
+
+    The "adaptive" kernel splits the cells of the finest ray grid into
+    four, up to log2(refine_kernel) times, while their image in the
+    source plane is folded or deviates by more than tolerance pixels
+    from a parallelogram.  The cells are then rasterised as triangles
+    like by the "triangulated_scanline" kernel.  The largest relative
+    error of a pixel is about tolerance, so it should be set to the
+    error aimed for, and the shooting grid can be chosen about 2 to 3
+    times coarser in each direction than for the triangulated kernels.
+    """
 
     _fields_ = [("params", _c.POINTER(MagpatParams)),
                 ("kernel", _c.c_int),
                 ("refine", _c.c_int),
                 ("refine_kernel", _c.c_int),
+                ("far_field_angle", _c.c_double),
+                ("tolerance", _c.c_double),
+                ("precision", _c.c_int),
                 ("cancel_flag", _c.c_int)]
 
-    def __init__(self, params, kernel, refine, refine_kernel):
+    def __init__(self, params, kernel, refine, refine_kernel,
+                 far_field_angle=0.0, precision="double", tolerance=0.01):
         if kernel not in all_kernels.values():
             try:
                 kernel = all_kernels[kernel.strip().lower()]
             except KeyError:
                 raise ValueError("Unknown ray shooting kernel '%s'" % kernel)
+        if precision not in all_precisions.values():
+            try:
+                precision = all_precisions[precision.strip().lower()]
+            except KeyError:
+                raise ValueError("Unknown precision '%s'" % precision)
         _c.Structure.__init__(self, _c.pointer(params), kernel,
-                              refine, refine_kernel, False)
+                              refine, refine_kernel, far_field_angle,
+                              tolerance, precision, False)
 
     def cancel(self):
         """Cancel the currently running ray shooting function.
@@ -352,26 +916,123 @@ class BasicRayshooter(_c.Structure):
         """
         self.cancel_flag = True
 
-    def get_subpatches(self, patches):
-        _get_subpatches(self.params, patches)
+    def set_lens_tree(self, tree):
+        """Use the given LensTree to compute deflections.
 
-    def run_subpatches(self, magpat, patches, progress=Progress()):
-        _rayshoot_subpatches(self, magpat, patches, progress)
+        Pass None to switch back to direct summation over all lenses.
+        A reference to the tree is kept as long as it is in use.
+        """
+        self.lens_tree = tree
+        self.params.contents.tree = tree and tree.handle
 
-    def finalise_subpatches(self, magpat, patches):
-        if isinstance(magpat, list):
-            if self.kernel != all_kernels["triangulated"]:
-                for i, m in enumerate(magpat):
-                    magpat[i] = m.view(_np.int32)
-            for m in magpat[1:]:
-                magpat[0] += m
-            magpat = magpat[0]
-        _finalise_subpatches(self, magpat, patches)
+    def get_subpatches(self, patches, num_threads=1):
+        if num_threads > 1:
+            _get_subpatches_parallel(self, patches, num_threads)
+        else:
+            _get_subpatches(self.params, patches)
 
-    def run(self, magpat, rect, xrays, yrays, levels, progress=Progress()):
-        """Start the actual ray shooting."""
+    def run_subpatches(self, magpat, patches, progress=Progress(),
+                       num_threads=1):
+        if num_threads > 1:
+            _rayshoot_subpatches_parallel(self, magpat, patches, progress,
+                                          num_threads)
+        else:
+            _rayshoot_subpatches(self, magpat, patches, progress)
+
+    def finalise_subpatches(self, magpat, patches, num_threads=1):
+        if num_threads > 1:
+            _finalise_subpatches_parallel(self, magpat, patches, num_threads)
+        else:
+            _finalise_subpatches(self, magpat, patches)
+
+    def run(self, magpat, rect, xrays, yrays, levels, progress=Progress(),
+            num_threads=1):
+        """Start the actual ray shooting.
+
+        If num_threads is greater than 1, the hit patches of the
+        coarsest level are shot in parallel by a pool of native
+        threads, which is kept alive between runs.  The threads add
+        their rays to magpat through small fixed-size buffers, so no
+        additional pattern-sized memory is needed.
+        """
         self.cancel_flag = False
-        _rayshoot(self, magpat, rect, xrays, yrays, levels, progress)
+        if num_threads > 1:
+            _rayshoot_parallel(self, magpat, rect, xrays, yrays, levels,
+                               progress, num_threads)
+        else:
+            _rayshoot(self, magpat, rect, xrays, yrays, levels, progress)
+
+    def run_rows(self, magpat, patches, first_row, row_ranges,
+                 progress=Progress(), num_threads=1):
+        """Shoot the rows of the pattern starting at first_row.
+
+        magpat holds only these rows of the pattern described by
+        self.params.  patches are the hit patches of the coarsest
+        level as determined by get_subpatches().  row_ranges is an
+        int array of shape (xrays*yrays, 2), which should initially be
+        filled with -1.  It records the pattern rows hit by each patch,
+        so shooting further rows can skip the patches that can't
+        contribute.  Shooting a pattern in bands of rows gives the
+        same result as a single run, and the rows are scaled to
+        magnifications in the same way.
+        """
+        self.cancel_flag = False
+        _rayshoot_rows(self, magpat, patches, first_row, len(magpat),
+                       row_ranges, progress, num_threads)
+
+    # The following methods expose the deflected source plane
+    # coordinates of the ray grids shot on the coarsest level and for
+    # its hit patches, so they can be cached (see
+    # luckylensing.DeflectionCache).  The grids are always deflected
+    # in double precision and without far field expansion.
+
+    def deflect_top_grid(self, patches):
+        """Return the source plane coordinates of the rays determining
+        the hit patches.
+
+        The result is an array of shape (2, yrays+3, xrays+3) holding
+        the x and y coordinates of the deflected rays around the
+        corners of the patches.
+        """
+        source = _np.empty((2, patches.yrays+3, patches.xrays+3))
+        _deflect_grid(self.params, patches.rect.x, patches.rect.y,
+                      patches.width_per_xrays, patches.height_per_yrays,
+                      -1, patches.xrays+1, -1, patches.yrays+1,
+                      source[0], source[1])
+        return source
+
+    def get_subpatches_deflected(self, patches, source):
+        """Determine the hit patches from deflect_top_grid()'s result."""
+        _get_subpatches_deflected(self.params, patches,
+                                  _np.ascontiguousarray(source[0]),
+                                  _np.ascontiguousarray(source[1]))
+
+    def deflect_patches(self, patches, indices, num_threads=1):
+        """Return the source plane coordinates of the ray grids shot
+        for the patches with the given flat indices.
+
+        The result has shape (2, len(indices), grid_size).
+        """
+        indices = _np.ascontiguousarray(indices, _c.c_uint)
+        grid_size = _patch_grid_size(self, patches)
+        source = _np.empty((2, len(indices), grid_size))
+        _deflect_patches(self, patches, indices, len(indices),
+                         source[0], source[1], num_threads)
+        return source
+
+    def run_deflected(self, magpat, patches, indices, source,
+                      progress=Progress(), num_threads=1):
+        """Shoot the patches with the given flat indices into magpat.
+
+        source contains the deflected ray grids of these patches as
+        returned by deflect_patches().  The result is identical to
+        that of run_subpatches(), but the grids aren't shot again.
+        """
+        indices = _np.ascontiguousarray(indices, _c.c_uint)
+        _rayshoot_deflected(self, magpat, patches, indices, len(indices),
+                            _np.ascontiguousarray(source[0]),
+                            _np.ascontiguousarray(source[1]),
+                            progress, num_threads)
 
 # ctypes prototypes for the functions in libll.so
 _shoot_single_ray.argtypes = [_c.POINTER(MagpatParams),
@@ -381,6 +1042,21 @@ _shoot_single_ray.argtypes = [_c.POINTER(MagpatParams),
                               _c.POINTER(_c.c_double)]
 _shoot_single_ray.restype = _c.c_int
 
+_new_lens_tree.argtypes = [_c.POINTER(Lenses),
+                           _c.c_double]
+_new_lens_tree.restype = _c.c_void_p
+
+_free_lens_tree.argtypes = [_c.c_void_p]
+_free_lens_tree.restype = None
+
+_lens_tree_error.argtypes = [_c.POINTER(MagpatParams),
+                             _c.POINTER(Rect),
+                             _c.c_int,
+                             _c.c_int,
+                             _c.POINTER(_c.c_double),
+                             _c.POINTER(_c.c_double)]
+_lens_tree_error.restype = None
+
 _rayshoot_rect.argtypes = [_c.POINTER(MagpatParams),
                            _ndpointer(_c.c_uint32, flags="C_CONTIGUOUS"),
                            _c.POINTER(Rect),
@@ -412,6 +1088,138 @@ _rayshoot.argtypes = [_c.POINTER(BasicRayshooter),
                       _c.POINTER(_c.c_double)]
 _rayshoot.restype = None
 
+_get_subpatches_parallel.argtypes = [_c.POINTER(BasicRayshooter),
+                                     _c.POINTER(Patches),
+                                     _c.c_uint]
+_get_subpatches_parallel.restype = None
+
+_rayshoot_subpatches_parallel.argtypes = [_c.POINTER(BasicRayshooter),
+                                          _ndpointer(flags="C_CONTIGUOUS"),
+                                          _c.POINTER(Patches),
+                                          _c.POINTER(_c.c_double),
+                                          _c.c_uint]
+_rayshoot_subpatches_parallel.restype = None
+
+_finalise_subpatches_parallel.argtypes = [_c.POINTER(BasicRayshooter),
+                                          _ndpointer(flags="C_CONTIGUOUS"),
+                                          _c.POINTER(Patches),
+                                          _c.c_uint]
+_finalise_subpatches_parallel.restype = None
+
+_rayshoot_parallel.argtypes = [_c.POINTER(BasicRayshooter),
+                               _ndpointer(flags="C_CONTIGUOUS"),
+                               _c.POINTER(Rect),
+                               _c.c_int,
+                               _c.c_int,
+                               _c.c_uint,
+                               _c.POINTER(_c.c_double),
+                               _c.c_uint]
+_rayshoot_parallel.restype = None
+
+_rayshoot_rows.argtypes = [_c.POINTER(BasicRayshooter),
+                           _ndpointer(flags="C_CONTIGUOUS"),
+                           _c.POINTER(Patches),
+                           _c.c_uint,
+                           _c.c_uint,
+                           _ndpointer(_c.c_int, flags="C_CONTIGUOUS"),
+                           _c.POINTER(_c.c_double),
+                           _c.c_uint]
+_rayshoot_rows.restype = None
+
+_deflect_grid.argtypes = [_c.POINTER(MagpatParams),
+                          _c.c_double,
+                          _c.c_double,
+                          _c.c_double,
+                          _c.c_double,
+                          _c.c_int,
+                          _c.c_int,
+                          _c.c_int,
+                          _c.c_int,
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS")]
+_deflect_grid.restype = None
+
+_get_subpatches_deflected.argtypes = [
+    _c.POINTER(MagpatParams),
+    _c.POINTER(Patches),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS")]
+_get_subpatches_deflected.restype = None
+
+_patch_grid_size.argtypes = [_c.POINTER(BasicRayshooter),
+                             _c.POINTER(Patches)]
+_patch_grid_size.restype = _c.c_uint
+
+_deflect_patches.argtypes = [_c.POINTER(BasicRayshooter),
+                             _c.POINTER(Patches),
+                             _ndpointer(_c.c_uint, flags="C_CONTIGUOUS"),
+                             _c.c_uint,
+                             _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                             _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                             _c.c_uint]
+_deflect_patches.restype = None
+
+_rayshoot_deflected.argtypes = [_c.POINTER(BasicRayshooter),
+                                _ndpointer(flags="C_CONTIGUOUS"),
+                                _c.POINTER(Patches),
+                                _ndpointer(_c.c_uint, flags="C_CONTIGUOUS"),
+                                _c.c_uint,
+                                _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                                _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                                _c.POINTER(_c.c_double),
+                                _c.c_uint]
+_rayshoot_deflected.restype = None
+
+_deflect_rays.argtypes = [_c.POINTER(MagpatParams),
+                          _c.c_uint,
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_int, flags="C_CONTIGUOUS"),
+                          _c.c_uint]
+_deflect_rays.restype = None
+
+_point_source_images.argtypes = [
+    _c.POINTER(MagpatParams),
+    _c.c_uint,
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_uint, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _c.c_uint]
+_point_source_images.restype = None
+
+_finite_source_magnifications.argtypes = [
+    _c.POINTER(MagpatParams),
+    _c.c_uint,
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _c.c_double,
+    _c.c_double,
+    _c.c_uint,
+    _c.c_double,
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _c.c_uint]
+_finite_source_magnifications.restype = None
+
+_render_source_images.argtypes = [
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _c.c_uint,
+    _c.c_uint,
+    _c.c_uint,
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+    _ndpointer(_c.c_uint8, flags="C_CONTIGUOUS"),
+    _c.c_uint]
+_render_source_images.restype = None
+
 _ray_hit_pattern.argtypes = [_c.POINTER(MagpatParams),
                              _ndpointer(_c.c_uint8, flags="C_CONTIGUOUS"),
                              _c.POINTER(Rect)]
@@ -528,3 +1336,27 @@ _light_curve.argtypes = [_c.POINTER(MagpatParams),
                          _c.c_double,
                          _c.c_double]
 _light_curve.restype = None
+
+_light_curves.argtypes = [_c.POINTER(MagpatParams),
+                          _ndpointer(_c.c_float, flags="C_CONTIGUOUS"),
+                          _c.c_uint,
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                          _c.POINTER(_c.c_uint),
+                          _c.c_uint,
+                          _ndpointer(_c.c_float, ndim=2,
+                                     flags="C_CONTIGUOUS"),
+                          _c.c_uint]
+_light_curves.restype = None
+
+_sample_magpat.argtypes = [_c.POINTER(MagpatParams),
+                           _ndpointer(_c.c_float, flags="C_CONTIGUOUS"),
+                           _c.c_uint,
+                           _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                           _ndpointer(_c.c_double, flags="C_CONTIGUOUS"),
+                           _c.c_int,
+                           _ndpointer(_c.c_float, flags="C_CONTIGUOUS"),
+                           _c.c_uint]
+_sample_magpat.restype = None
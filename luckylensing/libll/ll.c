@@ -1,8 +1,13 @@
 // Lucky Lensing Library (http://github.com/smarnach/luckylensing)
 // Copyright 2010 Sven Marnach
 
+#define _POSIX_C_SOURCE 200809L
+
 #include "ll.h"
+#include <complex.h>
+#include <float.h>
 #include <math.h>
+#include <pthread.h>
 #include <stdlib.h>
 
 extern void
@@ -17,6 +22,14 @@ ll_init_magpat_params(struct ll_magpat_params *params,
     params->ypixels = ypixels;
     params->pixels_per_width = xpixels / region->width;
     params->pixels_per_height = ypixels / region->height;
+    params->tree = 0;
+    params->far_field = 0;
+    params->static_field = 0;
+    params->kappa_c = 0.0;
+    params->gamma = 0.0;
+    params->components.num_components = 0;
+    params->components.component = 0;
+    params->mask = 0;
 }
 
 extern void
@@ -26,6 +39,9 @@ ll_init_rayshooter(struct ll_rayshooter *rs, struct ll_magpat_params *params)
     rs->kernel = LL_KERNEL_BILINEAR;
     rs->refine = 15;
     rs->refine_kernel = 25;
+    rs->far_field_angle = 0.0;
+    rs->tolerance = 0.01;
+    rs->precision = LL_PRECISION_DOUBLE;
     rs->cancel = false;
 }
 
@@ -35,565 +51,3659 @@ ll_cancel_rayshooter(struct ll_rayshooter *rs)
     rs->cancel = true;
 }
 
-extern int __attribute__ ((hot))
-ll_shoot_single_ray(const struct ll_magpat_params *params,
-                    double x, double y, double *mag_x, double *mag_y)
+// The lens tree is a quadtree over the lenses with complex multipole
+// moments in each node.  The deflection caused by all lenses in a
+// node is approximated by the truncated multipole expansion of the
+// node if the node is small compared to its distance from the ray,
+// i.e. if the maximum distance of its lenses from the expansion
+// centre is less than opening_angle times the distance of the ray
+// from the centre.  Otherwise, the children of the node are
+// considered, and the lenses of leaf nodes are summed up directly.
+
+#define LL_TREE_ORDER 8
+#define LL_TREE_LEAF_SIZE 8
+#define LL_TREE_MAX_DEPTH 48
+
+struct ll_tree_node
 {
-    struct ll_lens *lens = params->lenses.lens;
-    double x_deflected = x, y_deflected = y;
-    for(unsigned i = 0; i < params->lenses.num_lenses; ++i)
+    double x, y;
+    double radius_squared;
+    double moment[LL_TREE_ORDER][2];
+    unsigned first, count;
+    unsigned child[4];
+    unsigned num_children;
+};
+
+struct ll_lens_tree
+{
+    double opening_angle_squared;
+    unsigned num_nodes, max_nodes;
+    struct ll_tree_node *node;
+    struct ll_lens *lens;
+};
+
+static unsigned
+_ll_partition_lenses(struct ll_lens *lens, unsigned count, bool by_x,
+                     double split)
+{
+    unsigned i = 0, j = count;
+    while (i < j)
     {
-        double dx = x - lens[i].x;
-        double dy = y - lens[i].y;
-        double theta_squared = dx*dx + dy*dy;
-        double deflection = lens[i].mass / theta_squared;
-        x_deflected -= dx * deflection;
-        y_deflected -= dy * deflection;
+        if ((by_x ? lens[i].x : lens[i].y) < split)
+            ++i;
+        else
+        {
+            struct ll_lens tmp = lens[i];
+            lens[i] = lens[--j];
+            lens[j] = tmp;
+        }
     }
-    *mag_x = (x_deflected - params->region.x) * params->pixels_per_width;
-    *mag_y = (y_deflected - params->region.y) * params->pixels_per_height;
-    return (((0 <= *mag_x)     ) | ((*mag_x < params->xpixels) << 1) |
-            ((0 <= *mag_y) << 2) | ((*mag_y < params->ypixels) << 3));
+    return i;
+}
+
+static void
+_ll_init_tree_node(struct ll_lens_tree *tree, unsigned index)
+{
+    struct ll_tree_node *node = tree->node + index;
+    struct ll_lens *lens = tree->lens + node->first;
+    double mass = 0.0, x = 0.0, y = 0.0;
+    for (unsigned i = 0; i < node->count; ++i)
+    {
+        mass += lens[i].mass;
+        x += lens[i].mass * lens[i].x;
+        y += lens[i].mass * lens[i].y;
+    }
+    if (mass > 0.0)
+    {
+        node->x = x / mass;
+        node->y = y / mass;
+    }
+    else
+    {
+        node->x = lens[0].x;
+        node->y = lens[0].y;
+    }
+    node->radius_squared = 0.0;
+    for (int k = 0; k < LL_TREE_ORDER; ++k)
+        node->moment[k][0] = node->moment[k][1] = 0.0;
+    for (unsigned i = 0; i < node->count; ++i)
+    {
+        double dx = lens[i].x - node->x;
+        double dy = lens[i].y - node->y;
+        double r_squared = dx*dx + dy*dy;
+        if (r_squared > node->radius_squared)
+            node->radius_squared = r_squared;
+        // moment[k] = sum of mass * (w - c)^k in complex notation
+        double re = lens[i].mass, im = 0.0;
+        for (int k = 0; k < LL_TREE_ORDER; ++k)
+        {
+            node->moment[k][0] += re;
+            node->moment[k][1] += im;
+            double tmp = re*dx - im*dy;
+            im = re*dy + im*dx;
+            re = tmp;
+        }
+    }
+}
+
+static unsigned
+_ll_build_tree_node(struct ll_lens_tree *tree, unsigned first, unsigned count,
+                    double x, double y, double size, unsigned depth)
+{
+    if (tree->num_nodes == tree->max_nodes)
+    {
+        tree->max_nodes *= 2;
+        tree->node = realloc(tree->node,
+                             tree->max_nodes * sizeof(struct ll_tree_node));
+    }
+    unsigned index = tree->num_nodes++;
+    struct ll_tree_node *node = tree->node + index;
+    node->first = first;
+    node->count = count;
+    node->num_children = 0;
+    _ll_init_tree_node(tree, index);
+    if (count <= LL_TREE_LEAF_SIZE || depth >= LL_TREE_MAX_DEPTH)
+        return index;
+
+    // Split the lenses into the four quadrants of the cell
+    double half = 0.5 * size;
+    struct ll_lens *lens = tree->lens + first;
+    unsigned bottom = _ll_partition_lenses(lens, count, false, y + half);
+    unsigned bottom_left = _ll_partition_lenses(lens, bottom, true, x + half);
+    unsigned top_left = _ll_partition_lenses(lens + bottom, count - bottom,
+                                             true, x + half);
+    unsigned offsets[5] = {0, bottom_left, bottom, bottom + top_left, count};
+    for (int q = 0; q < 4; ++q)
+    {
+        unsigned n = offsets[q+1] - offsets[q];
+        if (!n)
+            continue;
+        unsigned child = _ll_build_tree_node(
+            tree, first + offsets[q], n,
+            x + (q & 1) * half, y + (q >> 1) * half, half, depth + 1);
+        node = tree->node + index;
+        node->child[node->num_children++] = child;
+    }
+    return index;
+}
+
+extern struct ll_lens_tree *
+ll_new_lens_tree(const struct ll_lenses *lenses, double opening_angle)
+{
+    struct ll_lens_tree *tree = malloc(sizeof(struct ll_lens_tree));
+    tree->opening_angle_squared = opening_angle * opening_angle;
+    tree->num_nodes = 0;
+    tree->max_nodes = 64;
+    tree->node = malloc(tree->max_nodes * sizeof(struct ll_tree_node));
+    tree->lens = malloc(lenses->num_lenses * sizeof(struct ll_lens));
+    if (!lenses->num_lenses)
+        return tree;
+    double x0 = lenses->lens[0].x, x1 = x0;
+    double y0 = lenses->lens[0].y, y1 = y0;
+    for (unsigned i = 0; i < lenses->num_lenses; ++i)
+    {
+        tree->lens[i] = lenses->lens[i];
+        if (tree->lens[i].x < x0)
+            x0 = tree->lens[i].x;
+        if (tree->lens[i].x > x1)
+            x1 = tree->lens[i].x;
+        if (tree->lens[i].y < y0)
+            y0 = tree->lens[i].y;
+        if (tree->lens[i].y > y1)
+            y1 = tree->lens[i].y;
+    }
+    double size = fmax(x1 - x0, y1 - y0) * (1.0 + 1e-12) + 1e-300;
+    _ll_build_tree_node(tree, 0, lenses->num_lenses, x0, y0, size, 0);
+    return tree;
 }
 
 extern void
-ll_rayshoot_rect(const struct ll_magpat_params *params, uint32_t *magpat,
-                 const struct ll_rect *rect, int xrays, int yrays)
+ll_free_lens_tree(struct ll_lens_tree *tree)
 {
-    double width_per_xrays = rect->width / xrays;
-    double height_per_yrays = rect->height / yrays;
-    double mag_x, mag_y;
-    for (int j = 0; j < yrays; ++j)
-        for (int i = 0; i < xrays; ++i)
-            if (ll_shoot_single_ray(params,
-                                    rect->x + i*width_per_xrays,
-                                    rect->y + j*height_per_yrays,
-                                    &mag_x, &mag_y) == 0x0F)
-                ++magpat[(int)mag_y*params->xpixels + (int)mag_x];
+    if (!tree)
+        return;
+    free(tree->lens);
+    free(tree->node);
+    free(tree);
 }
 
 static void __attribute__ ((hot))
-_ll_rayshoot_bilinear(const struct ll_magpat_params *params, uint32_t *magpat,
-                      double coords[4][2], bool hit_all, int refine)
+_ll_tree_deflection(const struct ll_lens_tree *tree, double x, double y,
+                    double *alpha_x, double *alpha_y)
 {
-    double inv_refine = 1.0/refine;
-    double ldown_x = (coords[2][0] - coords[0][0]) * inv_refine;
-    double ldown_y = (coords[2][1] - coords[0][1]) * inv_refine;
-    double rdown_x = (coords[3][0] - coords[1][0]) * inv_refine;
-    double rdown_y = (coords[3][1] - coords[1][1]) * inv_refine;
-    double right_x = (coords[1][0] - coords[0][0]) * inv_refine;
-    double right_y = (coords[1][1] - coords[0][1]) * inv_refine;
-    double update_x = (rdown_x - ldown_x) * inv_refine;
-    double update_y = (rdown_y - ldown_y) * inv_refine;
-    double sx = coords[0][0];
-    double sy = coords[0][1];
-    if (hit_all)
-        for (int j = 0; j < refine; ++j)
+    if (!tree->num_nodes)
+        return;
+    unsigned stack[3*LL_TREE_MAX_DEPTH + 4];
+    unsigned top = 0;
+    double ax = 0.0, ay = 0.0;
+    stack[top++] = 0;
+    while (top)
+    {
+        const struct ll_tree_node *node = tree->node + stack[--top];
+        double dx = x - node->x;
+        double dy = y - node->y;
+        double d_squared = dx*dx + dy*dy;
+        if (node->radius_squared < tree->opening_angle_squared * d_squared)
         {
-            double x = sx;
-            double y = sy;
-            for (int i = 0; i < refine; ++i)
+            // Evaluate sum_k moment[k] / u^(k+1) with u = dx + i*dy by
+            // Horner's scheme in v = 1/u; the deflection is the complex
+            // conjugate of the result.
+            double v_re = dx / d_squared, v_im = -dy / d_squared;
+            double s_re = node->moment[LL_TREE_ORDER-1][0];
+            double s_im = node->moment[LL_TREE_ORDER-1][1];
+            for (int k = LL_TREE_ORDER - 2; k >= 0; --k)
             {
-                ++magpat[(int)y*params->xpixels + (int)x];
-                x += right_x;
-                y += right_y;
+                double tmp = s_re*v_re - s_im*v_im + node->moment[k][0];
+                s_im = s_re*v_im + s_im*v_re + node->moment[k][1];
+                s_re = tmp;
             }
-            sx += ldown_x;
-            sy += ldown_y;
-            right_x += update_x;
-            right_y += update_y;
+            ax += s_re*v_re - s_im*v_im;
+            ay -= s_re*v_im + s_im*v_re;
         }
-    else
-        for (int j = 0; j < refine; ++j)
+        else if (!node->num_children)
         {
-            double x = sx;
-            double y = sy;
-            int i = 0;
-            while ((x < 0.0 || x >= params->xpixels ||
-                    y < 0.0 || y >= params->ypixels) &&
-                   i < refine)
-            {
-                x += right_x;
-                y += right_y;
-                ++i;
-            }
-            while (i < refine &&
-                   x >= 0.0 && x < params->xpixels &&
-                   y >= 0.0 && y < params->ypixels)
+            const struct ll_lens *lens = tree->lens + node->first;
+            for (unsigned i = 0; i < node->count; ++i)
             {
-                ++magpat[(int)y*params->xpixels + (int)x];
-                x += right_x;
-                y += right_y;
-                ++i;
+                double lx = x - lens[i].x;
+                double ly = y - lens[i].y;
+                double deflection = lens[i].mass / (lx*lx + ly*ly);
+                ax += lx * deflection;
+                ay += ly * deflection;
             }
-            sx += ldown_x;
-            sy += ldown_y;
-            right_x += update_x;
-            right_y += update_y;
         }
+        else
+            for (unsigned c = 0; c < node->num_children; ++c)
+                stack[top++] = node->child[c];
+    }
+    *alpha_x += ax;
+    *alpha_y += ay;
 }
 
+// A far field expansion represents the deflection of all lenses far
+// away from a shooting patch as a Taylor polynomial about the patch
+// centre.  In complex notation, the complex conjugate of the
+// deflection of a lens of mass m at w is m/(z - w), so the far field
+// is the complex conjugate of
+//
+//     sum_k coeff[k] (z - c)^k  with  coeff[k] = -sum m/(w - c)^(k+1).
+//
+// Each patch is split into near lenses, which are summed up directly,
+// and far lenses, whose contributions are added to the polynomial of
+// the parent patch shifted to the new centre.  A lens is considered
+// far away if the radius of the patch is less than far_field_angle
+// times its distance from the patch centre.
+
 static void __attribute__ ((hot))
-_ll_rayshoot_triangulated(const struct ll_magpat_params *params,
-                          float *magpat, double rect_area,
-                          double tri_vertices[4][2], int max_area)
+_ll_far_field_deflection(const struct ll_far_field *far_field,
+                         double x, double y, double *alpha_x, double *alpha_y)
 {
-    double pixel_area = 0.5 * rect_area *
-        params->pixels_per_width * params->pixels_per_height;
-    for (int triangle = 0; triangle < 2; ++triangle)
+    double u_re = x - far_field->x, u_im = y - far_field->y;
+    double s_re = far_field->coeff[LL_FAR_FIELD_ORDER-1][0];
+    double s_im = far_field->coeff[LL_FAR_FIELD_ORDER-1][1];
+    for (int k = LL_FAR_FIELD_ORDER - 2; k >= 0; --k)
     {
-        if (triangle)
+        double tmp = s_re*u_re - s_im*u_im + far_field->coeff[k][0];
+        s_im = s_re*u_im + s_im*u_re + far_field->coeff[k][1];
+        s_re = tmp;
+    }
+    *alpha_x += s_re;
+    *alpha_y -= s_im;
+}
+
+static bool
+_ll_split_far_field(const struct ll_rayshooter *rs,
+                    const struct ll_magpat_params *parent,
+                    const struct ll_rect *rect, int xrays, int yrays,
+                    struct ll_magpat_params *params,
+                    struct ll_far_field *far_field)
+{
+    // Splitting does not pay off for a small number of lenses.  With a
+    // static field, the costly lenses are in the field anyway.
+    if (rs->far_field_angle <= 0.0 || parent->lenses.num_lenses < 32 ||
+        parent->static_field)
+        return false;
+
+    // The expansion must be valid for the rays shot by
+    // ll_get_subpatches(), which exceed the patch by one ray spacing.
+    double width = rect->width * (1.0 + 2.0/xrays);
+    double height = rect->height * (1.0 + 2.0/yrays);
+    double radius_squared = 0.25 * (width*width + height*height);
+    double cx = rect->x + 0.5*rect->width;
+    double cy = rect->y + 0.5*rect->height;
+    double min_distance_squared =
+        radius_squared / (rs->far_field_angle * rs->far_field_angle);
+
+    far_field->x = cx;
+    far_field->y = cy;
+    if (parent->far_field)
+    {
+        // Shift the parent polynomial to the new centre
+        double d_re = cx - parent->far_field->x;
+        double d_im = cy - parent->far_field->y;
+        for (int k = 0; k < LL_FAR_FIELD_ORDER; ++k)
         {
-            tri_vertices[0][0] = tri_vertices[3][0];
-            tri_vertices[0][1] = tri_vertices[3][1];
+            far_field->coeff[k][0] = parent->far_field->coeff[k][0];
+            far_field->coeff[k][1] = parent->far_field->coeff[k][1];
         }
+        for (int i = 0; i < LL_FAR_FIELD_ORDER - 1; ++i)
+            for (int k = LL_FAR_FIELD_ORDER - 2; k >= i; --k)
+            {
+                double *c = far_field->coeff[k], *c1 = far_field->coeff[k+1];
+                c[0] += d_re*c1[0] - d_im*c1[1];
+                c[1] += d_re*c1[1] + d_im*c1[0];
+            }
+    }
+    else
+        for (int k = 0; k < LL_FAR_FIELD_ORDER; ++k)
+            far_field->coeff[k][0] = far_field->coeff[k][1] = 0.0;
 
-        double tri_area = ((tri_vertices[1][0]-tri_vertices[0][0]) *
-                           (tri_vertices[2][1]-tri_vertices[0][1]) -
-                           (tri_vertices[1][1]-tri_vertices[0][1]) *
-                           (tri_vertices[2][0]-tri_vertices[0][0]));
-        if (fabs(tri_area) > 1e-4*max_area*params->xpixels*params->ypixels)
-            continue;
-        double magnification =  pixel_area / tri_area;
-
-        // Get minimum and maximum x coordinate in the magpattern
-        bool single_pixel_optimization = true;
-        int min = 0, max = 0;
-        if (tri_vertices[1][0] < tri_vertices[0][0])
-            min = 1;
-        else
-            max = 1;
-        if (tri_vertices[2][0] < tri_vertices[min][0])
-            min = 2;
-        if (tri_vertices[2][0] > tri_vertices[max][0])
-            max = 2;
-        if (tri_vertices[min][0] >= params->xpixels)
-            continue;
-        if (tri_vertices[max][0] < 0.0)
+    const struct ll_lens *lens = parent->lenses.lens;
+    struct ll_lens *near = malloc(parent->lenses.num_lenses *
+                                  sizeof(struct ll_lens));
+    unsigned num_near = 0;
+    for (unsigned i = 0; i < parent->lenses.num_lenses; ++i)
+    {
+        double dx = lens[i].x - cx;
+        double dy = lens[i].y - cy;
+        double d_squared = dx*dx + dy*dy;
+        if (d_squared <= min_distance_squared)
+        {
+            near[num_near++] = lens[i];
             continue;
-        int mag_x0;
-        if (tri_vertices[min][0] < 0.0)
+        }
+        // Add -m/(w - c)^(k+1) to the coefficients
+        double q_re = dx / d_squared, q_im = -dy / d_squared;
+        double t_re = -lens[i].mass * q_re, t_im = -lens[i].mass * q_im;
+        for (int k = 0; k < LL_FAR_FIELD_ORDER; ++k)
         {
-            mag_x0 = -1;
-            single_pixel_optimization = false;
+            far_field->coeff[k][0] += t_re;
+            far_field->coeff[k][1] += t_im;
+            double tmp = t_re*q_re - t_im*q_im;
+            t_im = t_re*q_im + t_im*q_re;
+            t_re = tmp;
         }
-        else
-            mag_x0 = tri_vertices[min][0];
-        int mag_x1;
-        if (tri_vertices[max][0] >= params->xpixels)
+    }
+    *params = *parent;
+    params->lenses.num_lenses = num_near;
+    params->lenses.lens = near;
+    params->tree = 0;
+    params->far_field = far_field;
+    return true;
+}
+
+static void
+_ll_shoot_ray_block(const struct ll_magpat_params *params, unsigned n,
+                    const double *restrict x, const double *restrict y,
+                    double *restrict mag_x, double *restrict mag_y,
+                    int *restrict hit);
+
+static void
+_ll_shoot_ray_block_static(const struct ll_magpat_params *params, unsigned n,
+                           const double *restrict x, const double *restrict y,
+                           double *restrict mag_x, double *restrict mag_y,
+                           int *restrict hit);
+
+// Return the factor f such that the component deflects a ray at the
+// offset (dx, dy) from its centre by f*(dx, dy), where r_squared is
+// dx*dx + dy*dy.
+static inline double
+_ll_component_factor(const struct ll_component *c, double r_squared)
+{
+    if (c->type == LL_COMPONENT_PLUMMER)
+        return c->strength / (r_squared + c->radius*c->radius);
+    double r = sqrt(r_squared);
+    if (c->radius > 0.0 && r > c->radius)
+        return c->strength * c->radius / r_squared;
+    return c->strength / r;
+}
+
+extern int __attribute__ ((hot))
+ll_shoot_single_ray(const struct ll_magpat_params *params,
+                    double x, double y, double *mag_x, double *mag_y)
+{
+    if (params->static_field)
+    {
+        int hit;
+        _ll_shoot_ray_block(params, 1, &x, &y, mag_x, mag_y, &hit);
+        return hit;
+    }
+    struct ll_lens *lens = params->lenses.lens;
+    double x_deflected = (1.0 - params->kappa_c - params->gamma) * x;
+    double y_deflected = (1.0 - params->kappa_c + params->gamma) * y;
+    if (params->tree || params->far_field)
+    {
+        double alpha_x = 0.0, alpha_y = 0.0;
+        if (params->far_field)
+            _ll_far_field_deflection(params->far_field, x, y,
+                                     &alpha_x, &alpha_y);
+        if (params->tree)
+            _ll_tree_deflection(params->tree, x, y, &alpha_x, &alpha_y);
+        x_deflected -= alpha_x;
+        y_deflected -= alpha_y;
+    }
+    for (unsigned c = 0; c < params->components.num_components; ++c)
+    {
+        const struct ll_component *component =
+            params->components.component + c;
+        double dx = x - component->x;
+        double dy = y - component->y;
+        double factor = _ll_component_factor(component, dx*dx + dy*dy);
+        x_deflected -= dx * factor;
+        y_deflected -= dy * factor;
+    }
+    if (!params->tree)
+        for(unsigned i = 0; i < params->lenses.num_lenses; ++i)
         {
-            mag_x1 = params->xpixels - 1;
-            single_pixel_optimization = false;
+            double dx = x - lens[i].x;
+            double dy = y - lens[i].y;
+            double theta_squared = dx*dx + dy*dy;
+            double deflection = lens[i].mass / theta_squared;
+            x_deflected -= dx * deflection;
+            y_deflected -= dy * deflection;
         }
-        else
-            mag_x1 = tri_vertices[max][0];
+    *mag_x = (x_deflected - params->region.x) * params->pixels_per_width;
+    *mag_y = (y_deflected - params->region.y) * params->pixels_per_height;
+    return (((0 <= *mag_x)     ) | ((*mag_x < params->xpixels) << 1) |
+            ((0 <= *mag_y) << 2) | ((*mag_y < params->ypixels) << 3));
+}
 
-        // Get minimum and maximum y coordinate in the magpattern
-        min = 0, max = 0;
-        if (tri_vertices[1][1] < tri_vertices[0][1])
-            min = 1;
-        else
-            max = 1;
-        if (tri_vertices[2][1] < tri_vertices[min][1])
-            min = 2;
-        if (tri_vertices[2][1] > tri_vertices[max][1])
-            max = 2;
-        if (tri_vertices[min][1] >= params->ypixels)
-            continue;
-        if (tri_vertices[max][1] < 0.0)
-            continue;
-        int mag_y0;
-        if (tri_vertices[min][1] < 0.0)
+// Rays are deflected in blocks of up to LL_RAY_BLOCK rays.  The
+// lenses are copied to a structure-of-arrays layout in tiles of
+// LL_LENS_BLOCK lenses, so both the rays of a block and the current
+// lens tile stay in the L1 cache.  The innermost loop runs over the
+// rays and is vectorised by the compiler.  Each ray sees the lenses in
+// the same order as in ll_shoot_single_ray(), so the results are
+// identical.
+
+#define LL_RAY_BLOCK 256
+#define LL_LENS_BLOCK 256
+
+static void __attribute__ ((hot))
+_ll_shoot_ray_block(const struct ll_magpat_params *params, unsigned n,
+                    const double *restrict x, const double *restrict y,
+                    double *restrict mag_x, double *restrict mag_y,
+                    int *restrict hit)
+{
+    if (params->static_field)
+    {
+        _ll_shoot_ray_block_static(params, n, x, y, mag_x, mag_y, hit);
+        return;
+    }
+    double x_deflected[LL_RAY_BLOCK], y_deflected[LL_RAY_BLOCK];
+    double scale_x = 1.0 - params->kappa_c - params->gamma;
+    double scale_y = 1.0 - params->kappa_c + params->gamma;
+    for (unsigned r = 0; r < n; ++r)
+    {
+        x_deflected[r] = scale_x * x[r];
+        y_deflected[r] = scale_y * y[r];
+    }
+    if (params->tree || params->far_field)
+        for (unsigned r = 0; r < n; ++r)
         {
-            mag_y0 = 0;
-            single_pixel_optimization = false;
+            double alpha_x = 0.0, alpha_y = 0.0;
+            if (params->far_field)
+                _ll_far_field_deflection(params->far_field, x[r], y[r],
+                                         &alpha_x, &alpha_y);
+            if (params->tree)
+                _ll_tree_deflection(params->tree, x[r], y[r],
+                                    &alpha_x, &alpha_y);
+            x_deflected[r] -= alpha_x;
+            y_deflected[r] -= alpha_y;
         }
-        else
-            mag_y0 = tri_vertices[min][1];
-        int mag_y1;
-        if (tri_vertices[max][1] >= params->ypixels)
+    for (unsigned c = 0; c < params->components.num_components; ++c)
+    {
+        const struct ll_component *component =
+            params->components.component + c;
+        for (unsigned r = 0; r < n; ++r)
         {
-            mag_y1 = params->ypixels - 1;
-            single_pixel_optimization = false;
+            double dx = x[r] - component->x;
+            double dy = y[r] - component->y;
+            double factor = _ll_component_factor(component, dx*dx + dy*dy);
+            x_deflected[r] -= dx * factor;
+            y_deflected[r] -= dy * factor;
         }
-        else
-            mag_y1 = tri_vertices[max][1];
+    }
+    if (!params->tree)
+    {
+        const struct ll_lens *lens = params->lenses.lens;
+        double lens_x[LL_LENS_BLOCK], lens_y[LL_LENS_BLOCK];
+        double lens_mass[LL_LENS_BLOCK];
+        for (unsigned l0 = 0; l0 < params->lenses.num_lenses;
+             l0 += LL_LENS_BLOCK)
+        {
+            unsigned num_lenses = params->lenses.num_lenses - l0;
+            if (num_lenses > LL_LENS_BLOCK)
+                num_lenses = LL_LENS_BLOCK;
+            for (unsigned l = 0; l < num_lenses; ++l)
+            {
+                lens_x[l] = lens[l0+l].x;
+                lens_y[l] = lens[l0+l].y;
+                lens_mass[l] = lens[l0+l].mass;
+            }
+            for (unsigned l = 0; l < num_lenses; ++l)
+            {
+                double lx = lens_x[l], ly = lens_y[l], mass = lens_mass[l];
+                for (unsigned r = 0; r < n; ++r)
+                {
+                    double dx = x[r] - lx;
+                    double dy = y[r] - ly;
+                    double deflection = mass / (dx*dx + dy*dy);
+                    x_deflected[r] -= dx * deflection;
+                    y_deflected[r] -= dy * deflection;
+                }
+            }
+        }
+    }
+    for (unsigned r = 0; r < n; ++r)
+    {
+        mag_x[r] = (x_deflected[r] - params->region.x) *
+            params->pixels_per_width;
+        mag_y[r] = (y_deflected[r] - params->region.y) *
+            params->pixels_per_height;
+        hit[r] = (((0 <= mag_x[r])     ) |
+                  ((mag_x[r] < params->xpixels) << 1) |
+                  ((0 <= mag_y[r]) << 2) |
+                  ((mag_y[r] < params->ypixels) << 3));
+    }
+}
 
-        // Render the triangle
-        if (single_pixel_optimization && mag_x0 == mag_x1 && mag_y0 == mag_y1)
+// Version of _ll_shoot_ray_block() for parameters with a static field.
+// Rays on a lattice point of the field use the deflection of the
+// static lenses at the lattice point, computing it if needed.  Threads
+// filling in the same entry concurrently write the same values, and a
+// partially written entry is recognised as not computed, so no locking
+// is needed.  Rays off the lattice are deflected directly.
+static void
+_ll_shoot_ray_block_static(const struct ll_magpat_params *params, unsigned n,
+                           const double *restrict x, const double *restrict y,
+                           double *restrict mag_x, double *restrict mag_y,
+                           int *restrict hit)
+{
+    struct ll_static_field *field = params->static_field;
+    // Region at the origin and one pixel per unit length give source
+    // plane coordinates.
+    struct ll_magpat_params source_params = *params;
+    source_params.static_field = 0;
+    source_params.region.x = 0.0;
+    source_params.region.y = 0.0;
+    source_params.pixels_per_width = 1.0;
+    source_params.pixels_per_height = 1.0;
+    double source_x[LL_RAY_BLOCK], source_y[LL_RAY_BLOCK];
+    _ll_shoot_ray_block(&source_params, n, x, y, source_x, source_y, hit);
+
+    double alpha_x[LL_RAY_BLOCK], alpha_y[LL_RAY_BLOCK];
+    double missing_x[LL_RAY_BLOCK], missing_y[LL_RAY_BLOCK];
+    double *entry[LL_RAY_BLOCK];
+    unsigned missing[LL_RAY_BLOCK];
+    unsigned num_missing = 0;
+    for (unsigned r = 0; r < n; ++r)
+    {
+        double fi = (x[r] - field->x) / field->dx;
+        double fj = (y[r] - field->y) / field->dy;
+        long i = lround(fi);
+        long j = lround(fj);
+        double *d = 0;
+        if (fabs(fi - i) < 1e-6 && fabs(fj - j) < 1e-6 &&
+            0 <= i && i < (long)field->width &&
+            0 <= j && j < (long)field->height)
         {
-            // The triangle is completely contained in a single pixel,
-            // so we can take a shortcut
-            magpat[mag_y0*params->xpixels + mag_x0] += pixel_area;
-            continue;
+            d = field->deflection + 2*((size_t)j*field->width + i);
+            alpha_x[r] = d[0];
+            alpha_y[r] = d[1];
+            if (alpha_x[r] != LL_NOT_COMPUTED && alpha_y[r] != LL_NOT_COMPUTED)
+                continue;
+            // Use the exact lattice point, so the entry doesn't depend
+            // on which ray computes it first.
+            missing_x[num_missing] = field->x + i*field->dx;
+            missing_y[num_missing] = field->y + j*field->dy;
         }
-        double vertices[11][2];
-        for (int k = 0; k < 3; ++k)
+        else
         {
-            vertices[k][0] = tri_vertices[k][0];
-            vertices[k][1] = tri_vertices[k][1];
+            missing_x[num_missing] = x[r];
+            missing_y[num_missing] = y[r];
         }
-        for (int y = mag_y0; y <= mag_y1; ++y)
+        entry[num_missing] = d;
+        missing[num_missing++] = r;
+    }
+    if (num_missing)
+    {
+        struct ll_magpat_params static_params = source_params;
+        static_params.lenses = field->lenses;
+        static_params.tree = field->tree;
+        static_params.far_field = 0;
+        static_params.kappa_c = 0.0;
+        static_params.gamma = 0.0;
+        static_params.components.num_components = 0;
+        double static_x[LL_RAY_BLOCK], static_y[LL_RAY_BLOCK];
+        int static_hit[LL_RAY_BLOCK];
+        _ll_shoot_ray_block(&static_params, num_missing, missing_x, missing_y,
+                            static_x, static_y, static_hit);
+        for (unsigned k = 0; k < num_missing; ++k)
         {
-            int vertex_indices[5][2];
-            vertex_indices[0][0] = 2; vertex_indices[0][1] = 0;
-            vertex_indices[1][0] = 0; vertex_indices[1][1] = 1;
-            vertex_indices[2][0] = 1; vertex_indices[2][1] = 2;
-            int valid_edges = 0x07;
-            int num_edges = 3;
+            unsigned r = missing[k];
+            alpha_x[r] = missing_x[k] - static_x[k];
+            alpha_y[r] = missing_y[k] - static_y[k];
+            if (entry[k])
+            {
+                entry[k][0] = alpha_x[r];
+                entry[k][1] = alpha_y[r];
+            }
+        }
+    }
+    for (unsigned r = 0; r < n; ++r)
+    {
+        mag_x[r] = (source_x[r] - field->scale*alpha_x[r] - params->region.x) *
+            params->pixels_per_width;
+        mag_y[r] = (source_y[r] - field->scale*alpha_y[r] - params->region.y) *
+            params->pixels_per_height;
+        hit[r] = (((0 <= mag_x[r])     ) |
+                  ((mag_x[r] < params->xpixels) << 1) |
+                  ((0 <= mag_y[r]) << 2) |
+                  ((mag_y[r] < params->ypixels) << 3));
+    }
+}
 
-            for (int k = 0; k < 2; ++k)
+// Single precision version of _ll_shoot_ray_block().  The coordinates
+// of the rays and lenses are taken relative to an origin close to the
+// rays, usually the corner of the current shooting patch, so the
+// limited precision is not wasted on the absolute position of the
+// patch.  Only the deflection by the point lenses and the smooth
+// matter term of the relative coordinates are computed in single
+// precision.
+static void __attribute__ ((hot))
+_ll_shoot_ray_block_float(const struct ll_magpat_params *params, unsigned n,
+                          double origin_x, double origin_y,
+                          const double *restrict x, const double *restrict y,
+                          double *restrict mag_x, double *restrict mag_y,
+                          int *restrict hit)
+{
+    float x_rel[LL_RAY_BLOCK], y_rel[LL_RAY_BLOCK];
+    float x_deflected[LL_RAY_BLOCK], y_deflected[LL_RAY_BLOCK];
+    double scale_x = 1.0 - params->kappa_c - params->gamma;
+    double scale_y = 1.0 - params->kappa_c + params->gamma;
+    for (unsigned r = 0; r < n; ++r)
+    {
+        x_rel[r] = x[r] - origin_x;
+        y_rel[r] = y[r] - origin_y;
+        x_deflected[r] = scale_x * x_rel[r];
+        y_deflected[r] = scale_y * y_rel[r];
+    }
+    if (params->tree || params->far_field)
+        for (unsigned r = 0; r < n; ++r)
+        {
+            double alpha_x = 0.0, alpha_y = 0.0;
+            if (params->far_field)
+                _ll_far_field_deflection(params->far_field, x[r], y[r],
+                                         &alpha_x, &alpha_y);
+            if (params->tree)
+                _ll_tree_deflection(params->tree, x[r], y[r],
+                                    &alpha_x, &alpha_y);
+            x_deflected[r] = scale_x * (x[r] - origin_x) - alpha_x;
+            y_deflected[r] = scale_y * (y[r] - origin_y) - alpha_y;
+        }
+    for (unsigned c = 0; c < params->components.num_components; ++c)
+    {
+        const struct ll_component *component =
+            params->components.component + c;
+        for (unsigned r = 0; r < n; ++r)
+        {
+            double dx = x[r] - component->x;
+            double dy = y[r] - component->y;
+            double factor = _ll_component_factor(component, dx*dx + dy*dy);
+            x_deflected[r] -= dx * factor;
+            y_deflected[r] -= dy * factor;
+        }
+    }
+    if (!params->tree)
+    {
+        const struct ll_lens *lens = params->lenses.lens;
+        float lens_x[LL_LENS_BLOCK], lens_y[LL_LENS_BLOCK];
+        float lens_mass[LL_LENS_BLOCK];
+        for (unsigned l0 = 0; l0 < params->lenses.num_lenses;
+             l0 += LL_LENS_BLOCK)
+        {
+            unsigned num_lenses = params->lenses.num_lenses - l0;
+            if (num_lenses > LL_LENS_BLOCK)
+                num_lenses = LL_LENS_BLOCK;
+            for (unsigned l = 0; l < num_lenses; ++l)
             {
-                double yi = y + k;
-                int edge_idx = 3 + k;
-                int vertex_idx = 3 + 2*k;
-                double sgn = 1.0;
-                if (k)
-                    sgn = -1.0;
-                for (int v0 = 2, v1 = 0; v1 < 3; v0 = v1, ++v1)
+                lens_x[l] = lens[l0+l].x - origin_x;
+                lens_y[l] = lens[l0+l].y - origin_y;
+                lens_mass[l] = lens[l0+l].mass;
+            }
+            for (unsigned l = 0; l < num_lenses; ++l)
+            {
+                float lx = lens_x[l], ly = lens_y[l], mass = lens_mass[l];
+                for (unsigned r = 0; r < n; ++r)
                 {
-                    double a0 = sgn * (yi - vertices[v0][1]);
-                    double a1 = sgn * (yi - vertices[v1][1]);
-                    if (a0 < 0.0)
-                    {
-                        if (a1 >= 0.0)
-                        {
-                            double t = a0 / (a0-a1);
-                            vertices[vertex_idx][0] = vertices[v0][0] +
-                                t*(vertices[v1][0] - vertices[v0][0]);
-                            vertices[vertex_idx][1] = yi;
-                            vertex_indices[v1][1] = vertex_idx;
-                            vertex_indices[edge_idx][0] = vertex_idx;
-                            valid_edges |= 1 << edge_idx;
-                            ++num_edges;
-                        }
-                    } else {
-                        if (a1 < 0.0)
-                        {
-                            double t = a0 / (a0-a1);
-                            vertices[vertex_idx+1][0] = vertices[v0][0] +
-                                t*(vertices[v1][0] - vertices[v0][0]);
-                            vertices[vertex_idx+1][1] = yi;
-                            vertex_indices[v1][0] = vertex_idx+1;
-                            vertex_indices[edge_idx][1] = vertex_idx+1;
-                        } else {
-                            valid_edges &= ~(1 << v1);
-                            --num_edges;
-                        }
-                    }
+                    float dx = x_rel[r] - lx;
+                    float dy = y_rel[r] - ly;
+                    // Rays closer to a lens than the single precision
+                    // resolution would give 0/0 without FLT_MIN
+                    float deflection = mass / (dx*dx + dy*dy + FLT_MIN);
+                    x_deflected[r] -= dx * deflection;
+                    y_deflected[r] -= dy * deflection;
                 }
             }
+        }
+    }
+    for (unsigned r = 0; r < n; ++r)
+    {
+        mag_x[r] = (scale_x * origin_x - params->region.x + x_deflected[r]) *
+            params->pixels_per_width;
+        mag_y[r] = (scale_y * origin_y - params->region.y + y_deflected[r]) *
+            params->pixels_per_height;
+        hit[r] = (((0 <= mag_x[r])     ) |
+                  ((mag_x[r] < params->xpixels) << 1) |
+                  ((0 <= mag_y[r]) << 2) |
+                  ((mag_y[r] < params->ypixels) << 3));
+    }
+}
 
-            int actions = 0;
-            for (int x = mag_x0; x <= mag_x1; ++x)
+extern void
+ll_shoot_rays(const struct ll_magpat_params *params, unsigned num_rays,
+              const double *x, const double *y,
+              double *mag_x, double *mag_y, int *hit)
+{
+    for (unsigned start = 0; start < num_rays; start += LL_RAY_BLOCK)
+    {
+        unsigned n = num_rays - start;
+        if (n > LL_RAY_BLOCK)
+            n = LL_RAY_BLOCK;
+        _ll_shoot_ray_block(params, n, x + start, y + start,
+                            mag_x + start, mag_y + start, hit + start);
+    }
+}
+
+// Shoot the rays (x0 + i*dx, y0 + j*dy) for i0 <= i <= i1 and
+// j0 <= j <= j1 in row-major order.  mag_x and mag_y may be null if
+// only the hit codes are needed.  In single precision, (x0, y0) is
+// used as the origin for the relative coordinates.
+static void
+_ll_shoot_ray_grid(const struct ll_magpat_params *params,
+                   enum ll_precision precision,
+                   double x0, double y0, double dx, double dy,
+                   int i0, int i1, int j0, int j1,
+                   double *mag_x, double *mag_y, int *hit)
+{
+    double x[LL_RAY_BLOCK], y[LL_RAY_BLOCK];
+    double scratch_x[LL_RAY_BLOCK], scratch_y[LL_RAY_BLOCK];
+    int nx = i1 - i0 + 1;
+    int total = nx * (j1 - j0 + 1);
+    for (int start = 0; start < total; start += LL_RAY_BLOCK)
+    {
+        int n = total - start;
+        if (n > LL_RAY_BLOCK)
+            n = LL_RAY_BLOCK;
+        for (int k = 0, i = i0 + start % nx, j = j0 + start / nx; k < n; ++k)
+        {
+            x[k] = x0 + i*dx;
+            y[k] = y0 + j*dy;
+            if (++i > i1)
             {
-                int vertex_indices2[7][2];
-                for (int i = 0; i < 5; ++i)
-                {
-                    vertex_indices2[i][0] = vertex_indices[i][0];
-                    vertex_indices2[i][1] = vertex_indices[i][1];
-                }
-                int valid_edges2 = valid_edges;
-                int num_edges2 = num_edges;
+                i = i0;
+                ++j;
+            }
+        }
+        if (precision == LL_PRECISION_SINGLE && !params->static_field)
+            _ll_shoot_ray_block_float(params, n, x0, y0, x, y,
+                                      mag_x ? mag_x + start : scratch_x,
+                                      mag_y ? mag_y + start : scratch_y,
+                                      hit + start);
+        else
+            _ll_shoot_ray_block(params, n, x, y,
+                                mag_x ? mag_x + start : scratch_x,
+                                mag_y ? mag_y + start : scratch_y,
+                                hit + start);
+    }
+}
 
-                if (actions)
-                {
-                    int idx_offset = (x&1) << 1;
-                    for (int i = 0; i < 5; ++i)
-                    {
-                        switch (actions>>(i<<1) & 3)
-                        {
-                        case 1:
-                        {
-                            int vertex_idx = 7 + idx_offset;
-                            vertex_indices2[i][1] = vertex_idx;
-                            vertex_indices2[5][0] = vertex_idx;
-                            valid_edges2 |= 1 << 5;
-                            ++num_edges2;
-                            break;
-                        }
-                        case 2:
-                        {
-                            int vertex_idx = 8 + idx_offset;
-                            vertex_indices2[i][0] = vertex_idx;
-                            vertex_indices2[5][1] = vertex_idx;
-                            break;
-                        }
-                        case 3:
-                        {
-                            valid_edges2 &= ~(1 << i);
-                            --num_edges2;
-                            valid_edges &= ~(1 << i);
-                            --num_edges;
-                            break;
-                        }
-                        }
-                    }
-                }
-                double xi = x + 1;
-                int idx_offset = ((x&1) ^ 1) << 1;
-                actions = 0;
-                for(int i = 0; i < 5; ++i)
-                {
-                    if (!(valid_edges2 & 1<<i))
-                        continue;
-                    int v0 = vertex_indices2[i][0];
-                    int v1 = vertex_indices2[i][1];
-                    double a0 = vertices[v0][0] - xi;
-                    double a1 = vertices[v1][0] - xi;
-                    if (a0 < 0.0)
-                    {
-                        if (a1 >= 0.0)
-                        {
-                            actions |= 2 << (i<<1);
-                            int vertex_idx = 8 + idx_offset;
-                            double t = a0 / (a0-a1);
-                            vertices[vertex_idx][0] = xi;
-                            vertices[vertex_idx][1] = vertices[v0][1] +
-                                t*(vertices[v1][1] - vertices[v0][1]);
-                            vertex_indices2[i][1] = vertex_idx;
-                            vertex_indices2[6][0] = vertex_idx;
-                            valid_edges2 |= 1 << 6;
-                            ++num_edges2;
-                        } else {
-                            actions |= 3 << (i<<1);
-                        }
-                    } else {
-                        if (a1 < 0.0)
-                        {
-                            actions |= 1 << (i<<1);
-                            int vertex_idx = 7 + idx_offset;
-                            double t = a0 / (a0-a1);
-                            vertices[vertex_idx][0] = xi;
-                            vertices[vertex_idx][1] = vertices[v0][1] +
-                                t*(vertices[v1][1] - vertices[v0][1]);
-                            vertex_indices2[i][0] = vertex_idx;
-                            vertex_indices2[6][1] = vertex_idx;
-                        } else {
-                            valid_edges2 &= ~(1 << i);
-                            --num_edges2;
-                        }
-                    }
-                }
-                if (num_edges2 <= 1)
-                {
-                    if (num_edges <= 1)
-                        break;
-                    double min_x_d = mag_x1;
-                    for (int i = 0; i < 5; ++i)
-                    {
-                        if (!(valid_edges & 1<<i))
-                            continue;
-                        for (int k = 0; k < 2; ++k)
-                        {
-                            double tmp_x = vertices[vertex_indices[i][k]][0];
-                            if (tmp_x < min_x_d)
-                                min_x_d = tmp_x;
-                        }
-                    }
-                    int min_x = (int)min_x_d - 1;
-                    if (x < min_x)
-                        x = min_x;
-                    continue;
-                }
-                if (num_edges2 >= 3 && x >= 0)
+extern void
+ll_lens_tree_error(const struct ll_magpat_params *params,
+                   const struct ll_rect *rect, int xrays, int yrays,
+                   double *max_error, double *mean_error)
+{
+    struct ll_magpat_params direct = *params;
+    direct.tree = 0;
+    double width_per_xrays = rect->width / xrays;
+    double height_per_yrays = rect->height / yrays;
+    double max = 0.0, sum = 0.0;
+    for (int j = 0; j < yrays; ++j)
+        for (int i = 0; i < xrays; ++i)
+        {
+            double x = rect->x + (i + 0.5)*width_per_xrays;
+            double y = rect->y + (j + 0.5)*height_per_yrays;
+            double tree_x, tree_y, direct_x, direct_y;
+            ll_shoot_single_ray(params, x, y, &tree_x, &tree_y);
+            ll_shoot_single_ray(&direct, x, y, &direct_x, &direct_y);
+            double dx = tree_x - direct_x;
+            double dy = tree_y - direct_y;
+            double error = sqrt(dx*dx + dy*dy);
+            if (error > max)
+                max = error;
+            sum += error;
+        }
+    *max_error = max;
+    *mean_error = sum / (xrays * yrays);
+}
+
+// Hit buffers
+//
+// In parallel runs, all threads shoot into the same magnification
+// pattern.  Instead of writing to the pattern directly, the kernels
+// collect the pixels they hit in a fixed-size per-thread buffer.
+// Repeated hits of the same pixel are combined in a small
+// direct-mapped cache in front of the buffer.  A slot is empty if its
+// index doesn't map to the slot itself (see _ll_empty_slot_index), so
+// every 32-bit pixel index can be cached.  A full buffer is sorted
+// into bands of 2^band_shift consecutive pixels, and each band is
+// added to the pattern while holding the band's lock.
+// The memory needed thus doesn't depend on the number of threads or
+// the pattern size.
+//
+// The shared pattern may also be a window of num_pixels pixels
+// starting at pixel first_index of the full pattern, in which case the
+// hits outside the window are dropped when flushing the buffer.  The
+// buffer records the range of pixel rows the kernels might have hit
+// (see _ll_track_rows).
+
+#define LL_HIT_BUFFER_SIZE 16384
+#define LL_HIT_CACHE_BITS 14
+
+struct _ll_shared_magpat
+{
+    void *magpat;
+    bool is_float;
+    unsigned band_shift, num_bands;
+    pthread_mutex_t *locks;
+    unsigned first_index;
+    uint64_t num_pixels;
+};
+
+struct _ll_hit
+{
+    uint32_t index;
+    union
+    {
+        uint32_t rays;
+        float area;
+    } value;
+};
+
+struct _ll_hit_buffer
+{
+    struct _ll_shared_magpat *shared;
+    unsigned count, first_band;
+    unsigned *band_start;
+    double min_y, max_y;
+    bool prune;
+    struct _ll_hit cache[1 << LL_HIT_CACHE_BITS];
+    struct _ll_hit hit[LL_HIT_BUFFER_SIZE];
+    struct _ll_hit sorted[LL_HIT_BUFFER_SIZE];
+};
+
+static void
+_ll_flush_hit_buffer(struct _ll_hit_buffer *buffer)
+{
+    const struct _ll_shared_magpat *shared = buffer->shared;
+    unsigned num_bands = shared->num_bands;
+    unsigned *start = buffer->band_start;
+    unsigned count = 0;
+    for (unsigned k = 0; k < buffer->count; ++k)
+    {
+        // Indices below the window wrap around and are dropped, too.
+        uint32_t index = buffer->hit[k].index - shared->first_index;
+        if (index < shared->num_pixels)
+        {
+            buffer->hit[count] = buffer->hit[k];
+            buffer->hit[count++].index = index;
+        }
+    }
+    buffer->count = count;
+    for (unsigned b = 0; b <= num_bands; ++b)
+        start[b] = 0;
+    for (unsigned k = 0; k < buffer->count; ++k)
+        ++start[(buffer->hit[k].index >> shared->band_shift) + 1];
+    for (unsigned b = 0; b < num_bands; ++b)
+        start[b+1] += start[b];
+    for (unsigned k = 0; k < buffer->count; ++k)
+        buffer->sorted[start[buffer->hit[k].index >> shared->band_shift]++] =
+            buffer->hit[k];
+    // Now start[b] is the end of band b.  Each thread starts with a
+    // different band to reduce lock contention.
+    const struct _ll_hit *hit = buffer->sorted;
+    for (unsigned c = 0; c < num_bands; ++c)
+    {
+        unsigned b = (buffer->first_band + c) % num_bands;
+        unsigned begin = b ? start[b-1] : 0;
+        if (begin == start[b])
+            continue;
+        pthread_mutex_lock(shared->locks + b);
+        if (shared->is_float)
+        {
+            float *magpat = shared->magpat;
+            for (unsigned n = begin; n < start[b]; ++n)
+                magpat[hit[n].index] += hit[n].value.area;
+        }
+        else
+        {
+            uint32_t *magpat = shared->magpat;
+            for (unsigned n = begin; n < start[b]; ++n)
+                magpat[hit[n].index] += hit[n].value.rays;
+        }
+        pthread_mutex_unlock(shared->locks + b);
+    }
+    buffer->count = 0;
+}
+
+static inline void
+_ll_push_hit(struct _ll_hit_buffer *buffer, const struct _ll_hit *hit)
+{
+    if (buffer->count == LL_HIT_BUFFER_SIZE)
+        _ll_flush_hit_buffer(buffer);
+    buffer->hit[buffer->count++] = *hit;
+}
+
+static inline uint32_t
+_ll_cache_slot(uint32_t index)
+{
+    return index * 2654435761u >> (32 - LL_HIT_CACHE_BITS);
+}
+
+// Return an index marking the cache slot as empty.  Index 0 maps to
+// slot 0 and index 1 doesn't.
+static uint32_t
+_ll_empty_slot_index(uint32_t slot)
+{
+    return slot == 0;
+}
+
+static inline struct _ll_hit *
+_ll_cached_hit(struct _ll_hit_buffer *buffer, unsigned index, bool *found)
+{
+    uint32_t slot = _ll_cache_slot(index);
+    struct _ll_hit *hit = buffer->cache + slot;
+    *found = hit->index == index;
+    if (!*found)
+    {
+        if (_ll_cache_slot(hit->index) == slot)
+            _ll_push_hit(buffer, hit);
+        hit->index = index;
+    }
+    return hit;
+}
+
+// Add a ray to pixel index of the pattern, or to the buffer if given.
+static inline void
+_ll_add_ray(uint32_t *magpat, struct _ll_hit_buffer *buffer, unsigned index)
+{
+    if (!buffer)
+    {
+        ++magpat[index];
+        return;
+    }
+    bool found;
+    struct _ll_hit *hit = _ll_cached_hit(buffer, index, &found);
+    hit->value.rays = found ? hit->value.rays + 1 : 1;
+}
+
+// Add area to pixel index of the pattern, or to the buffer if given.
+static inline void
+_ll_add_area(float *magpat, struct _ll_hit_buffer *buffer, unsigned index,
+             double area)
+{
+    if (!buffer)
+    {
+        magpat[index] += area;
+        return;
+    }
+    bool found;
+    struct _ll_hit *hit = _ll_cached_hit(buffer, index, &found);
+    hit->value.area = found ? hit->value.area + area : area;
+}
+
+// Move the cached hits to the buffer and add it to the pattern.
+static void
+_ll_drain_hit_buffer(struct _ll_hit_buffer *buffer)
+{
+    for (unsigned k = 0; k < 1 << LL_HIT_CACHE_BITS; ++k)
+        if (_ll_cache_slot(buffer->cache[k].index) == k)
+        {
+            _ll_push_hit(buffer, buffer->cache + k);
+            buffer->cache[k].index = _ll_empty_slot_index(k);
+        }
+    _ll_flush_hit_buffer(buffer);
+}
+
+// Record that the kernels might hit the pixel rows from min_y to max_y.
+static inline void
+_ll_track_rows(struct _ll_hit_buffer *buffer, double min_y, double max_y)
+{
+    if (min_y < buffer->min_y)
+        buffer->min_y = min_y;
+    if (max_y > buffer->max_y)
+        buffer->max_y = max_y;
+}
+
+static void
+_ll_rayshoot_rect(const struct ll_magpat_params *params,
+                  enum ll_precision precision, uint32_t *magpat,
+                  struct _ll_hit_buffer *buffer,
+                  const struct ll_rect *rect, int xrays, int yrays)
+{
+    double width_per_xrays = rect->width / xrays;
+    double height_per_yrays = rect->height / yrays;
+    double *mag_x = malloc(xrays * sizeof(double));
+    double *mag_y = malloc(xrays * sizeof(double));
+    int *hit = malloc(xrays * sizeof(int));
+    for (int j = 0; j < yrays; ++j)
+    {
+        _ll_shoot_ray_grid(params, precision, rect->x, rect->y,
+                           width_per_xrays, height_per_yrays,
+                           0, xrays - 1, j, j, mag_x, mag_y, hit);
+        for (int i = 0; i < xrays; ++i)
+            if (hit[i] == 0x0F)
+            {
+                if (buffer)
+                    _ll_track_rows(buffer, mag_y[i], mag_y[i]);
+                _ll_add_ray(magpat, buffer,
+                            (int)mag_y[i]*params->xpixels + (int)mag_x[i]);
+            }
+    }
+    free(hit);
+    free(mag_y);
+    free(mag_x);
+}
+
+extern void
+ll_rayshoot_rect(const struct ll_magpat_params *params, uint32_t *magpat,
+                 const struct ll_rect *rect, int xrays, int yrays)
+{
+    _ll_rayshoot_rect(params, LL_PRECISION_DOUBLE, magpat, 0,
+                      rect, xrays, yrays);
+}
+
+static void __attribute__ ((hot))
+_ll_rayshoot_bilinear(const struct ll_magpat_params *params, uint32_t *magpat,
+                      struct _ll_hit_buffer *buffer,
+                      double coords[4][2], bool hit_all, int refine)
+{
+    double inv_refine = 1.0/refine;
+    double ldown_x = (coords[2][0] - coords[0][0]) * inv_refine;
+    double ldown_y = (coords[2][1] - coords[0][1]) * inv_refine;
+    double rdown_x = (coords[3][0] - coords[1][0]) * inv_refine;
+    double rdown_y = (coords[3][1] - coords[1][1]) * inv_refine;
+    double right_x = (coords[1][0] - coords[0][0]) * inv_refine;
+    double right_y = (coords[1][1] - coords[0][1]) * inv_refine;
+    double update_x = (rdown_x - ldown_x) * inv_refine;
+    double update_y = (rdown_y - ldown_y) * inv_refine;
+    double sx = coords[0][0];
+    double sy = coords[0][1];
+    if (hit_all)
+        for (int j = 0; j < refine; ++j)
+        {
+            double x = sx;
+            double y = sy;
+            for (int i = 0; i < refine; ++i)
+            {
+                _ll_add_ray(magpat, buffer, (int)y*params->xpixels + (int)x);
+                x += right_x;
+                y += right_y;
+            }
+            sx += ldown_x;
+            sy += ldown_y;
+            right_x += update_x;
+            right_y += update_y;
+        }
+    else
+        for (int j = 0; j < refine; ++j)
+        {
+            double x = sx;
+            double y = sy;
+            int i = 0;
+            while ((x < 0.0 || x >= params->xpixels ||
+                    y < 0.0 || y >= params->ypixels) &&
+                   i < refine)
+            {
+                x += right_x;
+                y += right_y;
+                ++i;
+            }
+            while (i < refine &&
+                   x >= 0.0 && x < params->xpixels &&
+                   y >= 0.0 && y < params->ypixels)
+            {
+                _ll_add_ray(magpat, buffer, (int)y*params->xpixels + (int)x);
+                x += right_x;
+                y += right_y;
+                ++i;
+            }
+            sx += ldown_x;
+            sy += ldown_y;
+            right_x += update_x;
+            right_y += update_y;
+        }
+}
+
+static void __attribute__ ((hot))
+_ll_rayshoot_triangulated(const struct ll_magpat_params *params,
+                          float *magpat, struct _ll_hit_buffer *buffer,
+                          double rect_area,
+                          double tri_vertices[4][2], int max_area)
+{
+    double pixel_area = 0.5 * rect_area *
+        params->pixels_per_width * params->pixels_per_height;
+    for (int triangle = 0; triangle < 2; ++triangle)
+    {
+        if (triangle)
+        {
+            tri_vertices[0][0] = tri_vertices[3][0];
+            tri_vertices[0][1] = tri_vertices[3][1];
+        }
+
+        double tri_area = ((tri_vertices[1][0]-tri_vertices[0][0]) *
+                           (tri_vertices[2][1]-tri_vertices[0][1]) -
+                           (tri_vertices[1][1]-tri_vertices[0][1]) *
+                           (tri_vertices[2][0]-tri_vertices[0][0]));
+        if (fabs(tri_area) > 1e-4*max_area*params->xpixels*params->ypixels)
+            continue;
+        double magnification =  pixel_area / tri_area;
+
+        // Get minimum and maximum x coordinate in the magpattern
+        bool single_pixel_optimization = true;
+        int min = 0, max = 0;
+        if (tri_vertices[1][0] < tri_vertices[0][0])
+            min = 1;
+        else
+            max = 1;
+        if (tri_vertices[2][0] < tri_vertices[min][0])
+            min = 2;
+        if (tri_vertices[2][0] > tri_vertices[max][0])
+            max = 2;
+        if (tri_vertices[min][0] >= params->xpixels)
+            continue;
+        if (tri_vertices[max][0] < 0.0)
+            continue;
+        int mag_x0;
+        if (tri_vertices[min][0] < 0.0)
+        {
+            mag_x0 = -1;
+            single_pixel_optimization = false;
+        }
+        else
+            mag_x0 = tri_vertices[min][0];
+        int mag_x1;
+        if (tri_vertices[max][0] >= params->xpixels)
+        {
+            mag_x1 = params->xpixels - 1;
+            single_pixel_optimization = false;
+        }
+        else
+            mag_x1 = tri_vertices[max][0];
+
+        // Get minimum and maximum y coordinate in the magpattern
+        min = 0, max = 0;
+        if (tri_vertices[1][1] < tri_vertices[0][1])
+            min = 1;
+        else
+            max = 1;
+        if (tri_vertices[2][1] < tri_vertices[min][1])
+            min = 2;
+        if (tri_vertices[2][1] > tri_vertices[max][1])
+            max = 2;
+        if (tri_vertices[min][1] >= params->ypixels)
+            continue;
+        if (tri_vertices[max][1] < 0.0)
+            continue;
+        int mag_y0;
+        if (tri_vertices[min][1] < 0.0)
+        {
+            mag_y0 = 0;
+            single_pixel_optimization = false;
+        }
+        else
+            mag_y0 = tri_vertices[min][1];
+        int mag_y1;
+        if (tri_vertices[max][1] >= params->ypixels)
+        {
+            mag_y1 = params->ypixels - 1;
+            single_pixel_optimization = false;
+        }
+        else
+            mag_y1 = tri_vertices[max][1];
+
+        // Render the triangle
+        if (single_pixel_optimization && mag_x0 == mag_x1 && mag_y0 == mag_y1)
+        {
+            // The triangle is completely contained in a single pixel,
+            // so we can take a shortcut
+            _ll_add_area(magpat, buffer, mag_y0*params->xpixels + mag_x0,
+                         pixel_area);
+            continue;
+        }
+        double vertices[11][2];
+        for (int k = 0; k < 3; ++k)
+        {
+            vertices[k][0] = tri_vertices[k][0];
+            vertices[k][1] = tri_vertices[k][1];
+        }
+        for (int y = mag_y0; y <= mag_y1; ++y)
+        {
+            int vertex_indices[5][2];
+            vertex_indices[0][0] = 2; vertex_indices[0][1] = 0;
+            vertex_indices[1][0] = 0; vertex_indices[1][1] = 1;
+            vertex_indices[2][0] = 1; vertex_indices[2][1] = 2;
+            int valid_edges = 0x07;
+            int num_edges = 3;
+
+            for (int k = 0; k < 2; ++k)
+            {
+                double yi = y + k;
+                int edge_idx = 3 + k;
+                int vertex_idx = 3 + 2*k;
+                double sgn = 1.0;
+                if (k)
+                    sgn = -1.0;
+                for (int v0 = 2, v1 = 0; v1 < 3; v0 = v1, ++v1)
+                {
+                    double a0 = sgn * (yi - vertices[v0][1]);
+                    double a1 = sgn * (yi - vertices[v1][1]);
+                    if (a0 < 0.0)
+                    {
+                        if (a1 >= 0.0)
+                        {
+                            double t = a0 / (a0-a1);
+                            vertices[vertex_idx][0] = vertices[v0][0] +
+                                t*(vertices[v1][0] - vertices[v0][0]);
+                            vertices[vertex_idx][1] = yi;
+                            vertex_indices[v1][1] = vertex_idx;
+                            vertex_indices[edge_idx][0] = vertex_idx;
+                            valid_edges |= 1 << edge_idx;
+                            ++num_edges;
+                        }
+                    } else {
+                        if (a1 < 0.0)
+                        {
+                            double t = a0 / (a0-a1);
+                            vertices[vertex_idx+1][0] = vertices[v0][0] +
+                                t*(vertices[v1][0] - vertices[v0][0]);
+                            vertices[vertex_idx+1][1] = yi;
+                            vertex_indices[v1][0] = vertex_idx+1;
+                            vertex_indices[edge_idx][1] = vertex_idx+1;
+                        } else {
+                            valid_edges &= ~(1 << v1);
+                            --num_edges;
+                        }
+                    }
+                }
+            }
+
+            int actions = 0;
+            for (int x = mag_x0; x <= mag_x1; ++x)
+            {
+                int vertex_indices2[7][2];
+                for (int i = 0; i < 5; ++i)
+                {
+                    vertex_indices2[i][0] = vertex_indices[i][0];
+                    vertex_indices2[i][1] = vertex_indices[i][1];
+                }
+                int valid_edges2 = valid_edges;
+                int num_edges2 = num_edges;
+
+                if (actions)
+                {
+                    int idx_offset = (x&1) << 1;
+                    for (int i = 0; i < 5; ++i)
+                    {
+                        switch (actions>>(i<<1) & 3)
+                        {
+                        case 1:
+                        {
+                            int vertex_idx = 7 + idx_offset;
+                            vertex_indices2[i][1] = vertex_idx;
+                            vertex_indices2[5][0] = vertex_idx;
+                            valid_edges2 |= 1 << 5;
+                            ++num_edges2;
+                            break;
+                        }
+                        case 2:
+                        {
+                            int vertex_idx = 8 + idx_offset;
+                            vertex_indices2[i][0] = vertex_idx;
+                            vertex_indices2[5][1] = vertex_idx;
+                            break;
+                        }
+                        case 3:
+                        {
+                            valid_edges2 &= ~(1 << i);
+                            --num_edges2;
+                            valid_edges &= ~(1 << i);
+                            --num_edges;
+                            break;
+                        }
+                        }
+                    }
+                }
+                double xi = x + 1;
+                int idx_offset = ((x&1) ^ 1) << 1;
+                actions = 0;
+                for(int i = 0; i < 5; ++i)
+                {
+                    if (!(valid_edges2 & 1<<i))
+                        continue;
+                    int v0 = vertex_indices2[i][0];
+                    int v1 = vertex_indices2[i][1];
+                    double a0 = vertices[v0][0] - xi;
+                    double a1 = vertices[v1][0] - xi;
+                    if (a0 < 0.0)
+                    {
+                        if (a1 >= 0.0)
+                        {
+                            actions |= 2 << (i<<1);
+                            int vertex_idx = 8 + idx_offset;
+                            double t = a0 / (a0-a1);
+                            vertices[vertex_idx][0] = xi;
+                            vertices[vertex_idx][1] = vertices[v0][1] +
+                                t*(vertices[v1][1] - vertices[v0][1]);
+                            vertex_indices2[i][1] = vertex_idx;
+                            vertex_indices2[6][0] = vertex_idx;
+                            valid_edges2 |= 1 << 6;
+                            ++num_edges2;
+                        } else {
+                            actions |= 3 << (i<<1);
+                        }
+                    } else {
+                        if (a1 < 0.0)
+                        {
+                            actions |= 1 << (i<<1);
+                            int vertex_idx = 7 + idx_offset;
+                            double t = a0 / (a0-a1);
+                            vertices[vertex_idx][0] = xi;
+                            vertices[vertex_idx][1] = vertices[v0][1] +
+                                t*(vertices[v1][1] - vertices[v0][1]);
+                            vertex_indices2[i][0] = vertex_idx;
+                            vertex_indices2[6][1] = vertex_idx;
+                        } else {
+                            valid_edges2 &= ~(1 << i);
+                            --num_edges2;
+                        }
+                    }
+                }
+                if (num_edges2 <= 1)
+                {
+                    if (num_edges <= 1)
+                        break;
+                    double min_x_d = mag_x1;
+                    for (int i = 0; i < 5; ++i)
+                    {
+                        if (!(valid_edges & 1<<i))
+                            continue;
+                        for (int k = 0; k < 2; ++k)
+                        {
+                            double tmp_x = vertices[vertex_indices[i][k]][0];
+                            if (tmp_x < min_x_d)
+                                min_x_d = tmp_x;
+                        }
+                    }
+                    int min_x = (int)min_x_d - 1;
+                    if (x < min_x)
+                        x = min_x;
+                    continue;
+                }
+                if (num_edges2 >= 3 && x >= 0)
+                {
+                    double area = 0.0;
+                    double x0 = vertices[0][0];
+                    double y0 = vertices[0][1];
+                    for(int i = 0; i < 7; ++i)
+                        if (valid_edges2 & 1<<i)
+                        {
+                            int i0 = vertex_indices2[i][0];
+                            int i1 = vertex_indices2[i][1];
+                            area += (vertices[i0][0]-x0) * (vertices[i1][1]-y0)
+                                - (vertices[i0][1]-y0) * (vertices[i1][0]-x0);
+                        }
+                    _ll_add_area(magpat, buffer, y*params->xpixels + x,
+                                 area * magnification);
+                }
+            }
+        }
+    }
+}
+
+// Scanline rasteriser for triangles
+//
+// The triangulated_scanline kernel computes the same pixel coverages as
+// _ll_rayshoot_triangulated(), but instead of clipping the triangle
+// against each pixel, it integrates along the edges row by row.  The
+// area of a polygon inside pixel x of a row is the sum over the parts
+// of its edges inside the row of the integral of
+// dy * clamp(x + 1 - x_edge(y), 0, 1), up to the sign given by the
+// orientation.  These integrals are added up in an accumulation
+// buffer of xpixels+1 doubles, such that the prefix sums of the buffer
+// are the covered areas of the pixels of the row.
+
+// Add the integrals for the edge part from (x0, y0) to (x1, y1) inside
+// a row to acc, and extend the range [*first, *last] of the entries
+// whose prefix sums might be nonzero accordingly.  Parts left of the
+// pattern count as if they were on its left border, and parts right
+// of the pattern don't count, so the sums then extend up to its right
+// border.
+static void
+_ll_accumulate_edge(double *acc, int xpixels, double x0, double x1,
+                    double dy, int *first, int *last)
+{
+    if (x1 < x0)
+    {
+        double tmp = x0;
+        x0 = x1;
+        x1 = tmp;
+    }
+    if (x1 >= xpixels)
+        *last = xpixels;
+    if (x0 >= xpixels)
+        return;
+    if (x0 < 0.0)
+    {
+        double dy_left = x1 <= 0.0 ? dy : dy * -x0 / (x1 - x0);
+        acc[0] += dy_left;
+        *first = 0;
+        if (*last < 0)
+            *last = 0;
+        if (x1 <= 0.0)
+            return;
+        dy -= dy_left;
+        x0 = 0.0;
+    }
+    if (x1 > xpixels)
+    {
+        dy -= dy * (x1 - xpixels) / (x1 - x0);
+        x1 = xpixels;
+    }
+    int c0 = x0;
+    int c1 = x1 < xpixels ? (int)x1 : xpixels - 1;
+    if (c0 < *first)
+        *first = c0;
+    if (c1 + 1 > *last)
+        *last = c1 + 1;
+    if (c0 == c1)
+    {
+        double xm = 0.5 * (x0 + x1);
+        acc[c0] += dy * (c0 + 1 - xm);
+        acc[c0+1] += dy * (xm - c0);
+        return;
+    }
+    double dy_per_x = dy / (x1 - x0);
+    double xl = x0;
+    for (int c = c0; c <= c1; ++c)
+    {
+        double xr = c + 1 < x1 ? c + 1 : x1;
+        double dy_part = dy_per_x * (xr - xl);
+        double xm = 0.5 * (xl + xr);
+        acc[c] += dy_part * (c + 1 - xm);
+        acc[c+1] += dy_part * (xm - c);
+        xl = xr;
+    }
+}
+
+static void __attribute__ ((hot))
+_ll_rayshoot_triangulated_scanline(const struct ll_magpat_params *params,
+                                   float *magpat,
+                                   struct _ll_hit_buffer *buffer,
+                                   double rect_area,
+                                   double tri_vertices[4][2], int max_area,
+                                   double *acc)
+{
+    int xpixels = params->xpixels;
+    int ypixels = params->ypixels;
+    double pixel_area = 0.5 * rect_area *
+        params->pixels_per_width * params->pixels_per_height;
+    for (int triangle = 0; triangle < 2; ++triangle)
+    {
+        // The second triangle has the vertices 3, 1 and 2.
+        double (*v)[2] = tri_vertices;
+        if (triangle)
+        {
+            v[0][0] = v[3][0];
+            v[0][1] = v[3][1];
+        }
+        double tri_area = ((v[1][0]-v[0][0]) * (v[2][1]-v[0][1]) -
+                           (v[1][1]-v[0][1]) * (v[2][0]-v[0][0]));
+        if (tri_area == 0.0 ||
+            fabs(tri_area) > 1e-4*max_area*params->xpixels*params->ypixels)
+            continue;
+        double min_x = fmin(fmin(v[0][0], v[1][0]), v[2][0]);
+        double max_x = fmax(fmax(v[0][0], v[1][0]), v[2][0]);
+        double min_y = fmin(fmin(v[0][1], v[1][1]), v[2][1]);
+        double max_y = fmax(fmax(v[0][1], v[1][1]), v[2][1]);
+        if (min_x >= xpixels || max_x < 0.0 ||
+            min_y >= ypixels || max_y < 0.0)
+            continue;
+        // The accumulated integrals are the areas with the opposite
+        // sign of tri_area, which is twice the area of the triangle.
+        double magnification = -2.0 * pixel_area / tri_area;
+        int y0 = min_y < 0.0 ? 0 : (int)min_y;
+        int y1 = max_y >= ypixels ? ypixels - 1 : (int)max_y;
+        for (int y = y0; y <= y1; ++y)
+        {
+            int first = xpixels, last = -1;
+            for (int k0 = 2, k1 = 0; k1 < 3; k0 = k1++)
+            {
+                double ya = v[k0][1], yb = v[k1][1];
+                if (ya == yb || fmax(ya, yb) <= y || fmin(ya, yb) >= y + 1)
+                    continue;
+                double dx_per_y = (v[k1][0] - v[k0][0]) / (yb - ya);
+                double ya_row = fmin(fmax(ya, y), y + 1);
+                double yb_row = fmin(fmax(yb, y), y + 1);
+                _ll_accumulate_edge(acc, xpixels,
+                                    v[k0][0] + (ya_row - ya) * dx_per_y,
+                                    v[k0][0] + (yb_row - ya) * dx_per_y,
+                                    yb_row - ya_row, &first, &last);
+            }
+            double area = 0.0;
+            for (int x = first; x <= last; ++x)
+            {
+                area += acc[x];
+                acc[x] = 0.0;
+                if (x < xpixels && area != 0.0)
+                    _ll_add_area(magpat, buffer, y*xpixels + x,
+                                 area * magnification);
+            }
+        }
+    }
+}
+
+// Adaptive kernel
+//
+// The adaptive kernel rasterises the cells of the level-1 ray grid like
+// the triangulated_scanline kernel, but first splits cells into four by
+// shooting five more rays if their mapping to the source plane is
+// folded or far from affine, up to depth times.  The deviation from an
+// affine mapping is the distance of the corner 3 from the corner of
+// the parallelogram spanned by the other corners, which is compared to
+// rs->tolerance in pixels.  Cells are split even if their corners miss
+// the pattern, since cells around a lens can hit it anyway.  The
+// rasterised cells are tracked and pruned like the cells of the other
+// interpolating kernels.
+static void
+_ll_rayshoot_adaptive(const struct ll_rayshooter *rs,
+                      const struct ll_magpat_params *params, float *magpat,
+                      struct _ll_hit_buffer *buffer,
+                      double x, double y, double width, double height,
+                      double coords[4][2], int depth, double *acc)
+{
+    double min_x = fmin(fmin(coords[0][0], coords[1][0]),
+                        fmin(coords[2][0], coords[3][0]));
+    double max_x = fmax(fmax(coords[0][0], coords[1][0]),
+                        fmax(coords[2][0], coords[3][0]));
+    double min_y = fmin(fmin(coords[0][1], coords[1][1]),
+                        fmin(coords[2][1], coords[3][1]));
+    double max_y = fmax(fmax(coords[0][1], coords[1][1]),
+                        fmax(coords[2][1], coords[3][1]));
+    double dx = coords[0][0] + coords[3][0] - coords[1][0] - coords[2][0];
+    double dy = coords[0][1] + coords[3][1] - coords[1][1] - coords[2][1];
+    double area0 = ((coords[1][0]-coords[0][0]) * (coords[2][1]-coords[0][1]) -
+                    (coords[1][1]-coords[0][1]) * (coords[2][0]-coords[0][0]));
+    double area3 = ((coords[1][0]-coords[3][0]) * (coords[2][1]-coords[3][1]) -
+                    (coords[1][1]-coords[3][1]) * (coords[2][0]-coords[3][0]));
+    // The image of an unfolded cell lies within its bounding box grown
+    // by the deviation, so cells further away from the pattern are
+    // skipped.  The triangles have opposite orientations unless the cell
+    // is folded.
+    bool folded = area0*area3 >= 0.0;
+    double deviation = sqrt(dx*dx + dy*dy);
+    if (!folded && (max_x + deviation < 0.0 ||
+                    min_x - deviation >= params->xpixels ||
+                    max_y + deviation < 0.0 ||
+                    min_y - deviation >= params->ypixels))
+        return;
+    if (depth > 0 && (deviation > rs->tolerance || folded))
+    {
+        double half_width = 0.5 * width;
+        double half_height = 0.5 * height;
+        double ray_x[5] = {x + half_width, x, x + half_width,
+                           x + width, x + half_width};
+        double ray_y[5] = {y, y + half_height, y + half_height,
+                           y + half_height, y + height};
+        double mag_x[5], mag_y[5];
+        int hit[5];
+        _ll_shoot_ray_block(params, 5, ray_x, ray_y, mag_x, mag_y, hit);
+        // The 3x3 grid of the corners of the four subcells
+        double grid[9][2] =
+            {{coords[0][0], coords[0][1]}, {mag_x[0], mag_y[0]},
+             {coords[1][0], coords[1][1]},
+             {mag_x[1], mag_y[1]}, {mag_x[2], mag_y[2]}, {mag_x[3], mag_y[3]},
+             {coords[2][0], coords[2][1]}, {mag_x[4], mag_y[4]},
+             {coords[3][0], coords[3][1]}};
+        for (int j = 0; j < 2; ++j)
+            for (int i = 0; i < 2; ++i)
+            {
+                int m = 3*j + i;
+                double subcoords[4][2] =
+                    {{grid[m][0], grid[m][1]}, {grid[m+1][0], grid[m+1][1]},
+                     {grid[m+3][0], grid[m+3][1]},
+                     {grid[m+4][0], grid[m+4][1]}};
+                _ll_rayshoot_adaptive(rs, params, magpat, buffer,
+                                      x + i*half_width, y + j*half_height,
+                                      half_width, half_height, subcoords,
+                                      depth - 1, acc);
+            }
+        return;
+    }
+    // The image of a cell that isn't split is the quadrilateral spanned
+    // by its corners.
+    if (max_x < 0.0 || min_x >= params->xpixels ||
+        max_y < 0.0 || min_y >= params->ypixels)
+        return;
+    if (buffer)
+    {
+        _ll_track_rows(buffer, min_y, max_y);
+        if (buffer->prune)
+        {
+            double first_row = buffer->shared->first_index / params->xpixels;
+            double end_row =
+                first_row + buffer->shared->num_pixels / params->xpixels;
+            if (max_y < first_row || min_y >= end_row)
+                return;
+        }
+    }
+    _ll_rayshoot_triangulated_scanline(params, magpat, buffer, width * height,
+                                       coords, rs->refine_kernel, acc);
+}
+
+// Source plane masks
+//
+// A mask restricts the shooting to the cells whose rays might hit one
+// of its pixels.  The images of the rays around a cell bound the image
+// of the cell, as long as the cell doesn't contain a lens or lie next
+// to one; rays passing close to a lens may end up anywhere.
+
+static void
+_ll_mark_lens_cells(const struct ll_lenses *lenses, double x0, double y0,
+                    double dx, double dy, int xcells, int ycells,
+                    uint8_t *near)
+{
+    for (unsigned k = 0; k < lenses->num_lenses; ++k)
+    {
+        double u = (lenses->lens[k].x - x0) / dx;
+        double v = (lenses->lens[k].y - y0) / dy;
+        if (u < -1.0 || u >= xcells + 1.0 || v < -1.0 || v >= ycells + 1.0)
+            continue;
+        int i = (int)floor(u), j = (int)floor(v);
+        for (int jj = j - 1; jj <= j + 1; ++jj)
+            for (int ii = i - 1; ii <= i + 1; ++ii)
+                if (0 <= ii && ii < xcells && 0 <= jj && jj < ycells)
+                    near[jj*xcells + ii] = 1;
+    }
+}
+
+// Return an array flagging the cells of the given grid that contain a
+// lens of params or are adjacent to one.  The caller frees it.
+static uint8_t *
+_ll_lens_cells(const struct ll_magpat_params *params, double x0, double y0,
+               double dx, double dy, int xcells, int ycells)
+{
+    uint8_t *near = calloc(xcells*ycells, sizeof(uint8_t));
+    _ll_mark_lens_cells(&params->lenses, x0, y0, dx, dy, xcells, ycells,
+                        near);
+    if (params->static_field)
+        _ll_mark_lens_cells(&params->static_field->lenses, x0, y0, dx, dy,
+                            xcells, ycells, near);
+    return near;
+}
+
+// Return whether the box [x0, x1] x [y0, y1] of pixel coordinates
+// contains a pixel of the mask.  The rays inside a cell may bulge out
+// of the box spanned by the rays around it, so the box is widened by
+// half its size on each side.
+static bool
+_ll_mask_hit(const struct ll_magpat_params *params,
+             double x0, double x1, double y0, double y1)
+{
+    double wx = 0.5 * (x1 - x0), wy = 0.5 * (y1 - y0);
+    x0 -= wx;
+    x1 += wx;
+    y0 -= wy;
+    y1 += wy;
+    if (x1 < 0.0 || y1 < 0.0 || x0 >= params->xpixels ||
+        y0 >= params->ypixels)
+        return false;
+    unsigned i0 = x0 > 0.0 ? (unsigned)x0 : 0;
+    unsigned j0 = y0 > 0.0 ? (unsigned)y0 : 0;
+    unsigned i1 = x1 < params->xpixels ? (unsigned)x1 + 1 : params->xpixels;
+    unsigned j1 = y1 < params->ypixels ? (unsigned)y1 + 1 : params->ypixels;
+    unsigned stride = params->xpixels + 1;
+    const uint32_t *mask = params->mask;
+    return mask[j1*stride + i1] - mask[j1*stride + i0] -
+        mask[j0*stride + i1] + mask[j0*stride + i0] != 0;
+}
+
+// Apply the kernel to all cells of the (xrays+1)*(yrays+1) ray grid
+// spanning rect that are hit, given the deflected rays of the grid.
+// The interpolating kernels only shoot rays inside the quadrilateral
+// spanned by the corners of a cell, so the pixel rows they might hit
+// are tracked in the buffer, and a pruning buffer skips the cells
+// outside its window.  With a mask, the cells that can't hit it are
+// skipped as well.
+static void
+_ll_rayshoot_kernels(const struct ll_rayshooter *rs,
+                     const struct ll_magpat_params *params, void *magpat,
+                     struct _ll_hit_buffer *buffer,
+                     const struct ll_rect *rect, int xrays, int yrays,
+                     const double *mag_x, const double *mag_y, const int *hit)
+{
+    double width_per_xrays = rect->width / xrays;
+    double height_per_yrays = rect->height / yrays;
+    int xrays1 = xrays + 1;
+    double rect_area = width_per_xrays * height_per_yrays;
+    double *acc = 0;
+    if (rs->kernel == LL_KERNEL_TRIANGULATED_SCANLINE ||
+        rs->kernel == LL_KERNEL_ADAPTIVE)
+        acc = calloc(params->xpixels + 1, sizeof(double));
+    int depth = 0;
+    while (2 << depth <= rs->refine_kernel)
+        ++depth;
+    // The adaptive kernel tracks and prunes its subcells itself.
+    bool track = buffer && rs->kernel != LL_KERNEL_SIMPLE &&
+        rs->kernel != LL_KERNEL_ADAPTIVE;
+    double first_row = 0.0, end_row = 0.0;
+    if (track)
+    {
+        first_row = buffer->shared->first_index / params->xpixels;
+        end_row = first_row + buffer->shared->num_pixels / params->xpixels;
+    }
+    // The adaptive kernel decides itself which cells might hit the
+    // pattern, since the corners of a cell around a lens can miss it.
+    bool test_hit = rs->kernel != LL_KERNEL_ADAPTIVE;
+    uint8_t *near = 0;
+    if (params->mask)
+        near = _ll_lens_cells(params, rect->x, rect->y, width_per_xrays,
+                              height_per_yrays, xrays, yrays);
+    for (int j = 0, m = 0; j < yrays; ++j, ++m)
+        for (int i = 0; i < xrays; ++i, ++m)
+            if (!test_hit ||
+                (hit[m] | hit[m+1] | hit[m+xrays+1] | hit[m+xrays+2]) == 0x0F)
+            {
+                if (near && !near[j*xrays + i] &&
+                    !_ll_mask_hit(params,
+                                  fmin(fmin(mag_x[m], mag_x[m+1]),
+                                       fmin(mag_x[m+xrays1],
+                                            mag_x[m+xrays1+1])),
+                                  fmax(fmax(mag_x[m], mag_x[m+1]),
+                                       fmax(mag_x[m+xrays1],
+                                            mag_x[m+xrays1+1])),
+                                  fmin(fmin(mag_y[m], mag_y[m+1]),
+                                       fmin(mag_y[m+xrays1],
+                                            mag_y[m+xrays1+1])),
+                                  fmax(fmax(mag_y[m], mag_y[m+1]),
+                                       fmax(mag_y[m+xrays1],
+                                            mag_y[m+xrays1+1]))))
+                    continue;
+                if (track)
+                {
+                    double min_y = fmin(fmin(mag_y[m], mag_y[m+1]),
+                                        fmin(mag_y[m+xrays1],
+                                             mag_y[m+xrays1+1]));
+                    double max_y = fmax(fmax(mag_y[m], mag_y[m+1]),
+                                        fmax(mag_y[m+xrays1],
+                                             mag_y[m+xrays1+1]));
+                    _ll_track_rows(buffer, min_y, max_y);
+                    if (buffer->prune &&
+                        (max_y < first_row || min_y >= end_row))
+                        continue;
+                }
+                double local_coords[4][2] =
+                    {{mag_x[m], mag_y[m]},
+                     {mag_x[m+1], mag_y[m+1]},
+                     {mag_x[m+xrays1], mag_y[m+xrays1]},
+                     {mag_x[m+xrays1+1], mag_y[m+xrays1+1]}};
+                switch (rs->kernel)
+                {
+                case LL_KERNEL_SIMPLE:
+                {
+                    double x = rect->x + i*width_per_xrays;
+                    double y = rect->y + j*height_per_yrays;
+                    struct ll_rect subrect
+                        = {x, y, width_per_xrays, height_per_yrays};
+                    _ll_rayshoot_rect(params, rs->precision, magpat, buffer,
+                                      &subrect,
+                                      rs->refine_kernel, rs->refine_kernel);
+                    break;
+                }
+                case LL_KERNEL_BILINEAR:
+                {
+                    bool hit_all = (hit[m] & hit[m+1] & hit[m+xrays+1] &
+                                    hit[m+xrays+2]) == 0x0F;
+                    _ll_rayshoot_bilinear(params, magpat, buffer,
+                                          local_coords, hit_all,
+                                          rs->refine_kernel);
+                    break;
+                }
+                case LL_KERNEL_TRIANGULATED:
+                    _ll_rayshoot_triangulated(params, magpat, buffer,
+                                              rect_area,
+                                              local_coords, rs->refine_kernel);
+                    break;
+                case LL_KERNEL_TRIANGULATED_SCANLINE:
+                    _ll_rayshoot_triangulated_scanline(
+                        params, magpat, buffer, rect_area, local_coords,
+                        rs->refine_kernel, acc);
+                    break;
+                case LL_KERNEL_ADAPTIVE:
+                    _ll_rayshoot_adaptive(
+                        rs, params, magpat, buffer,
+                        rect->x + i*width_per_xrays,
+                        rect->y + j*height_per_yrays,
+                        width_per_xrays, height_per_yrays,
+                        local_coords, depth, acc);
+                    break;
+                }
+            }
+    free(near);
+    free(acc);
+}
+
+static void
+_ll_rayshoot_level1(const struct ll_rayshooter *rs,
+                    const struct ll_magpat_params *params, void *magpat,
+                    struct _ll_hit_buffer *buffer,
+                    const struct ll_rect *rect, int xrays, int yrays)
+{
+    double *mag_x = malloc((xrays+1)*(yrays+1) * sizeof(double));
+    double *mag_y = malloc((xrays+1)*(yrays+1) * sizeof(double));
+    int *hit = malloc((xrays+1)*(yrays+1) * sizeof(int));
+    _ll_shoot_ray_grid(params, rs->precision, rect->x, rect->y,
+                       rect->width / xrays, rect->height / yrays,
+                       0, xrays, 0, yrays, mag_x, mag_y, hit);
+    _ll_rayshoot_kernels(rs, params, magpat, buffer, rect, xrays, yrays,
+                         mag_x, mag_y, hit);
+    free(hit);
+    free(mag_y);
+    free(mag_x);
+}
+
+static void
+_ll_rayshoot_subpatches(const struct ll_rayshooter *rs,
+                        const struct ll_magpat_params *params, void *magpat,
+                        struct _ll_hit_buffer *buffer,
+                        const struct ll_patches *patches, double *progress);
+
+// Large patch grids are split into blocks of at most
+// LL_FAR_FIELD_BLOCK x LL_FAR_FIELD_BLOCK subpatches, so each block can
+// use its own far field expansion when determining the hit subpatches.
+#define LL_FAR_FIELD_BLOCK 64
+
+static void
+_ll_get_subpatches_blocked(const struct ll_rayshooter *rs,
+                           const struct ll_magpat_params *params,
+                           struct ll_patches *patches)
+{
+    uint8_t *block_hit = malloc(LL_FAR_FIELD_BLOCK*LL_FAR_FIELD_BLOCK *
+                                sizeof(uint8_t));
+    patches->num_patches = 0;
+    for (int j0 = 0; j0 < patches->yrays; j0 += LL_FAR_FIELD_BLOCK)
+        for (int i0 = 0; i0 < patches->xrays; i0 += LL_FAR_FIELD_BLOCK)
+        {
+            int bx = patches->xrays - i0;
+            int by = patches->yrays - j0;
+            if (bx > LL_FAR_FIELD_BLOCK)
+                bx = LL_FAR_FIELD_BLOCK;
+            if (by > LL_FAR_FIELD_BLOCK)
+                by = LL_FAR_FIELD_BLOCK;
+            struct ll_patches block =
+                {{patches->rect.x + i0*patches->width_per_xrays,
+                  patches->rect.y + j0*patches->height_per_yrays,
+                  bx*patches->width_per_xrays, by*patches->height_per_yrays},
+                 bx, by, patches->level,
+                 patches->width_per_xrays, patches->height_per_yrays,
+                 block_hit, 0};
+            struct ll_magpat_params local_params;
+            struct ll_far_field far_field;
+            if (_ll_split_far_field(rs, params, &block.rect, bx, by,
+                                    &local_params, &far_field))
+            {
+                ll_get_subpatches(&local_params, &block);
+                free(local_params.lenses.lens);
+            }
+            else
+                ll_get_subpatches(params, &block);
+            for (int j = 0; j < by; ++j)
+                for (int i = 0; i < bx; ++i)
+                    patches->hit[(j0+j)*patches->xrays + i0+i] =
+                        block_hit[j*bx + i];
+            patches->num_patches += block.num_patches;
+        }
+    free(block_hit);
+}
+
+static void
+_ll_rayshoot_recursively(const struct ll_rayshooter *rs,
+                         const struct ll_magpat_params *parent, void *magpat,
+                         struct _ll_hit_buffer *buffer,
+                         const struct ll_rect *rect, int xrays, int yrays,
+                         unsigned level, double *progress)
+{
+    if (rs->cancel)
+        return;
+    struct ll_magpat_params local_params;
+    struct ll_far_field far_field;
+    const struct ll_magpat_params *params = parent;
+    if (_ll_split_far_field(rs, parent, rect, xrays, yrays,
+                            &local_params, &far_field))
+        params = &local_params;
+    if (level > 1)
+    {
+        struct ll_patches patches =
+            { *rect, xrays, yrays, level, rect->width/xrays, rect->height/yrays,
+              .hit = malloc(xrays*yrays * sizeof(uint8_t)), .num_patches = 0};
+        if (rs->far_field_angle > 0.0 &&
+            (xrays > LL_FAR_FIELD_BLOCK || yrays > LL_FAR_FIELD_BLOCK))
+            _ll_get_subpatches_blocked(rs, params, &patches);
+        else
+            ll_get_subpatches(params, &patches);
+        _ll_rayshoot_subpatches(rs, params, magpat, buffer, &patches,
+                                progress);
+        free(patches.hit);
+    }
+    else
+        _ll_rayshoot_level1(rs, params, magpat, buffer, rect, xrays, yrays);
+    if (params != parent)
+        free(local_params.lenses.lens);
+}
+
+// Mark the patches that might contribute to the pattern, given the hit
+// codes of the (xrays+3)*(yrays+3) grid of rays around the patch
+// corners.  A patch is considered hit if the rays around it hit the
+// pattern from all sides.  With a mask, mag_x and mag_y are the pixel
+// coordinates of the rays, and a patch away from the lenses is only
+// hit if the bounding box of the rays around it contains a masked
+// pixel.
+static void
+_ll_mark_hit_subpatches(const struct ll_magpat_params *params,
+                        struct ll_patches *patches, const int *hit,
+                        const double *mag_x, const double *mag_y)
+{
+    int xrays = patches->xrays;
+    int yrays = patches->yrays;
+    patches->num_patches = 0;
+    uint8_t* hit_patches = patches->hit;
+    uint8_t *near = 0;
+    if (params->mask)
+        near = _ll_lens_cells(params, patches->rect.x, patches->rect.y,
+                              patches->width_per_xrays,
+                              patches->height_per_yrays, xrays, yrays);
+    const int around[12] = {-xrays-3, -xrays-2, -1, 0, 1, 2, xrays+2,
+                            xrays+3, xrays+4, xrays+5, 2*xrays+6,
+                            2*xrays+7};
+    for (int j = 0, m = xrays+4, n = 0; j < yrays; ++j, m += 3)
+        for (int i = 0; i < xrays; ++i, ++m, ++n)
+        {
+            hit_patches[n] = (hit[m-xrays-3] | hit[m-xrays-2] |
+                              hit[m-1] | hit[m] | hit[m+1] | hit[m+2] |
+                              hit[m+xrays+2] | hit[m+xrays+3] |
+                              hit[m+xrays+4] | hit[m+xrays+5] |
+                              hit[m+2*xrays+6] | hit[m+2*xrays+7]) == 0x0F;
+            if (hit_patches[n] && near && !near[n])
+            {
+                double x0 = DBL_MAX, x1 = -DBL_MAX;
+                double y0 = DBL_MAX, y1 = -DBL_MAX;
+                for (int k = 0; k < 12; ++k)
+                {
+                    x0 = fmin(x0, mag_x[m + around[k]]);
+                    x1 = fmax(x1, mag_x[m + around[k]]);
+                    y0 = fmin(y0, mag_y[m + around[k]]);
+                    y1 = fmax(y1, mag_y[m + around[k]]);
+                }
+                hit_patches[n] = _ll_mask_hit(params, x0, x1, y0, y1);
+            }
+            if (hit_patches[n])
+                ++patches->num_patches;
+        }
+    free(near);
+}
+
+extern void
+ll_get_subpatches(const struct ll_magpat_params *params,
+                  struct ll_patches *patches)
+{
+    int xrays = patches->xrays;
+    int yrays = patches->yrays;
+    unsigned n = (xrays+3)*(yrays+3);
+    int *hit = malloc(n * sizeof(int));
+    double *mag_x = 0, *mag_y = 0;
+    if (params->mask)
+    {
+        mag_x = malloc(n * sizeof(double));
+        mag_y = malloc(n * sizeof(double));
+    }
+    _ll_shoot_ray_grid(params, LL_PRECISION_DOUBLE,
+                       patches->rect.x, patches->rect.y,
+                       patches->width_per_xrays, patches->height_per_yrays,
+                       -1, xrays+1, -1, yrays+1, mag_x, mag_y, hit);
+    _ll_mark_hit_subpatches(params, patches, hit, mag_x, mag_y);
+    free(mag_y);
+    free(mag_x);
+    free(hit);
+}
+
+extern void
+ll_rayshoot_subpatches(const struct ll_rayshooter *rs, void *magpat,
+                       const struct ll_patches *patches, double *progress)
+{
+    _ll_rayshoot_subpatches(rs, rs->params, magpat, 0, patches, progress);
+}
+
+static void
+_ll_rayshoot_subpatches(const struct ll_rayshooter *rs,
+                        const struct ll_magpat_params *params, void *magpat,
+                        struct _ll_hit_buffer *buffer,
+                        const struct ll_patches *patches, double *progress)
+{
+    double progress_inc = 1.0 / patches->num_patches;
+    for (int j = 0, n = 0; j < patches->yrays; ++j)
+        for (int i = 0; i < patches->xrays; ++i, ++n)
+            if (patches->hit[n])
+            {
+                double x = patches->rect.x + i*patches->width_per_xrays;
+                double y = patches->rect.y + j*patches->height_per_yrays;
+                struct ll_rect subrect
+                    = {x, y, patches->width_per_xrays, patches->height_per_yrays};
+                _ll_rayshoot_recursively(rs, params, magpat, buffer,
+                                         &subrect, rs->refine, rs->refine,
+                                         patches->level-1, 0);
+                if (progress)
+                    *progress += progress_inc;
+            }
+}
+
+// Return whether the kernel counts rays, and the factor converting ray
+// counts to magnifications in *scale.  The other kernels compute
+// magnifications directly.
+static bool
+_ll_magpat_scale(const struct ll_rayshooter *rs, const struct ll_rect *rect,
+                 int xrays, int yrays, unsigned level, double *scale)
+{
+    switch (rs->kernel)
+    {
+    case LL_KERNEL_SIMPLE:
+    case LL_KERNEL_BILINEAR:
+    {
+        double pixels = (double)rs->params->xpixels * rs->params->ypixels;
+        double density = (double)xrays * yrays;
+        for (unsigned i = 0; i < level - 1; ++i)
+            density *= rs->refine * rs->refine;
+        density *= rs->refine_kernel * rs->refine_kernel;
+        density *= rs->params->region.width * rs->params->region.height;
+        density /= rect->width * rect->height * pixels;
+        *scale = 1.0/density;
+        return true;
+    }
+    case LL_KERNEL_TRIANGULATED:
+    case LL_KERNEL_TRIANGULATED_SCANLINE:
+    case LL_KERNEL_ADAPTIVE:
+        break;
+    }
+    return false;
+}
+
+static void
+_ll_scale_pixels(void *magpat, double scale, uint64_t begin, uint64_t end)
+{
+    float *fpat = magpat;
+    uint32_t *ipat = magpat;
+    for (uint64_t i = begin; i < end; ++i)
+        fpat[i] = ipat[i] * scale;
+}
+
+static void
+_ll_scale_magpat(const struct ll_rayshooter *rs, void *magpat,
+                 const struct ll_rect *rect, int xrays, int yrays,
+                 unsigned level)
+{
+    double scale;
+    if (_ll_magpat_scale(rs, rect, xrays, yrays, level, &scale))
+        _ll_scale_pixels(magpat, scale, 0,
+                         (uint64_t)rs->params->xpixels * rs->params->ypixels);
+}
+
+extern void
+ll_finalise_subpatches(const struct ll_rayshooter *rs, void *magpat,
+                       const struct ll_patches *patches)
+{
+    _ll_scale_magpat(rs, magpat, &patches->rect,
+                     patches->xrays, patches->yrays, patches->level);
+}
+
+extern void
+ll_rayshoot(const struct ll_rayshooter *rs, void *magpat,
+            const struct ll_rect *rect, int xrays, int yrays,
+            unsigned levels, double *progress)
+{
+    if (progress)
+        *progress = 0.0;
+    _ll_rayshoot_recursively(rs, rs->params, magpat, 0, rect, xrays, yrays,
+                             levels - 1, progress);
+    _ll_scale_magpat(rs, magpat, rect, xrays, yrays, levels - 1);
+}
+
+// Thread pool
+//
+// The worker threads are started on first use and stay alive for the
+// lifetime of the process, so repeated parallel runs don't pay for
+// thread creation.  A job is a function that is called once by each
+// of num_threads threads with the thread index and the number of
+// threads as arguments; the calling thread takes part as thread 0.
+// Jobs submitted from different threads are serialised.
+
+struct _ll_pool_job
+{
+    void (*func)(void *arg, unsigned thread, unsigned num_threads);
+    void *arg;
+    unsigned num_threads;
+};
+
+struct _ll_pool_worker_arg
+{
+    unsigned index;
+    unsigned long generation;
+};
+
+static pthread_mutex_t _ll_pool_job_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_mutex_t _ll_pool_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t _ll_pool_start = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t _ll_pool_done = PTHREAD_COND_INITIALIZER;
+static struct _ll_pool_job _ll_pool_current;
+static unsigned long _ll_pool_generation = 0;
+static unsigned _ll_pool_num_workers = 0;
+static unsigned _ll_pool_pending = 0;
+
+static void *
+_ll_pool_worker(void *arg)
+{
+    struct _ll_pool_worker_arg *worker = arg;
+    unsigned index = worker->index;
+    unsigned long generation = worker->generation;
+    free(worker);
+    while (true)
+    {
+        pthread_mutex_lock(&_ll_pool_lock);
+        while (_ll_pool_generation == generation)
+            pthread_cond_wait(&_ll_pool_start, &_ll_pool_lock);
+        generation = _ll_pool_generation;
+        struct _ll_pool_job job = _ll_pool_current;
+        pthread_mutex_unlock(&_ll_pool_lock);
+        if (index >= job.num_threads)
+            continue;
+        job.func(job.arg, index, job.num_threads);
+        pthread_mutex_lock(&_ll_pool_lock);
+        if (--_ll_pool_pending == 0)
+            pthread_cond_signal(&_ll_pool_done);
+        pthread_mutex_unlock(&_ll_pool_lock);
+    }
+    return 0;
+}
+
+// Only the forking thread survives in the child process, so forget
+// about the workers and start afresh if the pool is used again.
+static void
+_ll_pool_reset_after_fork(void)
+{
+    pthread_mutex_init(&_ll_pool_job_lock, 0);
+    pthread_mutex_init(&_ll_pool_lock, 0);
+    pthread_cond_init(&_ll_pool_start, 0);
+    pthread_cond_init(&_ll_pool_done, 0);
+    _ll_pool_num_workers = 0;
+    _ll_pool_pending = 0;
+}
+
+// Forked children inherit both the handler and the once control, so
+// the handler is registered exactly once per process image.
+static pthread_once_t _ll_pool_atfork_once = PTHREAD_ONCE_INIT;
+
+static void
+_ll_pool_register_atfork(void)
+{
+    pthread_atfork(0, 0, _ll_pool_reset_after_fork);
+}
+
+// Must be called with _ll_pool_lock held.  Returns the number of
+// threads available for the next job including the calling thread.
+static unsigned
+_ll_pool_grow(unsigned num_threads)
+{
+    pthread_once(&_ll_pool_atfork_once, _ll_pool_register_atfork);
+    pthread_attr_t attr;
+    pthread_attr_init(&attr);
+    pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+    while (_ll_pool_num_workers + 1 < num_threads)
+    {
+        struct _ll_pool_worker_arg *worker = malloc(sizeof *worker);
+        worker->index = _ll_pool_num_workers + 1;
+        worker->generation = _ll_pool_generation;
+        pthread_t thread;
+        if (pthread_create(&thread, &attr, _ll_pool_worker, worker))
+        {
+            free(worker);
+            break;
+        }
+        ++_ll_pool_num_workers;
+    }
+    pthread_attr_destroy(&attr);
+    return _ll_pool_num_workers + 1 < num_threads ?
+        _ll_pool_num_workers + 1 : num_threads;
+}
+
+// Run func(arg, thread, num_threads) for thread = 0, ..., num_threads-1
+// in parallel and wait for all calls to return.  If not enough threads
+// can be started, func() is called for fewer threads.
+static void
+_ll_pool_run(void (*func)(void *arg, unsigned thread, unsigned num_threads),
+             void *arg, unsigned num_threads)
+{
+    if (num_threads < 2)
+    {
+        func(arg, 0, 1);
+        return;
+    }
+    pthread_mutex_lock(&_ll_pool_job_lock);
+    pthread_mutex_lock(&_ll_pool_lock);
+    num_threads = _ll_pool_grow(num_threads);
+    _ll_pool_current.func = func;
+    _ll_pool_current.arg = arg;
+    _ll_pool_current.num_threads = num_threads;
+    _ll_pool_pending = num_threads - 1;
+    ++_ll_pool_generation;
+    pthread_cond_broadcast(&_ll_pool_start);
+    pthread_mutex_unlock(&_ll_pool_lock);
+    func(arg, 0, num_threads);
+    pthread_mutex_lock(&_ll_pool_lock);
+    while (_ll_pool_pending)
+        pthread_cond_wait(&_ll_pool_done, &_ll_pool_lock);
+    pthread_mutex_unlock(&_ll_pool_lock);
+    pthread_mutex_unlock(&_ll_pool_job_lock);
+}
+
+// Parallel version of ll_get_subpatches().  The rows of the patch grid
+// are split into bands which are handed out to the threads one by one.
+
+struct _ll_subpatches_job
+{
+    const struct ll_rayshooter *rs;
+    struct ll_patches *patches;
+    int band_height;
+    int next_row;
+    pthread_mutex_t lock;
+};
+
+static void
+_ll_get_subpatches_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_subpatches_job *job = arg;
+    struct ll_patches *patches = job->patches;
+    (void)thread;
+    (void)num_threads;
+    while (!job->rs->cancel)
+    {
+        pthread_mutex_lock(&job->lock);
+        int j0 = job->next_row;
+        job->next_row += job->band_height;
+        pthread_mutex_unlock(&job->lock);
+        if (j0 >= patches->yrays)
+            break;
+        int rows = patches->yrays - j0;
+        if (rows > job->band_height)
+            rows = job->band_height;
+        struct ll_patches band =
+            {{patches->rect.x, patches->rect.y + j0*patches->height_per_yrays,
+              patches->rect.width, rows*patches->height_per_yrays},
+             patches->xrays, rows, patches->level,
+             patches->width_per_xrays, patches->height_per_yrays,
+             patches->hit + j0*patches->xrays, 0};
+        if (job->rs->far_field_angle > 0.0)
+            _ll_get_subpatches_blocked(job->rs, job->rs->params, &band);
+        else
+            ll_get_subpatches(job->rs->params, &band);
+        pthread_mutex_lock(&job->lock);
+        patches->num_patches += band.num_patches;
+        pthread_mutex_unlock(&job->lock);
+    }
+}
+
+extern void
+ll_get_subpatches_parallel(const struct ll_rayshooter *rs,
+                           struct ll_patches *patches, unsigned num_threads)
+{
+    // Every band shoots three extra rows of rays, so don't make the
+    // bands too thin.
+    int band_height = patches->yrays / (4*num_threads + 1) + 1;
+    if (band_height < 8)
+        band_height = 8;
+    struct _ll_subpatches_job job =
+        {.rs = rs, .patches = patches, .band_height = band_height};
+    pthread_mutex_init(&job.lock, 0);
+    patches->num_patches = 0;
+    _ll_pool_run(_ll_get_subpatches_worker, &job, num_threads);
+    pthread_mutex_destroy(&job.lock);
+}
+
+// Parallel version of ll_rayshoot_subpatches().  The hit patches are
+// distributed evenly among the threads' task ranges.  A thread that
+// has run out of work steals the upper half of the range of some other
+// thread, so lens-dense regions of the pattern don't leave the other
+// threads idle.  All threads shoot into the same pattern through their
+// hit buffers.
+
+struct _ll_task_range
+{
+    pthread_mutex_t lock;
+    unsigned begin, end;
+};
+
+struct _ll_rayshoot_job
+{
+    const struct ll_rayshooter *rs;
+    const struct ll_patches *patches;
+    unsigned *tasks;
+    struct _ll_task_range *ranges;
+    struct _ll_shared_magpat shared;
+    unsigned num_threads;
+    double *progress;
+    double progress_inc;
+    pthread_mutex_t lock;
+    // If source_x is set, task k shoots patch indices[k] using the
+    // deflected ray grid at offset k*grid_size (see ll_rayshoot_deflected).
+    const unsigned *indices;
+    const double *source_x, *source_y;
+    unsigned grid_size;
+    // If row_ranges is set, magpat only holds the rows [first_row,
+    // first_row + num_rows) of the pattern (see ll_rayshoot_rows).
+    int *row_ranges;
+    unsigned first_row, num_rows;
+};
+
+static void
+_ll_rayshoot_deflected_patch(const struct ll_rayshooter *rs, void *magpat,
+                             struct _ll_hit_buffer *buffer,
+                             const struct ll_patches *patches, unsigned n,
+                             const double *source_x, const double *source_y);
+
+static bool
+_ll_next_task(struct _ll_rayshoot_job *job, unsigned thread, unsigned *task)
+{
+    struct _ll_task_range *own = job->ranges + thread;
+    pthread_mutex_lock(&own->lock);
+    if (own->begin < own->end)
+    {
+        *task = job->tasks[own->begin++];
+        pthread_mutex_unlock(&own->lock);
+        return true;
+    }
+    pthread_mutex_unlock(&own->lock);
+    for (unsigned k = 1; k < job->num_threads; ++k)
+    {
+        struct _ll_task_range *victim =
+            job->ranges + (thread + k) % job->num_threads;
+        pthread_mutex_lock(&victim->lock);
+        unsigned begin = victim->begin, end = victim->end;
+        if (begin < end)
+        {
+            unsigned mid = begin + (end - begin) / 2;
+            victim->end = mid;
+            pthread_mutex_unlock(&victim->lock);
+            *task = job->tasks[mid];
+            pthread_mutex_lock(&own->lock);
+            own->begin = mid + 1;
+            own->end = end;
+            pthread_mutex_unlock(&own->lock);
+            return true;
+        }
+        pthread_mutex_unlock(&victim->lock);
+    }
+    return false;
+}
+
+static void
+_ll_rayshoot_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_rayshoot_job *job = arg;
+    const struct ll_rayshooter *rs = job->rs;
+    const struct ll_patches *patches = job->patches;
+    // A single thread can write to the pattern directly.
+    struct _ll_hit_buffer *buffer = 0;
+    if (num_threads > 1 || job->row_ranges)
+    {
+        buffer = malloc(sizeof *buffer);
+        buffer->shared = &job->shared;
+        buffer->count = 0;
+        buffer->prune = false;
+        for (unsigned k = 0; k < 1 << LL_HIT_CACHE_BITS; ++k)
+            buffer->cache[k].index = _ll_empty_slot_index(k);
+        buffer->first_band = thread * job->shared.num_bands / num_threads;
+        buffer->band_start =
+            malloc((job->shared.num_bands + 1) * sizeof(unsigned));
+    }
+    unsigned task;
+    while (!rs->cancel && _ll_next_task(job, thread, &task))
+    {
+        int *rows = job->row_ranges ? job->row_ranges + 2*task : 0;
+        if (buffer)
+        {
+            buffer->min_y = DBL_MAX;
+            buffer->max_y = -DBL_MAX;
+            buffer->prune = rows && rows[0] >= 0;
+        }
+        if (job->source_x)
+            _ll_rayshoot_deflected_patch(
+                rs, job->shared.magpat, buffer, patches, job->indices[task],
+                job->source_x + (size_t)task*job->grid_size,
+                job->source_y + (size_t)task*job->grid_size);
+        else
+        {
+            int i = task % patches->xrays;
+            int j = task / patches->xrays;
+            struct ll_rect subrect =
+                {patches->rect.x + i*patches->width_per_xrays,
+                 patches->rect.y + j*patches->height_per_yrays,
+                 patches->width_per_xrays, patches->height_per_yrays};
+            _ll_rayshoot_recursively(rs, rs->params, job->shared.magpat,
+                                     buffer, &subrect, rs->refine, rs->refine,
+                                     patches->level-1, 0);
+        }
+        if (rows && rows[0] < 0 && !rs->cancel)
+        {
+            // Rays outside the pattern aren't counted, so the range
+            // is clipped to the pattern.
+            double ypixels = rs->params->ypixels;
+            bool empty = buffer->min_y > buffer->max_y;
+            rows[0] = empty ? 0 : fmax(buffer->min_y, 0.0);
+            rows[1] = empty ? 0 : fmin(buffer->max_y, ypixels - 1.0) + 1.0;
+        }
+        if (job->progress)
+        {
+            pthread_mutex_lock(&job->lock);
+            *job->progress += job->progress_inc;
+            pthread_mutex_unlock(&job->lock);
+        }
+    }
+    if (!buffer)
+        return;
+    // The threads flush their last partial buffers concurrently.
+    _ll_drain_hit_buffer(buffer);
+    free(buffer->band_start);
+    free(buffer);
+}
+
+// Run job over its tasks[0..num_tasks-1], shooting into magpat.
+static void
+_ll_run_rayshoot_job(struct _ll_rayshoot_job *job, void *magpat,
+                     unsigned num_tasks, unsigned num_threads)
+{
+    const struct ll_rayshooter *rs = job->rs;
+    if (num_threads > num_tasks)
+        num_threads = num_tasks ? num_tasks : 1;
+    struct _ll_task_range *ranges =
+        malloc(num_threads * sizeof(struct _ll_task_range));
+    for (unsigned k = 0; k < num_threads; ++k)
+    {
+        pthread_mutex_init(&ranges[k].lock, 0);
+        ranges[k].begin = (uint64_t)num_tasks * k / num_threads;
+        ranges[k].end = (uint64_t)num_tasks * (k + 1) / num_threads;
+    }
+    // Use enough bands that threads rarely wait for each other.
+    uint64_t pixels = (uint64_t)rs->params->xpixels * rs->params->ypixels;
+    job->shared.first_index = 0;
+    if (job->row_ranges)
+    {
+        job->shared.first_index = job->first_row * rs->params->xpixels;
+        pixels = (uint64_t)job->num_rows * rs->params->xpixels;
+    }
+    job->shared.num_pixels = pixels;
+    unsigned band_shift = 10;
+    while (band_shift < 31 && pixels >> band_shift > 16*num_threads)
+        ++band_shift;
+    job->ranges = ranges;
+    job->num_threads = num_threads;
+    job->shared.magpat = magpat;
+    job->shared.is_float = rs->kernel == LL_KERNEL_TRIANGULATED ||
+        rs->kernel == LL_KERNEL_TRIANGULATED_SCANLINE ||
+        rs->kernel == LL_KERNEL_ADAPTIVE;
+    job->shared.band_shift = band_shift;
+    job->shared.num_bands = ((pixels - 1) >> band_shift) + 1;
+    job->shared.locks = malloc(job->shared.num_bands * sizeof(pthread_mutex_t));
+    for (unsigned b = 0; b < job->shared.num_bands; ++b)
+        pthread_mutex_init(job->shared.locks + b, 0);
+    pthread_mutex_init(&job->lock, 0);
+    // The pool might not be able to provide all threads.  The ranges
+    // of threads that don't run are stolen by the others.
+    _ll_pool_run(_ll_rayshoot_worker, job, num_threads);
+    pthread_mutex_destroy(&job->lock);
+    for (unsigned b = 0; b < job->shared.num_bands; ++b)
+        pthread_mutex_destroy(job->shared.locks + b);
+    free(job->shared.locks);
+    for (unsigned k = 0; k < num_threads; ++k)
+        pthread_mutex_destroy(&ranges[k].lock);
+    free(ranges);
+}
+
+extern void
+ll_rayshoot_subpatches_parallel(const struct ll_rayshooter *rs, void *magpat,
+                                const struct ll_patches *patches,
+                                double *progress, unsigned num_threads)
+{
+    if (num_threads < 2 || patches->num_patches < 2)
+    {
+        ll_rayshoot_subpatches(rs, magpat, patches, progress);
+        return;
+    }
+    unsigned *tasks = malloc(patches->num_patches * sizeof(unsigned));
+    unsigned num_tasks = 0;
+    for (int n = 0; n < patches->xrays * patches->yrays; ++n)
+        if (patches->hit[n])
+            tasks[num_tasks++] = n;
+    struct _ll_rayshoot_job job =
+        {.rs = rs, .patches = patches, .tasks = tasks, .progress = progress,
+         .progress_inc = 1.0 / patches->num_patches};
+    _ll_run_rayshoot_job(&job, magpat, num_tasks, num_threads);
+    free(tasks);
+}
+
+struct _ll_scale_job
+{
+    void *magpat;
+    double scale;
+    uint64_t pixels;
+};
+
+static void
+_ll_scale_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_scale_job *job = arg;
+    _ll_scale_pixels(job->magpat, job->scale,
+                     (uint64_t)job->pixels * thread / num_threads,
+                     (uint64_t)job->pixels * (thread + 1) / num_threads);
+}
+
+static void
+_ll_scale_magpat_parallel(const struct ll_rayshooter *rs, void *magpat,
+                          const struct ll_rect *rect, int xrays, int yrays,
+                          unsigned level, unsigned num_threads)
+{
+    struct _ll_scale_job job =
+        {magpat, 0.0, (uint64_t)rs->params->xpixels * rs->params->ypixels};
+    if (_ll_magpat_scale(rs, rect, xrays, yrays, level, &job.scale))
+        _ll_pool_run(_ll_scale_worker, &job, num_threads);
+}
+
+extern void
+ll_finalise_subpatches_parallel(const struct ll_rayshooter *rs, void *magpat,
+                                const struct ll_patches *patches,
+                                unsigned num_threads)
+{
+    _ll_scale_magpat_parallel(rs, magpat, &patches->rect, patches->xrays,
+                              patches->yrays, patches->level, num_threads);
+}
+
+extern void
+ll_rayshoot_parallel(const struct ll_rayshooter *rs, void *magpat,
+                     const struct ll_rect *rect, int xrays, int yrays,
+                     unsigned levels, double *progress, unsigned num_threads)
+{
+    if (num_threads < 2 || levels < 3)
+    {
+        ll_rayshoot(rs, magpat, rect, xrays, yrays, levels, progress);
+        return;
+    }
+    if (progress)
+        *progress = 0.0;
+    struct ll_patches patches =
+        { *rect, xrays, yrays, levels - 1, rect->width/xrays, rect->height/yrays,
+          .hit = malloc(xrays*yrays * sizeof(uint8_t)), .num_patches = 0};
+    ll_get_subpatches_parallel(rs, &patches, num_threads);
+    ll_rayshoot_subpatches_parallel(rs, magpat, &patches, progress,
+                                    num_threads);
+    free(patches.hit);
+    _ll_scale_magpat_parallel(rs, magpat, rect, xrays, yrays, levels - 1,
+                              num_threads);
+}
+
+// Shoot the rows [first_row, first_row + num_rows) of the pattern into
+// magpat, which only holds these rows, given the hit patches of the
+// coarsest level.  The patches are the same for all rows, so shooting
+// a pattern in bands of rows gives the same result as a single run.
+// row_ranges contains two ints per patch.  For the patches with a
+// negative first entry, all rays are shot and the range of rows they
+// hit is stored.  The other patches are only shot if their range
+// intersects the rows, and the kernels skip the cells outside of the
+// rows.
+extern void
+ll_rayshoot_rows(const struct ll_rayshooter *rs, void *magpat,
+                 const struct ll_patches *patches,
+                 unsigned first_row, unsigned num_rows, int *row_ranges,
+                 double *progress, unsigned num_threads)
+{
+    if (progress)
+        *progress = 0.0;
+    unsigned *tasks = malloc(patches->num_patches * sizeof(unsigned));
+    unsigned num_tasks = 0;
+    for (int n = 0; n < patches->xrays * patches->yrays; ++n)
+    {
+        const int *rows = row_ranges + 2*n;
+        if (patches->hit[n] && (rows[0] < 0 ||
+                                (rows[0] < (int)(first_row + num_rows) &&
+                                 rows[1] > (int)first_row)))
+            tasks[num_tasks++] = n;
+    }
+    struct _ll_rayshoot_job job =
+        {.rs = rs, .patches = patches, .tasks = tasks, .progress = progress,
+         .progress_inc = 1.0 / num_tasks, .row_ranges = row_ranges,
+         .first_row = first_row, .num_rows = num_rows};
+    if (num_threads < 1)
+        num_threads = 1;
+    _ll_run_rayshoot_job(&job, magpat, num_tasks, num_threads);
+    free(tasks);
+    struct _ll_scale_job scale_job =
+        {magpat, 0.0, (uint64_t)num_rows * rs->params->xpixels};
+    if (_ll_magpat_scale(rs, &patches->rect, patches->xrays, patches->yrays,
+                         patches->level, &scale_job.scale))
+        _ll_pool_run(_ll_scale_worker, &scale_job, num_threads);
+}
+
+// Deflection grids
+//
+// The coarse levels of a run only depend on the lenses and the shooting
+// rectangle, not on the pattern region or resolution.  The following
+// functions expose the deflected source plane coordinates of the ray
+// grids shot on the top level and for the hit top level patches, and
+// can continue a run from these coordinates, so they can be cached and
+// reused by later runs.  The grids are always shot in double precision
+// and without far field expansion.  Converting the coordinates to
+// pixels uses the same expressions as _ll_shoot_ray_block(), so the
+// results are identical to a run shooting the grids directly.
+
+extern void
+ll_deflect_grid(const struct ll_magpat_params *params,
+                double x0, double y0, double dx, double dy,
+                int i0, int i1, int j0, int j1,
+                double *source_x, double *source_y)
+{
+    // With the region at the origin and one pixel per unit length, the
+    // "pixel" coordinates are the source plane coordinates.
+    struct ll_magpat_params source_params = *params;
+    source_params.region.x = 0.0;
+    source_params.region.y = 0.0;
+    source_params.pixels_per_width = 1.0;
+    source_params.pixels_per_height = 1.0;
+    int *hit = malloc((i1-i0+1)*(j1-j0+1) * sizeof(int));
+    _ll_shoot_ray_grid(&source_params, LL_PRECISION_DOUBLE, x0, y0, dx, dy,
+                       i0, i1, j0, j1, source_x, source_y, hit);
+    free(hit);
+}
+
+static void
+_ll_source_to_pixels(const struct ll_magpat_params *params, unsigned n,
+                     const double *source_x, const double *source_y,
+                     double *mag_x, double *mag_y, int *hit)
+{
+    for (unsigned r = 0; r < n; ++r)
+    {
+        mag_x[r] = (source_x[r] - params->region.x) * params->pixels_per_width;
+        mag_y[r] = (source_y[r] - params->region.y) *
+            params->pixels_per_height;
+        hit[r] = (((0 <= mag_x[r])     ) |
+                  ((mag_x[r] < params->xpixels) << 1) |
+                  ((0 <= mag_y[r]) << 2) |
+                  ((mag_y[r] < params->ypixels) << 3));
+    }
+}
+
+extern void
+ll_get_subpatches_deflected(const struct ll_magpat_params *params,
+                            struct ll_patches *patches,
+                            const double *source_x, const double *source_y)
+{
+    unsigned n = (patches->xrays+3)*(patches->yrays+3);
+    double *mag_x = malloc(n * sizeof(double));
+    double *mag_y = malloc(n * sizeof(double));
+    int *hit = malloc(n * sizeof(int));
+    _ll_source_to_pixels(params, n, source_x, source_y, mag_x, mag_y, hit);
+    _ll_mark_hit_subpatches(params, patches, hit, mag_x, mag_y);
+    free(hit);
+    free(mag_y);
+    free(mag_x);
+}
+
+// Get the ray grid _ll_rayshoot_recursively() shoots for patch n.
+static void
+_ll_patch_grid(const struct ll_rayshooter *rs, const struct ll_patches *patches,
+               unsigned n, struct ll_rect *subrect, int *first, int *last)
+{
+    subrect->x = patches->rect.x + n % patches->xrays*patches->width_per_xrays;
+    subrect->y = patches->rect.y + n / patches->xrays*patches->height_per_yrays;
+    subrect->width = patches->width_per_xrays;
+    subrect->height = patches->height_per_yrays;
+    if (patches->level > 2)
+    {
+        *first = -1;
+        *last = rs->refine + 1;
+    }
+    else
+    {
+        *first = 0;
+        *last = rs->refine;
+    }
+}
+
+extern unsigned
+ll_patch_grid_size(const struct ll_rayshooter *rs,
+                   const struct ll_patches *patches)
+{
+    unsigned side = rs->refine + (patches->level > 2 ? 3 : 1);
+    return side * side;
+}
+
+struct _ll_deflect_job
+{
+    const struct ll_rayshooter *rs;
+    const struct ll_patches *patches;
+    const unsigned *indices;
+    unsigned num_indices, next;
+    double *source_x, *source_y;
+    pthread_mutex_t lock;
+};
+
+static void
+_ll_deflect_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_deflect_job *job = arg;
+    const struct ll_rayshooter *rs = job->rs;
+    unsigned grid_size = ll_patch_grid_size(rs, job->patches);
+    (void)thread;
+    (void)num_threads;
+    while (!rs->cancel)
+    {
+        pthread_mutex_lock(&job->lock);
+        unsigned k = job->next++;
+        pthread_mutex_unlock(&job->lock);
+        if (k >= job->num_indices)
+            break;
+        struct ll_rect subrect;
+        int first, last;
+        _ll_patch_grid(rs, job->patches, job->indices[k], &subrect,
+                       &first, &last);
+        ll_deflect_grid(rs->params, subrect.x, subrect.y,
+                        subrect.width / rs->refine, subrect.height / rs->refine,
+                        first, last, first, last,
+                        job->source_x + (size_t)k*grid_size,
+                        job->source_y + (size_t)k*grid_size);
+    }
+}
+
+extern void
+ll_deflect_patches(const struct ll_rayshooter *rs,
+                   const struct ll_patches *patches,
+                   const unsigned *indices, unsigned num_indices,
+                   double *source_x, double *source_y, unsigned num_threads)
+{
+    struct _ll_deflect_job job =
+        {.rs = rs, .patches = patches, .indices = indices,
+         .num_indices = num_indices, .source_x = source_x,
+         .source_y = source_y};
+    pthread_mutex_init(&job.lock, 0);
+    if (num_threads > num_indices)
+        num_threads = num_indices ? num_indices : 1;
+    _ll_pool_run(_ll_deflect_worker, &job, num_threads);
+    pthread_mutex_destroy(&job.lock);
+}
+
+struct _ll_deflect_rays_job
+{
+    const struct ll_magpat_params *params;
+    unsigned num_rays;
+    const double *x, *y;
+    double *source_x, *source_y;
+    int *hit;
+};
+
+static void
+_ll_deflect_rays_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_deflect_rays_job *job = arg;
+    const struct ll_magpat_params *params = job->params;
+    struct ll_magpat_params source_params = *params;
+    source_params.region.x = 0.0;
+    source_params.region.y = 0.0;
+    source_params.pixels_per_width = 1.0;
+    source_params.pixels_per_height = 1.0;
+    unsigned begin = (uint64_t)job->num_rays * thread / num_threads;
+    unsigned end = (uint64_t)job->num_rays * (thread + 1) / num_threads;
+    for (unsigned start = begin; start < end; start += LL_RAY_BLOCK)
+    {
+        unsigned n = end - start;
+        if (n > LL_RAY_BLOCK)
+            n = LL_RAY_BLOCK;
+        _ll_shoot_ray_block(&source_params, n, job->x + start, job->y + start,
+                            job->source_x + start, job->source_y + start,
+                            job->hit + start);
+    }
+    for (unsigned r = begin; r < end; ++r)
+    {
+        double mag_x = (job->source_x[r] - params->region.x) *
+            params->pixels_per_width;
+        double mag_y = (job->source_y[r] - params->region.y) *
+            params->pixels_per_height;
+        job->hit[r] = (((0 <= mag_x)     ) |
+                       ((mag_x < params->xpixels) << 1) |
+                       ((0 <= mag_y) << 2) |
+                       ((mag_y < params->ypixels) << 3));
+    }
+}
+
+// Deflect num_rays rays (x[r], y[r]) to the source plane coordinates
+// (source_x[r], source_y[r]), using num_threads threads.  hit[r] is
+// the hit code of the ray for the pattern of params.
+extern void
+ll_deflect_rays(const struct ll_magpat_params *params, unsigned num_rays,
+                const double *x, const double *y,
+                double *source_x, double *source_y, int *hit,
+                unsigned num_threads)
+{
+    struct _ll_deflect_rays_job job =
+        {params, num_rays, x, y, source_x, source_y, hit};
+    if (num_threads > num_rays / LL_RAY_BLOCK)
+        num_threads = num_rays / LL_RAY_BLOCK ? num_rays / LL_RAY_BLOCK : 1;
+    _ll_pool_run(_ll_deflect_rays_worker, &job, num_threads);
+}
+
+// Finding the images of point sources.  For n point lenses at z_k with
+// masses m_k, the lens equation in complex notation reads
+//
+//     zeta = z - sum_k m_k / conj(z - z_k).
+//
+// Taking the complex conjugate and substituting conj(z) back in gives a
+// polynomial of degree n*n + 1 in z.  With Q = prod_k (z - z_k),
+// P = sum_k m_k prod_{l != k} (z - z_l) and R_k = conj(zeta - z_k) Q + P
+// it reads
+//
+//     (z - zeta) prod_k R_k - Q sum_k m_k prod_{l != k} R_l.
+//
+// Its roots are found by Aberth's method, starting from the roots for
+// the previous source of the same thread, which are close for light
+// curves and pixel maps.  Only some of the roots are images; each root
+// is polished by Newton steps on the lens equation itself, and roots
+// with a remaining residual above LL_IMAGE_TOLERANCE are dropped.
+//
+// For hierarchical systems like planets the polynomial becomes badly
+// conditioned, and images close to small lenses may be lost.  This is
+// detected by the image counts of point lenses: there are at least
+// n + 1 images, and the number of positive parity images minus the
+// number of negative parity images is 1 - n.  If these don't hold, the
+// polynomial is solved again in coordinates centred on each lens in
+// turn, which keeps the images near this lens well conditioned, until
+// the images found so far are consistent.
+
+#define LL_IMAGE_TOLERANCE 1e-10
+#define LL_ABERTH_MAX_ITER 100
+#define LL_NEWTON_MAX_ITER 10
+
+struct _ll_image_finder
+{
+    unsigned num_lenses, num_roots, num_images;
+    double complex origin;
+    double complex *lens_z, *q, *p, *r, *prod, *sum, *tmp, *poly, *roots;
+    double *mass, *abs_poly;
+    char *converged;
+};
+
+static inline double
+_ll_cnorm(double complex z)
+{
+    return creal(z)*creal(z) + cimag(z)*cimag(z);
+}
+
+// out = a * b for polynomials a and b of degrees na and nb, with the
+// coefficients in ascending order.  out must not alias a or b.
+static void
+_ll_poly_mul(const double complex *a, unsigned na,
+             const double complex *b, unsigned nb, double complex *out)
+{
+    for (unsigned i = 0; i <= na + nb; ++i)
+        out[i] = 0.0;
+    for (unsigned i = 0; i <= na; ++i)
+        for (unsigned j = 0; j <= nb; ++j)
+            out[i+j] += a[i] * b[j];
+}
+
+// Aberth's method refining the approximations z of all roots of the
+// polynomial a at once.  A root is no longer updated once its last
+// correction fell below 1e-10 relative to the root, which is enough
+// since the images are polished by _ll_find_images() afterwards, or
+// once the polynomial value is at the level of the rounding errors,
+// bounded with the absolute values abs_a of the coefficients.
+// converged must have room for degree flags.
+static void
+_ll_aberth(const double complex *a, const double *abs_a, unsigned degree,
+           double complex *z, char *converged)
+{
+    for (unsigned i = 0; i < degree; ++i)
+        converged[i] = 0;
+    for (unsigned iter = 0; iter < LL_ABERTH_MAX_ITER; ++iter)
+    {
+        unsigned num_converged = 0;
+        for (unsigned i = 0; i < degree; ++i)
+        {
+            if (converged[i])
+            {
+                ++num_converged;
+                continue;
+            }
+            double complex p = a[degree], dp = 0.0;
+            double abs_z = sqrt(_ll_cnorm(z[i])), bound = abs_a[degree];
+            for (unsigned k = degree; k-- > 0;)
+            {
+                dp = dp * z[i] + p;
+                p = p * z[i] + a[k];
+                bound = bound * abs_z + abs_a[k];
+            }
+            bound *= 4.0 * DBL_EPSILON * degree;
+            if (_ll_cnorm(p) <= bound * bound)
+            {
+                converged[i] = 1;
+                continue;
+            }
+            double complex s = 0.0;
+            for (unsigned j = 0; j < degree; ++j)
+                if (j != i)
+                    s += 1.0 / (z[i] - z[j]);
+            double complex ratio = p / dp;
+            double complex w = ratio / (1.0 - ratio * s);
+            z[i] -= w;
+            converged[i] = _ll_cnorm(w) <= 1e-20 * _ll_cnorm(z[i]);
+        }
+        if (num_converged == degree)
+            break;
+    }
+}
+
+// Prepare finding the images of the lenses in coordinates centred on
+// origin.  The masses are divided by a.
+static void
+_ll_init_image_finder(struct _ll_image_finder *finder,
+                      const struct ll_lenses *lenses, double a,
+                      double complex origin)
+{
+    unsigned n = lenses->num_lenses;
+    unsigned size = n*n + n + 1;
+    finder->num_lenses = n;
+    finder->num_roots = 0;
+    finder->num_images = 0;
+    finder->origin = origin;
+    finder->lens_z = malloc(n * sizeof(double complex));
+    finder->mass = malloc(n * sizeof(double));
+    finder->q = malloc((n+1) * sizeof(double complex));
+    finder->p = malloc((n+1) * sizeof(double complex));
+    finder->r = malloc(n*(n+1) * sizeof(double complex));
+    finder->prod = malloc(size * sizeof(double complex));
+    finder->sum = malloc(size * sizeof(double complex));
+    finder->tmp = malloc(size * sizeof(double complex));
+    finder->poly = malloc(size * sizeof(double complex));
+    finder->abs_poly = malloc(size * sizeof(double));
+    finder->roots = malloc(size * sizeof(double complex));
+    finder->converged = malloc(size);
+    // Q and P are built up one lens at a time:
+    //     P <- P (z - z_k) + m_k Q,    Q <- Q (z - z_k)
+    finder->q[0] = 1.0;
+    for (unsigned k = 0; k < n; ++k)
+    {
+        double complex z_k =
+            lenses->lens[k].x + I * lenses->lens[k].y - origin;
+        double m_k = lenses->lens[k].mass / a;
+        finder->lens_z[k] = z_k;
+        finder->mass[k] = m_k;
+        finder->p[k] = 0.0;
+        for (unsigned i = k + 1; i-- > 0;)
+            finder->p[i] = (i ? finder->p[i-1] : 0.0) - z_k * finder->p[i] +
+                m_k * finder->q[i];
+        finder->q[k+1] = 0.0;
+        for (unsigned i = k + 2; i-- > 0;)
+            finder->q[i] = (i ? finder->q[i-1] : 0.0) - z_k * finder->q[i];
+    }
+}
+
+static void
+_ll_free_image_finder(struct _ll_image_finder *finder)
+{
+    free(finder->converged);
+    free(finder->roots);
+    free(finder->abs_poly);
+    free(finder->poly);
+    free(finder->tmp);
+    free(finder->sum);
+    free(finder->prod);
+    free(finder->r);
+    free(finder->p);
+    free(finder->q);
+    free(finder->mass);
+    free(finder->lens_z);
+}
+
+// Find the images of the source at zeta and append the ones not found
+// before to the num_images images in image_x, image_y and image_mag.
+// Returns the new number of images, which is at most max_images.  The
+// image magnifications are multiplied by mag_scale.
+static unsigned
+_ll_find_images(struct _ll_image_finder *finder, double complex zeta,
+                double *image_x, double *image_y, double *image_mag,
+                unsigned num_images, unsigned max_images, double mag_scale)
+{
+    unsigned n = finder->num_lenses;
+    const double complex *lens_z = finder->lens_z;
+    const double *mass = finder->mass;
+    double complex *r = finder->r;
+    zeta -= finder->origin;
+    for (unsigned k = 0; k < n; ++k)
+    {
+        double complex c = conj(zeta - lens_z[k]);
+        for (unsigned i = 0; i < n; ++i)
+            r[k*(n+1) + i] = c * finder->q[i] + finder->p[i];
+        r[k*(n+1) + n] = c;
+    }
+    // prod = prod_k R_k and sum = sum_k m_k prod_{l != k} R_l are built
+    // up one factor at a time.
+    double complex *prod = finder->prod, *sum = finder->sum;
+    double complex *tmp = finder->tmp;
+    for (unsigned i = 0; i <= n; ++i)
+        prod[i] = r[i];
+    sum[0] = mass[0];
+    for (unsigned k = 1; k < n; ++k)
+    {
+        unsigned degree = k*n;
+        _ll_poly_mul(sum, degree - n, r + k*(n+1), n, tmp);
+        for (unsigned i = 0; i <= degree; ++i)
+            sum[i] = tmp[i] + mass[k] * prod[i];
+        _ll_poly_mul(prod, degree, r + k*(n+1), n, tmp);
+        for (unsigned i = 0; i <= degree + n; ++i)
+            prod[i] = tmp[i];
+    }
+    unsigned degree = n*n + 1;
+    double complex *poly = finder->poly;
+    _ll_poly_mul(finder->q, n, sum, n*n - n, tmp);
+    poly[0] = -zeta * prod[0] - tmp[0];
+    for (unsigned i = 1; i < degree; ++i)
+        poly[i] = prod[i-1] - zeta * prod[i] - tmp[i];
+    poly[degree] = prod[degree-1];
+
+    // The degree drops if the source coincides with a lens.
+    double *abs_poly = finder->abs_poly;
+    double max_coeff = 0.0;
+    for (unsigned i = 0; i <= degree; ++i)
+    {
+        abs_poly[i] = sqrt(_ll_cnorm(poly[i]));
+        max_coeff = fmax(max_coeff, abs_poly[i]);
+    }
+    while (degree > 0 && abs_poly[degree] <= 1e-14 * max_coeff)
+        --degree;
+    // Newton steps stop once the residual is at the level of rounding
+    // errors, or if it is above the tolerance and doesn't shrink any
+    // more, as for spurious roots.  Images are the same if they are
+    // closer than 1e-7 relative to their position.  If the number of
+    // images differs from the last search, an image may have been lost
+    // in a cluster of roots started from the previous roots, and the
+    // roots are searched again from scratch.
+    double complex *roots = finder->roots;
+    double tolerance = LL_IMAGE_TOLERANCE * LL_IMAGE_TOLERANCE *
+        (1.0 + _ll_cnorm(zeta));
+    unsigned first_image = num_images;
+    int restart = finder->num_roots != degree;
+    for (;;)
+    {
+        if (restart)
+        {
+            double radius = 1.0 + sqrt(_ll_cnorm(zeta));
+            for (unsigned k = 0; k < n; ++k)
+                radius = fmax(radius, 1.0 + sqrt(_ll_cnorm(lens_z[k])));
+            for (unsigned i = 0; i < degree; ++i)
+                roots[i] = radius *
+                    cexp(I * (6.283185307179586*i / degree + 0.4));
+            finder->num_roots = degree;
+        }
+        _ll_aberth(poly, abs_poly, degree, roots, finder->converged);
+        num_images = first_image;
+        unsigned found = 0;
+        for (unsigned i = 0; i < degree && num_images < max_images; ++i)
+        {
+            double complex z = roots[i], g, residual;
+            double norm_residual = 0.0;
+            for (unsigned step = 0; ; ++step)
+            {
+                double last_norm = norm_residual;
+                residual = z - zeta;
+                g = 0.0;
+                for (unsigned k = 0; k < n; ++k)
                 {
-                    double area = 0.0;
-                    double x0 = vertices[0][0];
-                    double y0 = vertices[0][1];
-                    for(int i = 0; i < 7; ++i)
-                        if (valid_edges2 & 1<<i)
-                        {
-                            int i0 = vertex_indices2[i][0];
-                            int i1 = vertex_indices2[i][1];
-                            area += (vertices[i0][0]-x0) * (vertices[i1][1]-y0)
-                                - (vertices[i0][1]-y0) * (vertices[i1][0]-x0);
-                        }
-                    magpat[y*params->xpixels + x] += area * magnification;
+                    double complex d = 1.0 / conj(z - lens_z[k]);
+                    residual -= mass[k] * d;
+                    g += mass[k] * d * d;
                 }
+                norm_residual = _ll_cnorm(residual);
+                double det = 1.0 - _ll_cnorm(g);
+                if (step == LL_NEWTON_MAX_ITER || det == 0.0 ||
+                    norm_residual <= 1e-30 * (1.0 + _ll_cnorm(zeta)) ||
+                    (step >= 2 && norm_residual > 0.25 * last_norm &&
+                     norm_residual > tolerance))
+                    break;
+                z -= (residual - g * conj(residual)) / det;
             }
+            if (norm_residual > tolerance)
+                continue;
+            z += finder->origin;
+            unsigned j = 0;
+            while (j < num_images &&
+                   _ll_cnorm(z - (image_x[j] + I * image_y[j])) >
+                   1e-14 * (1.0 + _ll_cnorm(z)))
+                ++j;
+            if (j < first_image)
+                ++found;
+            if (j < num_images)
+                continue;
+            image_x[num_images] = creal(z);
+            image_y[num_images] = cimag(z);
+            image_mag[num_images] = mag_scale / (1.0 - _ll_cnorm(g));
+            ++num_images;
+            ++found;
+        }
+        if (restart || found == finder->num_images)
+        {
+            finder->num_images = found;
+            break;
         }
+        restart = 1;
     }
+    return num_images;
 }
 
+// The image finders of a thread: finder[0] uses the original
+// coordinates, finder[k+1] coordinates centred on lens k.
+struct _ll_image_finders
+{
+    unsigned num_lenses;
+    double a;
+    struct _ll_image_finder *finder;
+};
+
+// The lens equation with smooth matter, zeta = a z - sum ..., is
+// divided by a = 1 - kappa_c.  This scales the source positions and
+// the masses by 1/a and the magnifications by 1/a^2.
 static void
-_ll_rayshoot_level1(const struct ll_rayshooter *rs, void *magpat,
-                    const struct ll_rect *rect, int xrays, int yrays)
+_ll_init_image_finders(struct _ll_image_finders *finders,
+                       const struct ll_magpat_params *params)
 {
-    double *mag_coords = malloc((xrays+1)*(yrays+1) * 2*sizeof(double));
-    int *hit = malloc((xrays+1)*(yrays+1) * sizeof(int));
-    double width_per_xrays = rect->width / xrays;
-    double height_per_yrays = rect->height / yrays;
-    for (int j = 0, m = 0; j <= yrays; ++j)
-        for (int i = 0; i <= xrays; ++i, ++m)
-            hit[m] = ll_shoot_single_ray(rs->params,
-                                         rect->x + i*width_per_xrays,
-                                         rect->y + j*height_per_yrays,
-                                         mag_coords + (m<<1),
-                                         mag_coords + (m<<1) + 1);
-    int xrays2 = 2*xrays + 2;
-    double rect_area = width_per_xrays * height_per_yrays;
-    for (int j = 0, m = 0; j < yrays; ++j, ++m)
-        for (int i = 0; i < xrays; ++i, ++m)
-            if ((hit[m] | hit[m+1] | hit[m+xrays+1] | hit[m+xrays+2]) == 0x0F)
-            {
-                int n = m << 1;
-                double local_coords[4][2] =
-                    {{mag_coords[n], mag_coords[n+1]},
-                     {mag_coords[n+2], mag_coords[n+3]},
-                     {mag_coords[n+xrays2], mag_coords[n+xrays2+1]},
-                     {mag_coords[n+xrays2+2], mag_coords[n+xrays2+3]}};
-                switch (rs->kernel)
-                {
-                case LL_KERNEL_SIMPLE:
-                {
-                    double x = rect->x + i*width_per_xrays;
-                    double y = rect->y + j*height_per_yrays;
-                    struct ll_rect subrect
-                        = {x, y, width_per_xrays, height_per_yrays};
-                    ll_rayshoot_rect(rs->params, magpat, &subrect,
-                                     rs->refine_kernel, rs->refine_kernel);
-                    break;
-                }
-                case LL_KERNEL_BILINEAR:
-                {
-                    bool hit_all = (hit[m] & hit[m+1] & hit[m+xrays+1] &
-                                    hit[m+xrays+2]) == 0x0F;
-                    _ll_rayshoot_bilinear(rs->params, magpat,
-                                          local_coords, hit_all,
-                                          rs->refine_kernel);
-                    break;
-                }
-                case LL_KERNEL_TRIANGULATED:
-                    _ll_rayshoot_triangulated(rs->params, magpat, rect_area,
-                                              local_coords, rs->refine_kernel);
-                    break;
-                }
-            }
-    free(hit);
-    free(mag_coords);
+    const struct ll_lenses *lenses = &params->lenses;
+    unsigned n = lenses->num_lenses;
+    finders->num_lenses = n;
+    finders->a = 1.0 - params->kappa_c;
+    finders->finder = malloc((n+1) * sizeof(struct _ll_image_finder));
+    _ll_init_image_finder(finders->finder, lenses, finders->a, 0.0);
+    for (unsigned k = 0; k < n; ++k)
+        _ll_init_image_finder(finders->finder + k + 1, lenses, finders->a,
+                              lenses->lens[k].x + I * lenses->lens[k].y);
 }
 
 static void
-_ll_rayshoot_recursively(const struct ll_rayshooter *rs, void *magpat,
-                         const struct ll_rect *rect, int xrays, int yrays,
-                         unsigned level, double *progress)
+_ll_free_image_finders(struct _ll_image_finders *finders)
 {
-    if (rs->cancel)
-        return;
-    if (level > 1)
+    for (unsigned k = 0; k <= finders->num_lenses; ++k)
+        _ll_free_image_finder(finders->finder + k);
+    free(finders->finder);
+}
+
+// Find the images of the source at (source_x, source_y), trying the
+// finders in turn until the image counts are consistent.  The image
+// counts are only checked for positive masses.  Returns the number of
+// images, which is at most num_lenses^2 + 1.
+static unsigned
+_ll_find_all_images(struct _ll_image_finders *finders,
+                    double source_x, double source_y,
+                    double *image_x, double *image_y, double *image_mag)
+{
+    unsigned n = finders->num_lenses;
+    double a = finders->a;
+    double complex zeta = (source_x + I * source_y) / a;
+    unsigned num_images = 0;
+    for (unsigned f = 0; f <= n; ++f)
     {
-        struct ll_patches patches =
-            { *rect, xrays, yrays, level, rect->width/xrays, rect->height/yrays,
-              .hit = malloc(xrays*yrays * sizeof(uint8_t)), .num_patches = 0};
-        ll_get_subpatches(rs->params, &patches);
-        ll_rayshoot_subpatches(rs, magpat, &patches, progress);
-        free(patches.hit);
+        num_images = _ll_find_images(finders->finder + f, zeta, image_x,
+                                     image_y, image_mag, num_images,
+                                     n*n + 1, 1.0 / (a*a));
+        int parity = 0;
+        for (unsigned i = 0; i < num_images; ++i)
+            parity += image_mag[i] > 0.0 ? 1 : -1;
+        if (a < 0.0 || (num_images >= n + 1 && parity == 1 - (int)n))
+            break;
     }
-    else
-        _ll_rayshoot_level1(rs, magpat, rect, xrays, yrays);
+    return num_images;
+}
+
+struct _ll_point_images_job
+{
+    const struct ll_magpat_params *params;
+    unsigned num_sources;
+    const double *source_x, *source_y;
+    double *image_x, *image_y, *image_mag;
+    unsigned *num_images;
+    double *magnification;
+};
+
+static void
+_ll_point_source_images_worker(void *arg, unsigned thread,
+                               unsigned num_threads)
+{
+    struct _ll_point_images_job *job = arg;
+    unsigned n = job->params->lenses.num_lenses;
+    unsigned max_images = n*n + 1;
+    struct _ll_image_finders finders;
+    _ll_init_image_finders(&finders, job->params);
+    unsigned begin = (uint64_t)job->num_sources * thread / num_threads;
+    unsigned end = (uint64_t)job->num_sources * (thread + 1) / num_threads;
+    for (unsigned s = begin; s < end; ++s)
+    {
+        size_t offset = (size_t)s * max_images;
+        double *image_mag = job->image_mag + offset;
+        unsigned num_images =
+            _ll_find_all_images(&finders, job->source_x[s], job->source_y[s],
+                                job->image_x + offset, job->image_y + offset,
+                                image_mag);
+        double magnification = 0.0;
+        for (unsigned i = 0; i < num_images; ++i)
+            magnification += fabs(image_mag[i]);
+        job->num_images[s] = num_images;
+        job->magnification[s] = magnification;
+    }
+    _ll_free_image_finders(&finders);
 }
 
+// Find the images of num_sources point sources at the source plane
+// coordinates (source_x[s], source_y[s]) by solving the lens equation
+// for the point lenses and the smooth matter convergence of params.
+// The gamma, the lens tree and the components of params must be unset.
+// The image positions and signed magnifications of source s are
+// stored in image_x, image_y and image_mag at the indices
+// s*max_images ... s*max_images + num_images[s] - 1, where max_images
+// is num_lenses^2 + 1.  magnification[s] is the total magnification of
+// source s.
 extern void
-ll_get_subpatches(const struct ll_magpat_params *params,
-                  struct ll_patches *patches)
+ll_point_source_images(const struct ll_magpat_params *params,
+                       unsigned num_sources,
+                       const double *source_x, const double *source_y,
+                       double *image_x, double *image_y, double *image_mag,
+                       unsigned *num_images, double *magnification,
+                       unsigned num_threads)
 {
-    int xrays = patches->xrays;
-    int yrays = patches->yrays;
-    int *hit = malloc((xrays+3)*(yrays+3) * sizeof(int));
-    for (int j = -1, m = 0; j <= yrays+1; ++j)
-        for (int i = -1; i <= xrays+1; ++i, ++m)
-        {
-            double mag_x, mag_y;
-            hit[m] = ll_shoot_single_ray(
-                params,
-                patches->rect.x + i*patches->width_per_xrays,
-                patches->rect.y + j*patches->height_per_yrays,
-                &mag_x, &mag_y);
-        }
-    patches->num_patches = 0;
-    uint8_t* hit_patches = patches->hit;
-    for (int j = 0, m = xrays+4, n = 0; j < yrays; ++j, m += 3)
-        for (int i = 0; i < xrays; ++i, ++m, ++n)
+    struct _ll_point_images_job job =
+        {params, num_sources, source_x, source_y, image_x, image_y,
+         image_mag, num_images, magnification};
+    if (params->lenses.num_lenses == 0)
+    {
+        double a = 1.0 - params->kappa_c;
+        for (unsigned s = 0; s < num_sources; ++s)
         {
-            hit_patches[n] = (hit[m-xrays-3] | hit[m-xrays-2] |
-                              hit[m-1] | hit[m] | hit[m+1] | hit[m+2] |
-                              hit[m+xrays+2] | hit[m+xrays+3] |
-                              hit[m+xrays+4] | hit[m+xrays+5] |
-                              hit[m+2*xrays+6] | hit[m+2*xrays+7]) == 0x0F;
-            if (hit_patches[n])
-                ++patches->num_patches;
+            image_x[s] = source_x[s] / a;
+            image_y[s] = source_y[s] / a;
+            image_mag[s] = 1.0 / (a*a);
+            num_images[s] = 1;
+            magnification[s] = fabs(image_mag[s]);
         }
-    free(hit);
+        return;
+    }
+    if (num_threads > num_sources / LL_RAY_BLOCK)
+        num_threads = num_sources / LL_RAY_BLOCK ?
+            num_sources / LL_RAY_BLOCK : 1;
+    _ll_pool_run(_ll_point_source_images_worker, &job, num_threads);
 }
 
-extern void
-ll_rayshoot_subpatches(const struct ll_rayshooter *rs, void *magpat,
-                       const struct ll_patches *patches, double *progress)
+// Finite source magnifications by contour integration.  The images of
+// points on the source boundary zeta_0 + r exp(i theta) are found for a
+// set of angles theta, and the images of neighbouring angles are linked
+// to image contours by matching each image with the nearest image of
+// the same parity.  By Green's theorem, the area enclosed by an image
+// contour is the sum of 1/2 Im(conj(z_j) z_(j+1)) over its segments.
+// Negative parity images run through their contours in the opposite
+// direction, so their segments count negatively.  Where the boundary
+// crosses a caustic, a pair of images of opposite parity appears or
+// disappears between two angles, and the contour is closed by a segment
+// joining the pair.  Each interval of angles is halved until the areas
+// of the interval and of its two halves agree, and until the closing
+// segments are short, which concentrates the samples near caustic
+// crossings.
+
+#define LL_CONTOUR_INTERVALS 32
+#define LL_CONTOUR_MAX_DEPTH 16
+
+struct _ll_contour_point
 {
-    double progress_inc = 1.0 / patches->num_patches;
-    for (int j = 0, n = 0; j < patches->yrays; ++j)
-        for (int i = 0; i < patches->xrays; ++i, ++n)
-            if (patches->hit[n])
+    unsigned num_images;
+    double complex *z;
+    double *mag;
+};
+
+struct _ll_contour
+{
+    struct _ll_image_finders finders;
+    double complex centre;
+    double radius;
+    double tolerance, chord_tolerance;
+    double *image_x, *image_y;
+    char *used_a, *used_b;
+    // the end points of the initial intervals and one midpoint for
+    // each recursion depth
+    struct _ll_contour_point point[LL_CONTOUR_INTERVALS +
+                                  LL_CONTOUR_MAX_DEPTH];
+};
+
+static void
+_ll_init_contour(struct _ll_contour *contour,
+                 const struct ll_magpat_params *params)
+{
+    unsigned max_images =
+        params->lenses.num_lenses * params->lenses.num_lenses + 1;
+    _ll_init_image_finders(&contour->finders, params);
+    contour->image_x = malloc(max_images * sizeof(double));
+    contour->image_y = malloc(max_images * sizeof(double));
+    contour->used_a = malloc(max_images);
+    contour->used_b = malloc(max_images);
+    for (unsigned i = 0; i < LL_CONTOUR_INTERVALS + LL_CONTOUR_MAX_DEPTH; ++i)
+    {
+        contour->point[i].z = malloc(max_images * sizeof(double complex));
+        contour->point[i].mag = malloc(max_images * sizeof(double));
+    }
+}
+
+static void
+_ll_free_contour(struct _ll_contour *contour)
+{
+    for (unsigned i = 0; i < LL_CONTOUR_INTERVALS + LL_CONTOUR_MAX_DEPTH; ++i)
+    {
+        free(contour->point[i].mag);
+        free(contour->point[i].z);
+    }
+    free(contour->used_b);
+    free(contour->used_a);
+    free(contour->image_y);
+    free(contour->image_x);
+    _ll_free_image_finders(&contour->finders);
+}
+
+static void
+_ll_contour_images(struct _ll_contour *contour, double theta,
+                   struct _ll_contour_point *point)
+{
+    point->num_images = _ll_find_all_images(
+        &contour->finders,
+        creal(contour->centre) + contour->radius * cos(theta),
+        cimag(contour->centre) + contour->radius * sin(theta),
+        contour->image_x, contour->image_y, point->mag);
+    for (unsigned i = 0; i < point->num_images; ++i)
+        point->z[i] = contour->image_x[i] + I * contour->image_y[i];
+}
+
+// Join the images of point not marked in used to pairs of opposite
+// parity and return the area of the closing segments.  sign is 1 for
+// pairs appearing at point and -1 for pairs disappearing.  *ok is
+// cleared if an image is left without a partner, and *chord is raised
+// to the largest squared length of the closing segments.
+static double
+_ll_contour_close(const struct _ll_contour_point *point, char *used,
+                  double sign, int *ok, double *chord)
+{
+    double area = 0.0;
+    for (unsigned i = 0; i < point->num_images; ++i)
+    {
+        if (used[i] || point->mag[i] < 0.0)
+            continue;
+        double best = DBL_MAX;
+        unsigned best_j = 0;
+        for (unsigned j = 0; j < point->num_images; ++j)
+            if (!used[j] && point->mag[j] < 0.0 &&
+                _ll_cnorm(point->z[i] - point->z[j]) < best)
             {
-                double x = patches->rect.x + i*patches->width_per_xrays;
-                double y = patches->rect.y + j*patches->height_per_yrays;
-                struct ll_rect subrect
-                    = {x, y, patches->width_per_xrays, patches->height_per_yrays};
-                _ll_rayshoot_recursively(rs, magpat, &subrect, rs->refine,
-                                         rs->refine, patches->level-1, 0);
-                if (progress)
-                    *progress += progress_inc;
+                best = _ll_cnorm(point->z[i] - point->z[j]);
+                best_j = j;
             }
+        if (best == DBL_MAX)
+            break;
+        used[i] = used[best_j] = 1;
+        area += 0.5 * sign * cimag(conj(point->z[best_j]) * point->z[i]);
+        *chord = fmax(*chord, best);
+    }
+    for (unsigned i = 0; i < point->num_images; ++i)
+        if (!used[i])
+            *ok = 0;
+    return area;
 }
 
-static void
-_ll_scale_magpat(const struct ll_rayshooter *rs, void *magpat,
-                 const struct ll_rect *rect, int xrays, int yrays,
-                 unsigned level)
+// Return the area of the image contour segments between the images of
+// the points a and b.  *ok is cleared if the images can't be linked,
+// and *chord is set to the largest squared length of the segments
+// closing contours at caustic crossings.
+static double
+_ll_contour_segment(struct _ll_contour *contour,
+                    const struct _ll_contour_point *a,
+                    const struct _ll_contour_point *b, int *ok,
+                    double *chord)
 {
-    switch (rs->kernel)
+    char *used_a = contour->used_a, *used_b = contour->used_b;
+    for (unsigned i = 0; i < a->num_images; ++i)
+        used_a[i] = 0;
+    for (unsigned j = 0; j < b->num_images; ++j)
+        used_b[j] = 0;
+    unsigned num_links =
+        a->num_images < b->num_images ? a->num_images : b->num_images;
+    double area = 0.0;
+    for (unsigned link = 0; link < num_links; ++link)
     {
-    case LL_KERNEL_SIMPLE:
-    case LL_KERNEL_BILINEAR:
+        double best = DBL_MAX;
+        unsigned best_i = 0, best_j = 0;
+        for (unsigned i = 0; i < a->num_images; ++i)
+            if (!used_a[i])
+                for (unsigned j = 0; j < b->num_images; ++j)
+                    if (!used_b[j] && (a->mag[i] < 0.0) == (b->mag[j] < 0.0)
+                        && _ll_cnorm(a->z[i] - b->z[j]) < best)
+                    {
+                        best = _ll_cnorm(a->z[i] - b->z[j]);
+                        best_i = i;
+                        best_j = j;
+                    }
+        if (best == DBL_MAX)
+            break;
+        used_a[best_i] = used_b[best_j] = 1;
+        double parity = a->mag[best_i] < 0.0 ? -0.5 : 0.5;
+        area += parity * cimag(conj(a->z[best_i]) * b->z[best_j]);
+    }
+    *chord = 0.0;
+    area += _ll_contour_close(a, used_a, -1.0, ok, chord);
+    area += _ll_contour_close(b, used_b, 1.0, ok, chord);
+    return area;
+}
+
+// Return the area of the image contours between the angles theta_a and
+// theta_b, where area is the estimate from the points a and b alone.
+static double
+_ll_contour_interval(struct _ll_contour *contour,
+                     double theta_a, double theta_b,
+                     const struct _ll_contour_point *a,
+                     const struct _ll_contour_point *b,
+                     double area, int ok, unsigned depth)
+{
+    struct _ll_contour_point *m = contour->point + LL_CONTOUR_INTERVALS + depth;
+    double theta_m = 0.5 * (theta_a + theta_b);
+    _ll_contour_images(contour, theta_m, m);
+    int ok_a = 1, ok_b = 1;
+    double chord_a, chord_b;
+    double area_a = _ll_contour_segment(contour, a, m, &ok_a, &chord_a);
+    double area_b = _ll_contour_segment(contour, m, b, &ok_b, &chord_b);
+    double halves = area_a + area_b;
+    if (ok && ok_a && ok_b && fabs(halves - area) <=
+        contour->tolerance * (theta_b - theta_a))
     {
-        unsigned pixels = rs->params->xpixels * rs->params->ypixels;
-        double density = xrays * yrays;
-        for (unsigned i = 0; i < level - 1; ++i)
-            density *= rs->refine * rs->refine;
-        density *= rs->refine_kernel * rs->refine_kernel;
-        density *= rs->params->region.width * rs->params->region.height;
-        density /= rect->width * rect->height * pixels;
-        density = 1.0/density;
-        float *fpat = magpat;
-        uint32_t *ipat = magpat;
-        for (unsigned i = 0; i < pixels; ++i)
-            fpat[i] = ipat[i] * density;
-        break;
+        // Away from caustic crossings, the polygon misses an area
+        // proportional to the square of the length of its segments,
+        // which is corrected for by Richardson extrapolation.
+        if (chord_a == 0.0 && chord_b == 0.0)
+            return halves + (halves - area) / 3.0;
+        if (fmax(chord_a, chord_b) <= contour->chord_tolerance)
+            return halves;
     }
-    case LL_KERNEL_TRIANGULATED:
-        break;
+    if (depth + 1 == LL_CONTOUR_MAX_DEPTH)
+        return halves;
+    return _ll_contour_interval(contour, theta_a, theta_m, a, m,
+                                area_a, ok_a, depth + 1) +
+        _ll_contour_interval(contour, theta_m, theta_b, m, b,
+                             area_b, ok_b, depth + 1);
+}
+
+// Return the area of the images of the disc with the given centre and
+// radius.  The relative error is about tolerance.
+static double
+_ll_contour_area(struct _ll_contour *contour, double complex centre,
+                 double radius, double tolerance)
+{
+    const double two_pi = 6.283185307179586;
+    contour->centre = centre;
+    contour->radius = radius;
+    struct _ll_contour_point *point = contour->point;
+    for (unsigned k = 0; k < LL_CONTOUR_INTERVALS; ++k)
+        _ll_contour_images(contour, two_pi * k / LL_CONTOUR_INTERVALS,
+                           point + k);
+    double area[LL_CONTOUR_INTERVALS];
+    int ok[LL_CONTOUR_INTERVALS];
+    double estimate = 0.0;
+    for (unsigned k = 0; k < LL_CONTOUR_INTERVALS; ++k)
+    {
+        double chord;
+        ok[k] = 1;
+        area[k] = _ll_contour_segment(
+            contour, point + k, point + (k + 1) % LL_CONTOUR_INTERVALS,
+            ok + k, &chord);
+        estimate += area[k];
+    }
+    // The error of a closing segment of length c is of the order of
+    // c^3, so its squared length is limited to the tolerated area.
+    contour->chord_tolerance =
+        tolerance * fmax(fabs(estimate), 0.5 * two_pi * radius * radius);
+    contour->tolerance = contour->chord_tolerance / two_pi;
+    double total = 0.0;
+    for (unsigned k = 0; k < LL_CONTOUR_INTERVALS; ++k)
+        total += _ll_contour_interval(
+            contour, two_pi * k / LL_CONTOUR_INTERVALS,
+            two_pi * (k + 1) / LL_CONTOUR_INTERVALS,
+            point + k, point + (k + 1) % LL_CONTOUR_INTERVALS,
+            area[k], ok[k], 0);
+    return total;
+}
+
+struct _ll_finite_source_job
+{
+    const struct ll_magpat_params *params;
+    unsigned num_sources;
+    const double *source_x, *source_y;
+    double source_r, limb_darkening;
+    unsigned num_annuli;
+    double tolerance;
+    double *magnification;
+};
+
+// The cumulative flux within the radius sqrt(s) source_r of a source
+// with linear limb darkening u, in units of pi source_r^2 times the
+// central intensity.
+static double
+_ll_limb_darkened_flux(double s, double u)
+{
+    return (1.0 - u) * s + 2.0/3.0 * u * (1.0 - pow(1.0 - s, 1.5));
+}
+
+static void
+_ll_finite_source_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_finite_source_job *job = arg;
+    double r = job->source_r, u = job->limb_darkening;
+    unsigned num_annuli = u == 0.0 ? 1 : job->num_annuli;
+    struct _ll_contour *contour = malloc(sizeof(struct _ll_contour));
+    _ll_init_contour(contour, job->params);
+    unsigned begin = (uint64_t)job->num_sources * thread / num_threads;
+    unsigned end = (uint64_t)job->num_sources * (thread + 1) / num_threads;
+    for (unsigned s = begin; s < end; ++s)
+    {
+        double complex centre = job->source_x[s] + I * job->source_y[s];
+        // The source is split into annuli, narrower towards the limb,
+        // each of constant intensity.
+        double flux = 0.0, last_area = 0.0, last_s = 0.0;
+        for (unsigned i = 1; i <= num_annuli; ++i)
+        {
+            double t = 1.0 - (double)i / num_annuli;
+            double s_i = 1.0 - t*t;
+            double area = _ll_contour_area(contour, centre, r * sqrt(s_i),
+                                           job->tolerance);
+            double intensity = (_ll_limb_darkened_flux(s_i, u) -
+                                _ll_limb_darkened_flux(last_s, u)) /
+                (s_i - last_s);
+            flux += intensity * (area - last_area);
+            last_area = area;
+            last_s = s_i;
+        }
+        job->magnification[s] = flux /
+            (3.141592653589793 * r * r * _ll_limb_darkened_flux(1.0, u));
     }
+    _ll_free_contour(contour);
+    free(contour);
 }
 
+// Compute the magnifications of num_sources sources of radius source_r
+// centred at (source_x[s], source_y[s]) by contour integration, for
+// the point lenses and the smooth matter convergence of params, like
+// ll_point_source_images().  The source has linear limb darkening
+// with the coefficient limb_darkening, and is split into num_annuli
+// annuli of constant intensity if it is not zero.  tolerance is the
+// relative error of the image areas.
 extern void
-ll_finalise_subpatches(const struct ll_rayshooter *rs, void *magpat,
-                       const struct ll_patches *patches)
+ll_finite_source_magnifications(const struct ll_magpat_params *params,
+                                unsigned num_sources,
+                                const double *source_x,
+                                const double *source_y, double source_r,
+                                double limb_darkening, unsigned num_annuli,
+                                double tolerance, double *magnification,
+                                unsigned num_threads)
 {
-    _ll_scale_magpat(rs, magpat, &patches->rect,
-                     patches->xrays, patches->yrays, patches->level);
+    struct _ll_finite_source_job job =
+        {params, num_sources, source_x, source_y, source_r, limb_darkening,
+         num_annuli, tolerance, magnification};
+    if (params->lenses.num_lenses == 0)
+    {
+        double a = 1.0 - params->kappa_c;
+        for (unsigned s = 0; s < num_sources; ++s)
+            magnification[s] = 1.0 / (a*a);
+        return;
+    }
+    if (num_threads > num_sources)
+        num_threads = num_sources ? num_sources : 1;
+    _ll_pool_run(_ll_finite_source_worker, &job, num_threads);
+}
+
+static void
+_ll_rayshoot_deflected_patch(const struct ll_rayshooter *rs, void *magpat,
+                             struct _ll_hit_buffer *buffer,
+                             const struct ll_patches *patches, unsigned n,
+                             const double *source_x, const double *source_y)
+{
+    struct ll_rect subrect;
+    int first, last;
+    _ll_patch_grid(rs, patches, n, &subrect, &first, &last);
+    int refine = rs->refine;
+    if (patches->level > 2)
+    {
+        struct ll_patches subpatches =
+            { subrect, refine, refine, patches->level - 1,
+              subrect.width/refine, subrect.height/refine,
+              .hit = malloc(refine*refine * sizeof(uint8_t)),
+              .num_patches = 0};
+        ll_get_subpatches_deflected(rs->params, &subpatches,
+                                    source_x, source_y);
+        _ll_rayshoot_subpatches(rs, rs->params, magpat, buffer, &subpatches,
+                                0);
+        free(subpatches.hit);
+    }
+    else
+    {
+        unsigned size = (refine+1)*(refine+1);
+        double *mag_x = malloc(size * sizeof(double));
+        double *mag_y = malloc(size * sizeof(double));
+        int *hit = malloc(size * sizeof(int));
+        _ll_source_to_pixels(rs->params, size, source_x, source_y,
+                             mag_x, mag_y, hit);
+        _ll_rayshoot_kernels(rs, rs->params, magpat, buffer, &subrect,
+                             refine, refine, mag_x, mag_y, hit);
+        free(hit);
+        free(mag_y);
+        free(mag_x);
+    }
 }
 
 extern void
-ll_rayshoot(const struct ll_rayshooter *rs, void *magpat,
-            const struct ll_rect *rect, int xrays, int yrays,
-            unsigned levels, double *progress)
+ll_rayshoot_deflected(const struct ll_rayshooter *rs, void *magpat,
+                      const struct ll_patches *patches,
+                      const unsigned *indices, unsigned num_indices,
+                      const double *source_x, const double *source_y,
+                      double *progress, unsigned num_threads)
 {
-    if (progress)
-        *progress = 0.0;
-    _ll_rayshoot_recursively(rs, magpat, rect, xrays, yrays,
-                             levels - 1, progress);
-    _ll_scale_magpat(rs, magpat, rect, xrays, yrays, levels - 1);
+    unsigned *tasks = malloc(num_indices * sizeof(unsigned));
+    for (unsigned k = 0; k < num_indices; ++k)
+        tasks[k] = k;
+    struct _ll_rayshoot_job job =
+        {.rs = rs, .patches = patches, .tasks = tasks, .progress = progress,
+         .progress_inc = 1.0 / patches->num_patches, .indices = indices,
+         .source_x = source_x, .source_y = source_y,
+         .grid_size = ll_patch_grid_size(rs, patches)};
+    _ll_run_rayshoot_job(&job, magpat, num_indices, num_threads);
+    free(tasks);
 }
 
 extern void
@@ -621,12 +3731,13 @@ ll_source_images(const struct ll_magpat_params *params, uint8_t *buf,
     double height_per_yrays = rect->height / yrays;
     double x_inc = width_per_xrays / refine;
     double y_inc = height_per_yrays / refine;
-    int buf_inc = 255 / (refine*refine);
+    int samples = refine*refine;
     for (int j = 0, m = 0; j < xrays; ++j)
         for (int i = 0; i < yrays; ++i, ++m)
         {
             double x0 = rect->x + i*width_per_xrays;
             double y = rect->y + j*height_per_yrays;
+            int count = 0;
             for (int k = 0; k < refine; ++k)
             {
                 double x = x0;
@@ -636,13 +3747,91 @@ ll_source_images(const struct ll_magpat_params *params, uint8_t *buf,
                     ll_shoot_single_ray(params, x, y, &mag_x, &mag_y);
                     double dx = source_x - mag_x;
                     double dy = source_y - mag_y;
-                    if (dx*dx + dy*dy < r_squared)
-                        buf[m] += buf_inc;
+                    count += dx*dx + dy*dy < r_squared;
                     x += x_inc;
                 }
                 y += y_inc;
             }
+            buf[m] += count * 255 / samples;
+        }
+}
+
+// Rendering the images of many source positions by looking up the
+// cached source plane coordinates of a lattice of rays.  The samples
+// of each image pixel are stored consecutively, together with their
+// bounding box (min_x, min_y, max_x, max_y).  The pixels are processed
+// in blocks of LL_RAY_BLOCK pixels, rendering all frames for a block,
+// so the samples are read from memory only once.  Pixels whose
+// bounding box misses a source, or is covered by it completely, don't
+// need to look at the samples.
+
+struct _ll_images_job
+{
+    const double *source_x, *source_y, *bbox;
+    unsigned num_pixels, samples, num_frames;
+    const double *frame_x, *frame_y, *frame_r;
+    uint8_t *buf;
+};
+
+static void
+_ll_render_images_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    const struct _ll_images_job *job = arg;
+    unsigned samples = job->samples;
+    unsigned begin = (uint64_t)job->num_pixels * thread / num_threads;
+    unsigned end = (uint64_t)job->num_pixels * (thread + 1) / num_threads;
+    for (unsigned m0 = begin; m0 < end; m0 += LL_RAY_BLOCK)
+    {
+        unsigned m1 = m0 + LL_RAY_BLOCK < end ? m0 + LL_RAY_BLOCK : end;
+        for (unsigned f = 0; f < job->num_frames; ++f)
+        {
+            double fx = job->frame_x[f];
+            double fy = job->frame_y[f];
+            double r_squared = job->frame_r[f] * job->frame_r[f];
+            uint8_t *buf = job->buf + (size_t)f*job->num_pixels;
+            for (unsigned m = m0; m < m1; ++m)
+            {
+                const double *bbox = job->bbox + 4*(size_t)m;
+                double ex = fmax(fmax(bbox[0] - fx, fx - bbox[2]), 0.0);
+                double ey = fmax(fmax(bbox[1] - fy, fy - bbox[3]), 0.0);
+                double gx = fmax(fx - bbox[0], bbox[2] - fx);
+                double gy = fmax(fy - bbox[1], bbox[3] - fy);
+                if (ex*ex + ey*ey >= r_squared)
+                    buf[m] = 0;
+                else if (gx*gx + gy*gy < r_squared)
+                    buf[m] = 255;
+                else
+                {
+                    const double *x = job->source_x + (size_t)m*samples;
+                    const double *y = job->source_y + (size_t)m*samples;
+                    unsigned count = 0;
+                    for (unsigned s = 0; s < samples; ++s)
+                    {
+                        double dx = fx - x[s];
+                        double dy = fy - y[s];
+                        count += dx*dx + dy*dy < r_squared;
+                    }
+                    buf[m] = count * 255 / samples;
+                }
+            }
         }
+    }
+}
+
+extern void
+ll_render_source_images(const double *source_x, const double *source_y,
+                        const double *bbox, unsigned num_pixels,
+                        unsigned samples, unsigned num_frames,
+                        const double *frame_x, const double *frame_y,
+                        const double *frame_r, uint8_t *buf,
+                        unsigned num_threads)
+{
+    struct _ll_images_job job =
+        {source_x, source_y, bbox, num_pixels, samples, num_frames,
+         frame_x, frame_y, frame_r, buf};
+    if (num_threads > num_pixels / LL_RAY_BLOCK)
+        num_threads = num_pixels / LL_RAY_BLOCK ? num_pixels / LL_RAY_BLOCK : 1;
+    _ll_pool_run(_ll_render_images_worker, &job, num_threads);
 }
 
 static void
@@ -751,8 +3940,12 @@ ll_light_curve(const struct ll_magpat_params *params, const float *magpat,
 {
     double mag_x = (x0 - params->region.x) * params->pixels_per_width;
     double mag_y = (y0 - params->region.y) * params->pixels_per_height;
-    double dx = (x1 - x0) * params->pixels_per_width / (samples - 1);
-    double dy = (y1 - y0) * params->pixels_per_height / (samples - 1);
+    double dx = 0.0, dy = 0.0;
+    if (samples > 1)
+    {
+        dx = (x1 - x0) * params->pixels_per_width / (samples - 1);
+        dy = (y1 - y0) * params->pixels_per_height / (samples - 1);
+    }
     for (unsigned i = 0; i < samples; ++i)
     {
         if (mag_x < 0.5 || mag_x >= params->xpixels - 0.5 ||
@@ -762,7 +3955,7 @@ ll_light_curve(const struct ll_magpat_params *params, const float *magpat,
         {
             int ix = lrint(mag_x) - 1;
             int iy = lrint(mag_y) - 1;
-            int index = iy*params->xpixels + ix;
+            size_t index = (size_t)iy*params->xpixels + ix;
             double frac_x = mag_x - 0.5 - ix;
             double frac_y = mag_y - 0.5 - iy;
             curve[i] = (1.0 - frac_x) * (1.0 - frac_y) * magpat[index]
@@ -774,3 +3967,165 @@ ll_light_curve(const struct ll_magpat_params *params, const float *magpat,
         mag_y += dy;
     }
 }
+
+// Light curves are handed out to the threads in contiguous ranges of
+// at least LL_CURVE_BLOCK curves.
+#define LL_CURVE_BLOCK 64
+
+struct _ll_light_curves_job
+{
+    const struct ll_magpat_params *params;
+    const float *magpat;
+    unsigned num_curves;
+    const double *x0, *y0, *x1, *y1;
+    const unsigned *samples;
+    unsigned max_samples;
+    float *curves;
+};
+
+static void
+_ll_light_curves_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_light_curves_job *job = arg;
+    unsigned begin = (uint64_t)job->num_curves * thread / num_threads;
+    unsigned end = (uint64_t)job->num_curves * (thread + 1) / num_threads;
+    for (unsigned c = begin; c < end; ++c)
+    {
+        float *curve = job->curves + (size_t)c * job->max_samples;
+        unsigned samples = job->max_samples;
+        if (job->samples && job->samples[c] < samples)
+            samples = job->samples[c];
+        ll_light_curve(job->params, job->magpat, curve, samples,
+                       job->x0[c], job->y0[c], job->x1[c], job->y1[c]);
+        for (unsigned i = samples; i < job->max_samples; ++i)
+            curve[i] = NAN;
+    }
+}
+
+// Extract num_curves light curves like ll_light_curve().  Curve c runs
+// from (x0[c], y0[c]) to (x1[c], y1[c]) and is stored in the row
+// curves + c*max_samples.  It has samples[c] samples, or max_samples
+// if samples is null, and the rest of the row is filled with NaN.
+extern void
+ll_light_curves(const struct ll_magpat_params *params, const float *magpat,
+                unsigned num_curves, const double *x0, const double *y0,
+                const double *x1, const double *y1, const unsigned *samples,
+                unsigned max_samples, float *curves, unsigned num_threads)
+{
+    struct _ll_light_curves_job job =
+        {params, magpat, num_curves, x0, y0, x1, y1, samples, max_samples,
+         curves};
+    if (num_threads > num_curves / LL_CURVE_BLOCK)
+        num_threads = num_curves / LL_CURVE_BLOCK ?
+            num_curves / LL_CURVE_BLOCK : 1;
+    _ll_pool_run(_ll_light_curves_worker, &job, num_threads);
+}
+
+// Sampling magnification patterns at arbitrary points
+//
+// The pixel values are taken to be the magnifications at the pixel
+// centres.  The bilinear mode interpolates between the four nearest
+// pixel centres, and the bicubic mode uses the Catmull-Rom spline
+// through the 4 x 4 nearest ones, which has a continuous derivative but
+// may overshoot next to caustics.  Beyond the outermost pixel centres,
+// the edge pixels are repeated, so the whole pattern region can be
+// sampled.
+
+struct _ll_sample_job
+{
+    const struct ll_magpat_params *params;
+    const float *magpat;
+    unsigned num_points;
+    const double *x, *y;
+    enum ll_interpolation interpolation;
+    float *values;
+};
+
+// Compute the Catmull-Rom weights of the four pixels around the
+// fraction t of the way between the second and the third.
+static inline void
+_ll_cubic_weights(double t, double *w)
+{
+    w[0] = ((-0.5*t + 1.0)*t - 0.5)*t;
+    w[1] = (1.5*t - 2.5)*t*t + 1.0;
+    w[2] = ((-1.5*t + 2.0)*t + 0.5)*t;
+    w[3] = (0.5*t - 0.5)*t*t;
+}
+
+static inline int
+_ll_clamp_index(int i, int n)
+{
+    return i < 0 ? 0 : i >= n ? n - 1 : i;
+}
+
+static void
+_ll_sample_worker(void *arg, unsigned thread, unsigned num_threads)
+{
+    struct _ll_sample_job *job = arg;
+    const struct ll_magpat_params *params = job->params;
+    const float *magpat = job->magpat;
+    int xpixels = params->xpixels, ypixels = params->ypixels;
+    unsigned begin = (uint64_t)job->num_points * thread / num_threads;
+    unsigned end = (uint64_t)job->num_points * (thread + 1) / num_threads;
+    for (unsigned k = begin; k < end; ++k)
+    {
+        double u = (job->x[k] - params->region.x) * params->pixels_per_width;
+        double v = (job->y[k] - params->region.y) * params->pixels_per_height;
+        if (!(u >= 0.0 && u <= xpixels && v >= 0.0 && v <= ypixels))
+        {
+            job->values[k] = NAN;
+            continue;
+        }
+        // (i, j) is the pixel centre below and to the left of the point.
+        int i = (int)floor(u - 0.5), j = (int)floor(v - 0.5);
+        double frac_x = u - 0.5 - i, frac_y = v - 0.5 - j;
+        double value = 0.0;
+        if (job->interpolation == LL_INTERPOLATION_BICUBIC)
+        {
+            double wx[4], wy[4];
+            _ll_cubic_weights(frac_x, wx);
+            _ll_cubic_weights(frac_y, wy);
+            int ix[4];
+            for (int a = 0; a < 4; ++a)
+                ix[a] = _ll_clamp_index(i - 1 + a, xpixels);
+            for (int b = 0; b < 4; ++b)
+            {
+                const float *row =
+                    magpat + (size_t)_ll_clamp_index(j - 1 + b, ypixels) *
+                    xpixels;
+                value += wy[b] * (wx[0]*row[ix[0]] + wx[1]*row[ix[1]] +
+                                  wx[2]*row[ix[2]] + wx[3]*row[ix[3]]);
+            }
+        }
+        else
+        {
+            int i0 = _ll_clamp_index(i, xpixels);
+            int i1 = _ll_clamp_index(i + 1, xpixels);
+            const float *row0 =
+                magpat + (size_t)_ll_clamp_index(j, ypixels) * xpixels;
+            const float *row1 =
+                magpat + (size_t)_ll_clamp_index(j + 1, ypixels) * xpixels;
+            value = (1.0 - frac_y) * ((1.0 - frac_x) * row0[i0] +
+                                      frac_x * row0[i1]) +
+                frac_y * ((1.0 - frac_x) * row1[i0] + frac_x * row1[i1]);
+        }
+        job->values[k] = value;
+    }
+}
+
+// Sample the pattern magpat at the num_points source plane points
+// (x[k], y[k]) with the given interpolation and store the results in
+// values.  Points outside the pattern region give NaN.
+extern void
+ll_sample_magpat(const struct ll_magpat_params *params, const float *magpat,
+                 unsigned num_points, const double *x, const double *y,
+                 enum ll_interpolation interpolation, float *values,
+                 unsigned num_threads)
+{
+    struct _ll_sample_job job =
+        {params, magpat, num_points, x, y, interpolation, values};
+    if (num_threads > num_points / LL_RAY_BLOCK)
+        num_threads = num_points / LL_RAY_BLOCK ?
+            num_points / LL_RAY_BLOCK : 1;
+    _ll_pool_run(_ll_sample_worker, &job, num_threads);
+}
@@ -4,6 +4,7 @@
 #ifndef LL_LL_H
 #define LL_LL_H
 
+#include <float.h>
 #include <stdbool.h>
 #include <stdint.h>
 
@@ -18,17 +19,87 @@ struct ll_lenses
     struct ll_lens *lens;
 };
 
+// Analytic extended lens components.  A singular isothermal sphere
+// with Einstein radius strength deflects by strength towards its
+// centre, or by strength*radius/distance beyond the truncation radius
+// if radius > 0.  A Plummer sphere of the given strength (Einstein
+// radius squared, as the mass of a point lens) and core radius
+// deflects by strength*distance/(distance^2 + radius^2).
+enum ll_component_type
+{
+    LL_COMPONENT_SIS,
+    LL_COMPONENT_PLUMMER
+};
+
+struct ll_component
+{
+    enum ll_component_type type;
+    double x, y, strength, radius;
+};
+
+struct ll_components
+{
+    unsigned num_components;
+    struct ll_component *component;
+};
+
 struct ll_rect
 {
     double x, y, width, height;
 };
 
+struct ll_lens_tree;
+
+extern struct ll_lens_tree *
+ll_new_lens_tree(const struct ll_lenses *lenses, double opening_angle);
+
+extern void
+ll_free_lens_tree(struct ll_lens_tree *tree);
+
+#define LL_FAR_FIELD_ORDER 10
+
+struct ll_far_field
+{
+    double x, y;
+    double coeff[LL_FAR_FIELD_ORDER][2];
+};
+
+// Deflection of a set of static lenses on a lattice of lens plane
+// points, filled in lazily by the rays hitting the lattice points.
+// Entries not computed yet hold LL_NOT_COMPUTED.  The deflection of
+// the static lenses is multiplied by scale before it is used.
+#define LL_NOT_COMPUTED DBL_MAX
+
+struct ll_static_field
+{
+    struct ll_lenses lenses;
+    const struct ll_lens_tree *tree;
+    double x, y, dx, dy;
+    unsigned width, height;
+    double *deflection;
+    double scale;
+};
+
 struct ll_magpat_params
 {
     struct ll_lenses lenses;
     struct ll_rect region;
     unsigned xpixels, ypixels;
     double pixels_per_width, pixels_per_height;
+    const struct ll_lens_tree *tree;
+    const struct ll_far_field *far_field;
+    struct ll_static_field *static_field;
+    // Convergence of the smooth matter and external shear (along the
+    // x-axis), deflecting the ray (x, y) by
+    // (kappa_c + gamma)*x, (kappa_c - gamma)*y.
+    double kappa_c, gamma;
+    // Extended components, deflecting all rays directly
+    struct ll_components components;
+    // Source plane mask as a summed-area table of (xpixels+1)*(ypixels+1)
+    // entries: mask[j*(xpixels+1) + i] is the number of masked pixels
+    // left of column i and below row j.  If set, only the patches that
+    // might hit a masked pixel are shot.
+    const uint32_t *mask;
 };
 
 extern void
@@ -41,7 +112,15 @@ enum ll_rayshooting_kernel
 {
     LL_KERNEL_SIMPLE,
     LL_KERNEL_BILINEAR,
-    LL_KERNEL_TRIANGULATED
+    LL_KERNEL_TRIANGULATED,
+    LL_KERNEL_TRIANGULATED_SCANLINE,
+    LL_KERNEL_ADAPTIVE
+};
+
+enum ll_precision
+{
+    LL_PRECISION_DOUBLE,
+    LL_PRECISION_SINGLE
 };
 
 struct ll_rayshooter
@@ -50,6 +129,9 @@ struct ll_rayshooter
     enum ll_rayshooting_kernel kernel;
     int refine;
     int refine_kernel;
+    double far_field_angle;
+    double tolerance;
+    enum ll_precision precision;
     bool cancel;
 };
 
@@ -63,6 +145,16 @@ extern int
 ll_shoot_single_ray(const struct ll_magpat_params *params,
                     double x, double y, double *mag_x, double *mag_y);
 
+extern void
+ll_shoot_rays(const struct ll_magpat_params *params, unsigned num_rays,
+              const double *x, const double *y,
+              double *mag_x, double *mag_y, int *hit);
+
+extern void
+ll_lens_tree_error(const struct ll_magpat_params *params,
+                   const struct ll_rect *rect, int xrays, int yrays,
+                   double *max_error, double *mean_error);
+
 extern void
 ll_rayshoot_rect(const struct ll_magpat_params *params, uint32_t *magpat,
                  const struct ll_rect *rect, int xrays, int yrays);
@@ -94,6 +186,82 @@ ll_rayshoot(const struct ll_rayshooter *rs, void *magpat,
             const struct ll_rect *rect, int xrays, int yrays,
             unsigned levels, double *progress);
 
+extern void
+ll_get_subpatches_parallel(const struct ll_rayshooter *rs,
+                           struct ll_patches *patches, unsigned num_threads);
+
+extern void
+ll_rayshoot_subpatches_parallel(const struct ll_rayshooter *rs, void *magpat,
+                                const struct ll_patches *patches,
+                                double *progress, unsigned num_threads);
+
+extern void
+ll_finalise_subpatches_parallel(const struct ll_rayshooter *rs, void *magpat,
+                                const struct ll_patches *patches,
+                                unsigned num_threads);
+
+extern void
+ll_rayshoot_parallel(const struct ll_rayshooter *rs, void *magpat,
+                     const struct ll_rect *rect, int xrays, int yrays,
+                     unsigned levels, double *progress, unsigned num_threads);
+
+extern void
+ll_rayshoot_rows(const struct ll_rayshooter *rs, void *magpat,
+                 const struct ll_patches *patches,
+                 unsigned first_row, unsigned num_rows, int *row_ranges,
+                 double *progress, unsigned num_threads);
+
+extern void
+ll_deflect_grid(const struct ll_magpat_params *params,
+                double x0, double y0, double dx, double dy,
+                int i0, int i1, int j0, int j1,
+                double *source_x, double *source_y);
+
+extern void
+ll_get_subpatches_deflected(const struct ll_magpat_params *params,
+                            struct ll_patches *patches,
+                            const double *source_x, const double *source_y);
+
+extern unsigned
+ll_patch_grid_size(const struct ll_rayshooter *rs,
+                   const struct ll_patches *patches);
+
+extern void
+ll_deflect_patches(const struct ll_rayshooter *rs,
+                   const struct ll_patches *patches,
+                   const unsigned *indices, unsigned num_indices,
+                   double *source_x, double *source_y, unsigned num_threads);
+
+extern void
+ll_deflect_rays(const struct ll_magpat_params *params, unsigned num_rays,
+                const double *x, const double *y,
+                double *source_x, double *source_y, int *hit,
+                unsigned num_threads);
+
+extern void
+ll_point_source_images(const struct ll_magpat_params *params,
+                       unsigned num_sources,
+                       const double *source_x, const double *source_y,
+                       double *image_x, double *image_y, double *image_mag,
+                       unsigned *num_images, double *magnification,
+                       unsigned num_threads);
+
+extern void
+ll_finite_source_magnifications(const struct ll_magpat_params *params,
+                                unsigned num_sources,
+                                const double *source_x,
+                                const double *source_y, double source_r,
+                                double limb_darkening, unsigned num_annuli,
+                                double tolerance, double *magnification,
+                                unsigned num_threads);
+
+extern void
+ll_rayshoot_deflected(const struct ll_rayshooter *rs, void *magpat,
+                      const struct ll_patches *patches,
+                      const unsigned *indices, unsigned num_indices,
+                      const double *source_x, const double *source_y,
+                      double *progress, unsigned num_threads);
+
 extern void
 ll_ray_hit_pattern(const struct ll_magpat_params *params,
                    uint8_t *buf, const struct ll_rect *rect);
@@ -103,6 +271,14 @@ ll_source_images(const struct ll_magpat_params *params, uint8_t *buf,
                  const struct ll_rect *rect, int xrays, int yrays,
                  int refine, double source_x, double source_y, double source_r);
 
+extern void
+ll_render_source_images(const double *source_x, const double *source_y,
+                        const double *bbox, unsigned num_pixels,
+                        unsigned samples, unsigned num_frames,
+                        const double *frame_x, const double *frame_y,
+                        const double *frame_r, uint8_t *buf,
+                        unsigned num_threads);
+
 extern void
 ll_render_magpat_greyscale(const float *magpat, uint8_t *buf,
                            unsigned xpixels, unsigned ypixels,
@@ -120,4 +296,22 @@ ll_light_curve(const struct ll_magpat_params *params, const float *magpat,
                float *curve, unsigned samples,
                double x0, double y0, double x1, double y1);
 
+enum ll_interpolation
+{
+    LL_INTERPOLATION_BILINEAR,
+    LL_INTERPOLATION_BICUBIC
+};
+
+extern void
+ll_sample_magpat(const struct ll_magpat_params *params, const float *magpat,
+                 unsigned num_points, const double *x, const double *y,
+                 enum ll_interpolation interpolation, float *values,
+                 unsigned num_threads);
+
+extern void
+ll_light_curves(const struct ll_magpat_params *params, const float *magpat,
+                unsigned num_curves, const double *x0, const double *y0,
+                const double *x1, const double *y1, const unsigned *samples,
+                unsigned max_samples, float *curves, unsigned num_threads);
+
 #endif
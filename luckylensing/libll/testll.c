@@ -1,10 +1,15 @@
 // Lucky Lensing Library (http://github.com/smarnach/luckylensing)
 // Copyright 2010 Sven Marnach
 
+#define _POSIX_C_SOURCE 200809L
+
+#include <math.h>
 #include <time.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/mman.h>
+#include <unistd.h>
 #include "ll.h"
 
 int main(int argc, char *argv[])
@@ -29,6 +34,8 @@ int main(int argc, char *argv[])
     ll_init_rayshooter(&rs, &params);
     double progress;
     float *magpat = calloc(N, sizeof(float));
+    float *magpat_single = calloc(N, sizeof(float));
+    float *magpat_triangulated = calloc(N, sizeof(float));
     unsigned char *buf = calloc(3*N, sizeof(char));
     const unsigned char colors[9][3] = {{0, 0, 0}, {64, 0, 128}, {0, 0, 255},
                                         {0, 255, 255}, {0, 255, 0}, {255, 255, 0},
@@ -37,12 +44,16 @@ int main(int argc, char *argv[])
     const unsigned steps[9] = {128, 255, 255, 255, 255, 255, 255, 255, 0};
 
     for (rs.kernel = LL_KERNEL_BILINEAR;
-         rs.kernel <= LL_KERNEL_TRIANGULATED; ++rs.kernel)
+         rs.kernel <= LL_KERNEL_ADAPTIVE; ++rs.kernel)
     {
         if (rs.kernel == LL_KERNEL_BILINEAR)
             printf("Using bilinear ray shooting\n");
         else if (rs.kernel == LL_KERNEL_TRIANGULATED)
             printf("Using triangulated ray shooting\n");
+        else if (rs.kernel == LL_KERNEL_TRIANGULATED_SCANLINE)
+            printf("Using triangulated ray shooting with scanlines\n");
+        else if (rs.kernel == LL_KERNEL_ADAPTIVE)
+            printf("Using adaptive ray shooting\n");
         else
             continue;
 
@@ -66,12 +77,402 @@ int main(int argc, char *argv[])
         avg /= N;
         printf("Average magnification:          %8.2f\n", avg);
 
+        // Both triangulated kernels compute the same pixel coverages,
+        // while the adaptive kernel should stay close to them.
+        if (rs.kernel == LL_KERNEL_TRIANGULATED)
+            memcpy(magpat_triangulated, magpat, N * sizeof(float));
+        else if (rs.kernel == LL_KERNEL_TRIANGULATED_SCANLINE ||
+                 rs.kernel == LL_KERNEL_ADAPTIVE)
+        {
+            double max_deviation = 0.0;
+            for (unsigned i = 0; i < N; ++i)
+            {
+                double deviation =
+                    fabs(magpat[i] - magpat_triangulated[i]) /
+                    fmax(magpat_triangulated[i], 1.0);
+                if (deviation > max_deviation)
+                    max_deviation = deviation;
+            }
+            printf("Maximum relative deviation from triangulated: %8.2g\n",
+                   max_deviation);
+        }
+
+        printf("Calculating in single precision...\n");
+        memset(magpat_single, 0, N * sizeof(float));
+        rs.precision = LL_PRECISION_SINGLE;
+        t = clock();
+        ll_rayshoot(&rs, magpat_single, &rect, xrays, yrays, levels, &progress);
+        printf("finished in %g seconds.\n", (double)(clock()-t)/CLOCKS_PER_SEC);
+        rs.precision = LL_PRECISION_DOUBLE;
+        double max_deviation = 0.0;
+        for (unsigned i = 0; i < N; ++i)
+        {
+            double deviation = fabs(magpat_single[i] - magpat[i]);
+            if (deviation > max_deviation)
+                max_deviation = deviation;
+        }
+        printf("Maximum deviation from double:  %8.2g\n", max_deviation);
+
+        const unsigned num_threads = 4;
+        printf("Calculating with %u threads...\n", num_threads);
+        memset(magpat_single, 0, N * sizeof(float));
+        struct timespec t0, t1;
+        clock_gettime(CLOCK_MONOTONIC, &t0);
+        ll_rayshoot_parallel(&rs, magpat_single, &rect, xrays, yrays, levels,
+                             &progress, num_threads);
+        clock_gettime(CLOCK_MONOTONIC, &t1);
+        printf("finished in %g seconds wall-clock time.\n",
+               t1.tv_sec - t0.tv_sec + 1e-9 * (t1.tv_nsec - t0.tv_nsec));
+        max_deviation = 0.0;
+        for (unsigned i = 0; i < N; ++i)
+        {
+            double deviation = fabs(magpat_single[i] - magpat[i]);
+            if (deviation > max_deviation)
+                max_deviation = deviation;
+        }
+        printf("Maximum deviation from serial:  %8.2g\n", max_deviation);
+
         printf("Converting to an image...\n");
         t = clock();
         ll_render_magpat_gradient(magpat, buf, xpixels, ypixels,
                                   -1.0, -1.0, colors, steps);
         printf("finished in %g seconds.\n\n", (double)(clock()-t)/CLOCKS_PER_SEC);
     }
+    // A mask of the rows around the centre line, like the band needed
+    // for a light curve along it
+    const int band_y0 = ypixels/2 - 16, band_y1 = ypixels/2 + 16;
+    uint32_t *mask = calloc((xpixels+1)*(ypixels+1), sizeof(uint32_t));
+    for (int j = 1; j <= ypixels; ++j)
+        for (int i = 1; i <= xpixels; ++i)
+            mask[j*(xpixels+1) + i] =
+                (j-1 >= band_y0 && j-1 < band_y1) +
+                mask[(j-1)*(xpixels+1) + i] + mask[j*(xpixels+1) + i-1] -
+                mask[(j-1)*(xpixels+1) + i-1];
+    params.mask = mask;
+    rs.kernel = LL_KERNEL_TRIANGULATED;
+    printf("Calculating the rows %i to %i with a mask...\n",
+           band_y0, band_y1 - 1);
+    memset(magpat, 0, N * sizeof(float));
+    clock_t t = clock();
+    ll_rayshoot(&rs, magpat, &rect, xrays, yrays, levels, &progress);
+    printf("finished in %g seconds.\n", (double)(clock()-t)/CLOCKS_PER_SEC);
+    params.mask = 0;
+    double max_deviation = 0.0;
+    for (int i = band_y0*xpixels; i < band_y1*xpixels; ++i)
+        max_deviation = fmax(max_deviation,
+                             fabs(magpat[i] - magpat_triangulated[i]));
+    printf("Maximum deviation in the mask:  %8.2g\n\n", max_deviation);
+
+    // Compare the adaptive kernel, which needs a coarser grid, with the
+    // triangulated_scanline kernel shooting a grid in the same time.
+    // The errors are measured in the masked rows, which cross the
+    // caustic, against the scanline kernel on a grid refined 8 times.
+    printf("Calculating the masked rows on a grid refined 8 times...\n");
+    float *magpat_ref = calloc(N, sizeof(float));
+    params.mask = mask;
+    rs.kernel = LL_KERNEL_TRIANGULATED_SCANLINE;
+    ll_rayshoot_parallel(&rs, magpat_ref, &rect, 8*xrays, 8*yrays, levels,
+                         &progress, 4);
+    params.mask = 0;
+    double adaptive_seconds = 0.0, scale = 1.0 / 3.0;
+    for (int run = 0; run < 3; ++run)
+    {
+        rs.kernel = run ? LL_KERNEL_TRIANGULATED_SCANLINE : LL_KERNEL_ADAPTIVE;
+        int run_xrays = (int)(scale * xrays + 0.5);
+        int run_yrays = (int)(scale * yrays + 0.5);
+        memset(magpat, 0, N * sizeof(float));
+        t = clock();
+        ll_rayshoot(&rs, magpat, &rect, run_xrays, run_yrays, levels,
+                    &progress);
+        double seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+        double mean_error = 0.0, max_error = 0.0;
+        for (int i = band_y0*xpixels; i < band_y1*xpixels; ++i)
+        {
+            double error =
+                fabs(magpat[i] - magpat_ref[i]) / fmax(magpat_ref[i], 1.0);
+            mean_error += error;
+            max_error = fmax(max_error, error);
+        }
+        mean_error /= (band_y1 - band_y0) * xpixels;
+        printf("%-9s %4i x %3i rays: %8.3g seconds, "
+               "mean error %8.2g, maximum error %8.2g\n",
+               run ? "scanline" : "adaptive", run_xrays, run_yrays,
+               seconds, mean_error, max_error);
+        // The time grows with the number of rays, so the grid of the
+        // last run is scaled to take as long as the adaptive kernel.
+        if (run == 0)
+        {
+            adaptive_seconds = seconds;
+            scale = 1.0;
+        }
+        else
+            scale = sqrt(adaptive_seconds / seconds);
+    }
+    printf("\n");
+    free(magpat_ref);
+    free(mask);
+
+    const unsigned num_curves = 1 << 16, curve_samples = 256;
+    double *curve_x0 = malloc(num_curves * sizeof(double));
+    double *curve_y0 = malloc(num_curves * sizeof(double));
+    double *curve_x1 = malloc(num_curves * sizeof(double));
+    double *curve_y1 = malloc(num_curves * sizeof(double));
+    float *curves = malloc(num_curves * curve_samples * sizeof(float));
+    for (unsigned i = 0; i < num_curves; ++i)
+    {
+        double angle = 2.399963229728653 * i;
+        double cx = region.x + region.width * (0.5 + 0.25*sin(0.1*i));
+        double cy = region.y + region.height * (0.5 + 0.25*cos(0.1*i));
+        curve_x0[i] = cx - 0.2 * region.height * cos(angle);
+        curve_y0[i] = cy - 0.2 * region.height * sin(angle);
+        curve_x1[i] = cx + 0.2 * region.height * cos(angle);
+        curve_y1[i] = cy + 0.2 * region.height * sin(angle);
+    }
+    printf("Extracting %u light curves...\n", num_curves);
+    t = clock();
+    ll_light_curves(&params, magpat_triangulated, num_curves,
+                    curve_x0, curve_y0, curve_x1, curve_y1, 0, curve_samples,
+                    curves, 1);
+    double seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g samples/second).\n\n",
+           seconds, num_curves * curve_samples / seconds);
+    const unsigned num_points = 1 << 20;
+    double *point_x = malloc(num_points * sizeof(double));
+    double *point_y = malloc(num_points * sizeof(double));
+    float *values = malloc(num_points * sizeof(float));
+    for (unsigned i = 0; i < num_points; ++i)
+    {
+        double s = (double)i / num_points;
+        point_x[i] = region.x + region.width * (0.5 + 0.45*sin(6.0*s));
+        point_y[i] = region.y + region.height * (0.5 + 0.45*cos(31.0*s));
+    }
+    for (enum ll_interpolation interpolation = LL_INTERPOLATION_BILINEAR;
+         interpolation <= LL_INTERPOLATION_BICUBIC; ++interpolation)
+    {
+        printf("Sampling %u points with %s interpolation...\n", num_points,
+               interpolation == LL_INTERPOLATION_BICUBIC ?
+               "bicubic" : "bilinear");
+        t = clock();
+        ll_sample_magpat(&params, magpat_triangulated, num_points,
+                         point_x, point_y, interpolation, values, 1);
+        seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+        printf("finished in %g seconds (%.3g points/second).\n\n",
+               seconds, num_points / seconds);
+    }
+    free(values);
+    free(point_y);
+    free(point_x);
+    free(curves);
+    free(curve_y1);
+    free(curve_x1);
+    free(curve_y0);
+    free(curve_x0);
+
+    // A pattern of 2^32 pixels in a sparse file, as a memory mapped
+    // pattern shot in bands.  Only the pixels written are stored.
+    const unsigned big_pixels = 65536;
+    const size_t big_size = (size_t)big_pixels * big_pixels * sizeof(float);
+    char big_name[] = "testll-XXXXXX";
+    int fd = mkstemp(big_name);
+    float *big = MAP_FAILED;
+    if (fd >= 0)
+    {
+        unlink(big_name);
+        if (ftruncate(fd, big_size) == 0)
+            big = mmap(0, big_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        close(fd);
+    }
+    if (big == MAP_FAILED)
+        printf("Skipping the %ux%u pattern.\n\n", big_pixels, big_pixels);
+    else
+    {
+        struct ll_magpat_params big_params;
+        ll_init_magpat_params(&big_params, &lenses, &region,
+                              big_pixels, big_pixels);
+        const unsigned row = 40000;
+        for (unsigned i = 1000; i < 2000; ++i)
+            big[(size_t)row*big_pixels + i] =
+                big[(size_t)(row + 1)*big_pixels + i] = 3.0;
+        double curve_y = region.y + region.height * (row + 0.5) / big_pixels;
+        double curve_x = region.x + region.width * 1200.5 / big_pixels;
+        float *big_curves = malloc(2 * curve_samples * sizeof(float));
+        double big_x0[2] = {curve_x, curve_x}, big_y0[2] = {curve_y, curve_y};
+        double big_x1[2] = {curve_x + region.width * 500 / big_pixels,
+                            curve_x + region.width * 500 / big_pixels};
+        ll_light_curves(&big_params, big, 2, big_x0, big_y0, big_x1, big_y0,
+                        0, curve_samples, big_curves, 1);
+        max_deviation = 0.0;
+        for (unsigned i = 0; i < 2 * curve_samples; ++i)
+            max_deviation = fmax(max_deviation, fabs(big_curves[i] - 3.0));
+        printf("Light curves along row %u of the %ux%u pattern deviate\n"
+               "from the pixels by at most %g.\n", row,
+               big_pixels, big_pixels, max_deviation);
+        free(big_curves);
+
+        // The simple kernel counts rays, which are scaled to
+        // magnifications after each band.
+        const unsigned band_rows = 32, first_row = big_pixels - band_rows;
+        const int big_xrays = 60, big_yrays = 12;
+        struct ll_rayshooter big_rs;
+        ll_init_rayshooter(&big_rs, &big_params);
+        big_rs.kernel = LL_KERNEL_SIMPLE;
+        struct ll_patches patches =
+            {rect, big_xrays, big_yrays, levels - 1,
+             rect.width/big_xrays, rect.height/big_yrays,
+             .hit = malloc(big_xrays*big_yrays * sizeof(uint8_t)),
+             .num_patches = 0};
+        int *row_ranges = malloc(2*big_xrays*big_yrays * sizeof(int));
+        for (int i = 0; i < 2*big_xrays*big_yrays; ++i)
+            row_ranges[i] = -1;
+        float *band = big + (size_t)first_row*big_pixels;
+        printf("Shooting the last %u rows of the pattern...\n", band_rows);
+        t = clock();
+        ll_get_subpatches(&big_params, &patches);
+        ll_rayshoot_rows(&big_rs, band, &patches, first_row, band_rows,
+                         row_ranges, &progress, 4);
+        printf("finished in %g seconds.\n", (double)(clock()-t)/CLOCKS_PER_SEC);
+        double avg = 0.0;
+        for (unsigned i = 0; i < band_rows*big_pixels; ++i)
+            avg += band[i];
+        printf("Average magnification:          %8.2f\n\n",
+               avg / (band_rows*big_pixels));
+        free(row_ranges);
+        free(patches.hit);
+        munmap(big, big_size);
+    }
+
+    free(magpat_triangulated);
+    free(magpat_single);
+
+    const unsigned num_rays = 1 << 20;
+    double *x = malloc(num_rays * sizeof(double));
+    double *y = malloc(num_rays * sizeof(double));
+    double *mag_x = malloc(num_rays * sizeof(double));
+    double *mag_y = malloc(num_rays * sizeof(double));
+    int *hit = malloc(num_rays * sizeof(int));
+    for (unsigned i = 0; i < num_rays; ++i)
+    {
+        x[i] = rect.x + (i & 1023) * (rect.width / 1024);
+        y[i] = rect.y + (i >> 10) * (rect.height / 1024);
+    }
+    printf("Shooting %u single rays...\n", num_rays);
+    t = clock();
+    for (unsigned i = 0; i < num_rays; ++i)
+        hit[i] = ll_shoot_single_ray(&params, x[i], y[i], mag_x + i, mag_y + i);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g rays/second).\n",
+           seconds, num_rays / seconds);
+    printf("Shooting %u rays in batches...\n", num_rays);
+    t = clock();
+    ll_shoot_rays(&params, num_rays, x, y, mag_x, mag_y, hit);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g rays/second).\n\n",
+           seconds, num_rays / seconds);
+
+    const unsigned num_sources = 1 << 16;
+    const unsigned max_images = lenses.num_lenses * lenses.num_lenses + 1;
+    double *source_x = malloc(num_sources * sizeof(double));
+    double *source_y = malloc(num_sources * sizeof(double));
+    double *image_x = malloc(num_sources * max_images * sizeof(double));
+    double *image_y = malloc(num_sources * max_images * sizeof(double));
+    double *image_mag = malloc(num_sources * max_images * sizeof(double));
+    unsigned *num_images = malloc(num_sources * sizeof(unsigned));
+    double *point_mag = malloc(num_sources * sizeof(double));
+    for (unsigned i = 0; i < num_sources; ++i)
+    {
+        source_x[i] = region.x + i * (region.width / num_sources);
+        source_y[i] = region.y + 0.5 * region.height;
+    }
+    printf("Finding the images of %u point sources...\n", num_sources);
+    t = clock();
+    ll_point_source_images(&params, num_sources, source_x, source_y,
+                           image_x, image_y, image_mag, num_images,
+                           point_mag, 1);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g sources/second).\n",
+           seconds, num_sources / seconds);
+    double max_residual = 0.0;
+    for (unsigned i = 0; i < num_sources; ++i)
+        for (unsigned k = 0; k < num_images[i]; ++k)
+        {
+            double mag_x, mag_y;
+            unsigned m = i*max_images + k;
+            ll_shoot_single_ray(&params, image_x[m], image_y[m],
+                                &mag_x, &mag_y);
+            mag_x = mag_x / params.pixels_per_width + region.x;
+            mag_y = mag_y / params.pixels_per_height + region.y;
+            max_residual = fmax(max_residual,
+                                fmax(fabs(mag_x - source_x[i]),
+                                     fabs(mag_y - source_y[i])));
+        }
+    printf("Maximum residual of the images: %8.2g\n\n", max_residual);
+
+    const unsigned num_finite = 64;
+    double finite_x[64], finite_y[64], finite_mag[64];
+    for (unsigned i = 0; i < num_finite; ++i)
+    {
+        finite_x[i] = source_x[i * (num_sources / num_finite)];
+        finite_y[i] = source_y[i * (num_sources / num_finite)];
+    }
+    printf("Computing the magnifications of %u limb darkened sources...\n",
+           num_finite);
+    t = clock();
+    ll_finite_source_magnifications(&params, num_finite, finite_x, finite_y,
+                                    0.01 * region.width, 0.6, 4, 1e-4,
+                                    finite_mag, 1);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g sources/second).\n\n",
+           seconds, num_finite / seconds);
+    free(point_mag);
+    free(num_images);
+    free(image_mag);
+    free(image_y);
+    free(image_x);
+    free(source_y);
+    free(source_x);
+
+    struct ll_component component[2] =
+        {{LL_COMPONENT_SIS, 0.3, 0.1, 0.05, 0.5},
+         {LL_COMPONENT_PLUMMER, -0.2, 0.0, 0.2, 0.1}};
+    params.components = (struct ll_components){2, component};
+    printf("Shooting %u single rays with extended components...\n",
+           num_rays);
+    double *single_x = malloc(num_rays * sizeof(double));
+    double *single_y = malloc(num_rays * sizeof(double));
+    t = clock();
+    for (unsigned i = 0; i < num_rays; ++i)
+        hit[i] = ll_shoot_single_ray(&params, x[i], y[i],
+                                     single_x + i, single_y + i);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g rays/second).\n",
+           seconds, num_rays / seconds);
+    printf("Shooting %u rays with extended components in batches...\n",
+           num_rays);
+    t = clock();
+    ll_shoot_rays(&params, num_rays, x, y, mag_x, mag_y, hit);
+    seconds = (double)(clock()-t)/CLOCKS_PER_SEC;
+    printf("finished in %g seconds (%.3g rays/second).\n",
+           seconds, num_rays / seconds);
+    max_deviation = 0.0;
+    for (unsigned i = 0; i < num_rays; ++i)
+        max_deviation = fmax(max_deviation,
+                             fmax(fabs(single_x[i] - mag_x[i]),
+                                  fabs(single_y[i] - mag_y[i])));
+    printf("Maximum deviation from single rays: %8.2g\n", max_deviation);
+    printf("Calculating in single precision with extended components...\n");
+    memset(magpat, 0, N * sizeof(float));
+    rs.kernel = LL_KERNEL_TRIANGULATED_SCANLINE;
+    rs.precision = LL_PRECISION_SINGLE;
+    t = clock();
+    ll_rayshoot(&rs, magpat, &rect, xrays, yrays, levels, &progress);
+    printf("finished in %g seconds.\n\n", (double)(clock()-t)/CLOCKS_PER_SEC);
+    free(single_y);
+    free(single_x);
+    free(hit);
+    free(mag_y);
+    free(mag_x);
+    free(y);
+    free(x);
 
     if (argc > 1)
     {
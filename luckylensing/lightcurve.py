@@ -2,9 +2,9 @@
 # Copyright 2010 Sven Marnach
 
 from __future__ import division, absolute_import
-from math import sqrt
+from math import sqrt, ceil
 import numpy
-from . import utils
+from . import utils, libll, lensconfig
 from .magpat import Magpat
 
 class SourceProfile(numpy.ndarray):
@@ -30,6 +30,13 @@ def _gaussian(r2, source_radius2, width, height):
 
 all_profile_types = {"flat": _flat, "gaussian": _gaussian}
 
+# Distance beyond which a source profile vanishes or is negligible, given
+# the source radius and the pixel width and height.  Used by
+# convolve_banded().
+_profile_support = {
+    "flat": lambda r, width, height: r + 0.5*(width + height),
+    "gaussian": lambda r, width, height: 6.0*r}
+
 def source_profile(magpat, source_radius, profile_type="flat"):
     """Create a source profile suitable to convolve the given magpat with.
 
@@ -94,6 +101,70 @@ def convolve(magpat, source_fft, convolved_pattern=None):
         convolved_pattern[:,-1] = convolved_pattern[:,-2]
     return convolved_pattern
 
+def convolve_banded(magpat, source_radius, profile_type="flat",
+                    convolved_pattern=None, band_rows=256):
+    """Convolve a magnification pattern with a source profile in bands.
+
+    Like convolve(), this treats the pattern as periodic.  Only a band
+    of rows of the pattern, extended by the radius of the source
+    profile, is held in memory at a time, so memory mapped patterns
+    larger than the available memory can be convolved.  Up to
+    rounding, the result is the same as that of convolve() for
+    patterns of even size.
+
+    Parameters:
+
+        magpat           the magnification pattern
+        source_radius    radius or standard deviation of the source
+        profile_type     "flat" or "gaussian"
+        convolved_pattern
+                         output array; may coincide with magpat to
+                         convolve in place
+        band_rows        number of rows per band
+    """
+    profile_type = profile_type.strip().lower()
+    try:
+        profile = all_profile_types[profile_type]
+        support = _profile_support[profile_type]
+    except KeyError:
+        raise ValueError("Unknown source profile type: " + profile_type)
+    ypixels, xpixels = magpat.shape
+    width = magpat.region.width / xpixels
+    height = magpat.region.height / ypixels
+    radius = support(source_radius, width, height)
+    hx = min(int(ceil(radius / width)), xpixels // 2)
+    hy = min(int(ceil(radius / height)), ypixels // 2)
+    band_rows = max(band_rows, hy)
+    iy, ix = numpy.ogrid[-hy:hy+1, -hx:hx+1]
+    kernel = profile((height*iy)**2 + (width*ix)**2,
+                     source_radius*source_radius, width, height)
+    kernel = kernel / float(numpy.sum(kernel))
+    kernel_ffts = {}
+    if convolved_pattern is None:
+        convolved_pattern = Magpat.empty_like(magpat)
+    src = magpat.view(numpy.ndarray)
+    dst = convolved_pattern.view(numpy.ndarray)
+    # The rows above the current band and the first rows of the pattern
+    # are saved before they are overwritten in the in-place case.
+    above = src[ypixels-hy:].copy()
+    head = src[:hy].copy()
+    for j0 in range(0, ypixels, band_rows):
+        j1 = min(j0 + band_rows, ypixels)
+        band = src[j0:j1]
+        below = src[j1:j1+hy]
+        if len(below) < hy:
+            below = numpy.vstack((below, head[:hy-len(below)]))
+        block = numpy.vstack((above, band, below))
+        if block.shape not in kernel_ffts:
+            padded = numpy.zeros(block.shape)
+            numpy.add.at(padded, (iy % block.shape[0], ix % xpixels), kernel)
+            kernel_ffts[block.shape] = numpy.fft.rfft2(padded)
+        result = numpy.fft.irfft2(numpy.fft.rfft2(block) *
+                                  kernel_ffts[block.shape], block.shape)
+        above = numpy.vstack((above, band))[len(above) + len(band) - hy:]
+        dst[j0:j1] = result[hy:hy+j1-j0]
+    return convolved_pattern
+
 class LightCurve(numpy.ndarray):
     """One-dimensional NumPy array representing a light curve.
 
@@ -124,3 +195,237 @@ def light_curve(magpat, curve_x0, curve_y0, curve_x1, curve_y1,
     magpat.params.light_curve(
         magpat, curve, curve_x0, curve_y0, curve_x1, curve_y1)
     return curve
+
+def light_curves(magpat, curve_x0, curve_y0, curve_x1, curve_y1,
+                 curve_samples=256, num_threads=1):
+    """Extract many light curves from a magnification pattern at once.
+
+    Returns a two-dimensional float32 array with one light curve per
+    row.  All curves are extracted by a single multi-threaded call,
+    which is much faster than calling light_curve() for each of them.
+
+    Parameters:
+
+        magpat           the magnification pattern
+        curve_x0, curve_y0, curve_x1, curve_y1
+                         arrays of the start and end point coordinates
+                         of the light curves in source plane coordinates
+        curve_samples    number of samples, either the same for all
+                         curves or an array with the number of each
+                         curve; shorter curves are padded with NaN
+        num_threads      number of threads to use
+    """
+    curve_x0, curve_y0, curve_x1, curve_y1 = [
+        numpy.ravel(a) for a in (curve_x0, curve_y0, curve_x1, curve_y1)]
+    samples = None
+    max_samples = curve_samples
+    if numpy.ndim(curve_samples):
+        samples = numpy.ravel(curve_samples)
+        max_samples = samples.max() if samples.size else 0
+    curves = numpy.empty((curve_x0.size, max_samples), numpy.float32)
+    magpat.params.light_curves(magpat, curves, curve_x0, curve_y0,
+                               curve_x1, curve_y1, samples, num_threads)
+    return curves
+
+def random_light_curves(magpat, num_curves, curve_length, curve_samples=256,
+                        random_seed=42, num_threads=1):
+    """Extract light curves along random tracks.
+
+    The tracks have the given length and uniformly distributed
+    directions.  Given its direction, the start point of a track is
+    uniformly distributed over the positions keeping the whole track
+    at least one pixel inside the pattern.  Returns a pair (curves,
+    tracks), where curves is the array returned by light_curves() and
+    tracks is an array of shape (num_curves, 4) containing the start
+    and end point coordinates x0, y0, x1, y1 of each track.
+
+    Parameters:
+
+        magpat           the magnification pattern
+        num_curves       number of light curves
+        curve_length     length of the tracks in source plane
+                         coordinates
+        curve_samples    number of samples per light curve
+        random_seed      seed used for NumPy's Mersenne Twister
+        num_threads      number of threads to use
+    """
+    ypixels, xpixels = magpat.shape
+    region = magpat.region
+    dx = region.width / xpixels
+    dy = region.height / ypixels
+    x0, x1 = region.x + dx, region.x + region.width - dx
+    y0, y1 = region.y + dy, region.y + region.height - dy
+    if curve_length > min(x1 - x0, y1 - y0):
+        raise ValueError("the tracks don't fit into the pattern")
+    random = numpy.random.RandomState(random_seed)
+    angle = random.uniform(0.0, 2.0*numpy.pi, num_curves)
+    track_x = curve_length * numpy.cos(angle)
+    track_y = curve_length * numpy.sin(angle)
+    start_x = random.uniform(x0 + numpy.maximum(-track_x, 0.0),
+                             x1 - numpy.maximum(track_x, 0.0))
+    start_y = random.uniform(y0 + numpy.maximum(-track_y, 0.0),
+                             y1 - numpy.maximum(track_y, 0.0))
+    tracks = numpy.column_stack(
+        [start_x, start_y, start_x + track_x, start_y + track_y])
+    curves = light_curves(magpat, *tracks.T, curve_samples=curve_samples,
+                          num_threads=num_threads)
+    return curves, tracks
+
+def trajectory_light_curve(magpat, x, y, interpolation="bilinear",
+                           num_threads=1):
+    """Sample a magnification pattern along an arbitrary trajectory.
+
+    Returns a LightCurve instance with the magnifications at the
+    source positions (x[i], y[i]), which need not be equidistant, so
+    curved tracks and irregular survey cadences can be sampled
+    directly.  Positions outside the pattern region give NaN.  See
+    libll.MagpatParams.sample_magpat().
+
+    Parameters:
+
+        magpat           the magnification pattern
+        x, y             one-dimensional arrays of the source positions
+                         in source plane coordinates
+        interpolation    "bilinear", or "bicubic" for a smooth curve
+        num_threads      number of threads to use
+    """
+    values = magpat.params.sample_magpat(
+        magpat, numpy.ravel(x), numpy.ravel(y), interpolation, num_threads)
+    return values.view(LightCurve)
+
+class Trajectory(object):
+    """Parametric source trajectory across a magnification pattern.
+
+    The source position at time t is the linear motion
+
+        x0 + vx*(t - t0), y0 + vy*(t - t0)
+
+    plus two periodic terms of the form a*cos(phi) + b*sin(phi), where
+    a and b are (x, y) vectors in source plane coordinates.  The
+    parallax term has phi = 2*pi*(t - t0)/year + parallax_phase and
+    describes the projected orbit of the observer, the orbital term
+    has phi = 2*pi*(t - t0)/orbit_period + orbit_phase and describes
+    the motion of the source in a binary system.  The periodic terms
+    vanish by default.  Times may be given in any unit, as long as
+    the velocities and periods use the same one; year defaults to
+    365.25, i.e. times in days.
+    """
+
+    def __init__(self, x0, y0, vx, vy, t0=0.0,
+                 parallax_a=(0.0, 0.0), parallax_b=(0.0, 0.0),
+                 parallax_phase=0.0, year=365.25,
+                 orbit_a=(0.0, 0.0), orbit_b=(0.0, 0.0),
+                 orbit_phase=0.0, orbit_period=None):
+        self.x0 = x0
+        self.y0 = y0
+        self.vx = vx
+        self.vy = vy
+        self.t0 = t0
+        self.parallax_a = parallax_a
+        self.parallax_b = parallax_b
+        self.parallax_phase = parallax_phase
+        self.year = year
+        self.orbit_a = orbit_a
+        self.orbit_b = orbit_b
+        self.orbit_phase = orbit_phase
+        self.orbit_period = orbit_period
+
+    def position(self, t):
+        """Return the source positions (x, y) at the times t."""
+        dt = numpy.asarray(t, numpy.double) - self.t0
+        x = self.x0 + self.vx*dt
+        y = self.y0 + self.vy*dt
+        periodic = [(self.parallax_a, self.parallax_b,
+                     self.year, self.parallax_phase)]
+        if self.orbit_period is not None:
+            periodic.append((self.orbit_a, self.orbit_b,
+                             self.orbit_period, self.orbit_phase))
+        for a, b, period, phase in periodic:
+            if not any(a) and not any(b):
+                continue
+            phi = (2.0*numpy.pi/period)*dt + phase
+            cos_phi = numpy.cos(phi)
+            sin_phi = numpy.sin(phi)
+            x = x + a[0]*cos_phi + b[0]*sin_phi
+            y = y + a[1]*cos_phi + b[1]*sin_phi
+        return x, y
+
+    def light_curve(self, magpat, t, interpolation="bilinear",
+                    num_threads=1):
+        """Sample magpat at the times t along this trajectory.
+
+        Returns a LightCurve instance, see trajectory_light_curve().
+        """
+        x, y = self.position(t)
+        return trajectory_light_curve(magpat, x, y, interpolation,
+                                      num_threads)
+
+def point_source_light_curve(lenses, curve_x0, curve_y0, curve_x1, curve_y1,
+                             curve_samples=256, kappa_c=0.0, num_threads=1):
+    """Compute the light curve of a point source without ray shooting.
+
+    Returns a LightCurve instance with the exact point source
+    magnifications at curve_samples equidistant points from the start
+    to the end point, both included.  The lens equation is solved for
+    each sample, which is fast for systems with only a few lenses.
+    See libll.MagpatParams.point_source_images().
+
+    Parameters:
+
+        lenses           the lens configuration
+        curve_x0, curve_y0, curve_x1, curve_y1
+                         start and end point coordinates of the light
+                         curve in source plane coordinates
+        curve_samples    number of samples
+        kappa_c          convergence of the smooth matter
+        num_threads      number of threads to use
+    """
+    if not isinstance(lenses, lensconfig.LensConfig):
+        lenses = lensconfig.LensConfig(lenses)
+    params = libll.MagpatParams(lenses, libll.Rect(0.0, 0.0, 1.0, 1.0),
+                                1, 1, kappa_c)
+    x = numpy.linspace(curve_x0, curve_x1, curve_samples)
+    y = numpy.linspace(curve_y0, curve_y1, curve_samples)
+    curve = LightCurve(curve_samples)
+    curve[:] = params.point_source_images(x, y, num_threads=num_threads)[3]
+    return curve
+
+def finite_source_light_curve(lenses, curve_x0, curve_y0, curve_x1, curve_y1,
+                              source_radius, curve_samples=256,
+                              limb_darkening=0.0, num_annuli=8, kappa_c=0.0,
+                              tolerance=1e-4, num_threads=1):
+    """Compute the light curve of a finite source without ray shooting.
+
+    Returns a LightCurve instance with the magnifications of a uniform
+    or limb darkened source disc at curve_samples equidistant points
+    from the start to the end point, both included.  The magnifications
+    are computed by contour integration along the images of the source
+    boundary, which is sampled more densely near caustic crossings.
+    See libll.MagpatParams.finite_source_magnifications().
+
+    Parameters:
+
+        lenses           the lens configuration
+        curve_x0, curve_y0, curve_x1, curve_y1
+                         start and end point coordinates of the light
+                         curve in source plane coordinates
+        source_radius    radius of the source in source plane coordinates
+        curve_samples    number of samples
+        limb_darkening   linear limb darkening coefficient
+        num_annuli       number of annuli of constant intensity used for
+                         limb darkened sources
+        kappa_c          convergence of the smooth matter
+        tolerance        relative error of the magnifications
+        num_threads      number of threads to use
+    """
+    if not isinstance(lenses, lensconfig.LensConfig):
+        lenses = lensconfig.LensConfig(lenses)
+    params = libll.MagpatParams(lenses, libll.Rect(0.0, 0.0, 1.0, 1.0),
+                                1, 1, kappa_c)
+    x = numpy.linspace(curve_x0, curve_x1, curve_samples)
+    y = numpy.linspace(curve_y0, curve_y1, curve_samples)
+    curve = LightCurve(curve_samples)
+    curve[:] = params.finite_source_magnifications(
+        x, y, source_radius, limb_darkening, num_annuli, tolerance,
+        num_threads)
+    return curve
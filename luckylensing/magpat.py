@@ -3,11 +3,21 @@
 
 from __future__ import division, absolute_import
 from math import sqrt, log, ceil
+import hashlib
+import mmap
+import multiprocessing
+import os
+import sys
 import threading
+import time
 try:
-    from Queue import Queue, Empty
+    import queue
 except ImportError:
-    from queue import Queue, Empty
+    import Queue as queue
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 import numpy
 from . import libll
 from . import utils
@@ -22,7 +32,8 @@ class Magpat(numpy.ndarray):
 
     Constructor:
 
-        Magpat(xpixels, ypixels, lenses, region, buffer=None, offset=0)
+        Magpat(xpixels, ypixels, lenses, region, buffer=None, offset=0,
+               kappa_c=0.0, gamma=0.0, components=None)
 
         buffer and offset are passed on to numpy.ndarray.__new__().
 
@@ -33,13 +44,21 @@ class Magpat(numpy.ndarray):
                          lenses parameter to the LensConfig constructor
         region           the coordinates of the source plane rectangle
                          occupied by this pattern
+        kappa_c          convergence of the smooth matter, which is
+                         modelled analytically instead of by lenses
+        gamma            external shear along the x-axis
+        components       the analytic extended lens components; a
+                         ComponentConfig instance or something
+                         suitable to be passed to its constructor
         params           a libll.MagpatParams instance encapsulating
-                         xpixels, ypixels, lenses and region
+                         xpixels, ypixels, lenses, region, kappa_c,
+                         gamma and components
     """
 
     arg_name = "magpat"
 
-    def __new__(cls, xpixels, ypixels, lenses, region, buffer=None, offset=0):
+    def __new__(cls, xpixels, ypixels, lenses, region, buffer=None, offset=0,
+                kappa_c=0.0, gamma=0.0, components=None):
         obj = numpy.ndarray.__new__(
             cls, (ypixels, xpixels), numpy.float32, buffer, offset)
         if not isinstance(lenses, lensconfig.LensConfig):
@@ -49,9 +68,17 @@ class Magpat(numpy.ndarray):
                 region = utils.rectangle(**region)
             except TypeError:
                 region = utils.rectangle(*region)
+        if components is None:
+            components = []
+        if not isinstance(components, lensconfig.ComponentConfig):
+            components = lensconfig.ComponentConfig(components)
         obj.lenses = lenses
         obj.region = region
-        obj.params = libll.MagpatParams(lenses, region, xpixels, ypixels)
+        obj.kappa_c = kappa_c
+        obj.gamma = gamma
+        obj.components = components
+        obj.params = libll.MagpatParams(lenses, region, xpixels, ypixels,
+                                        kappa_c, gamma, components)
         return obj
 
     def __array_finalize__(self, obj):
@@ -59,12 +86,61 @@ class Magpat(numpy.ndarray):
             return
         for attr in ["lenses", "region", "params"]:
             setattr(self, attr, getattr(obj, attr, None))
+        self.kappa_c = getattr(obj, "kappa_c", 0.0)
+        self.gamma = getattr(obj, "gamma", 0.0)
+        self.components = getattr(obj, "components", None)
 
     @classmethod
     def empty_like(cls, obj):
         """Create a new empty Magpat instance similar to obj."""
         ypixels, xpixels = obj.shape
-        return Magpat.__new__(cls, xpixels, ypixels, obj.lenses, obj.region)
+        return Magpat.__new__(cls, xpixels, ypixels, obj.lenses, obj.region,
+                              kappa_c=obj.kappa_c, gamma=obj.gamma,
+                              components=obj.components)
+
+    @classmethod
+    def memmap(cls, filename, xpixels, ypixels, lenses, region, mode="w+",
+               kappa_c=0.0, gamma=0.0, components=None):
+        """Create a Magpat backed by a memory mapped file.
+
+        The pixels are stored in the file as raw float32 values in
+        native byte order, row by row, so the size of the pattern is
+        only limited by the disk space.  The methods downsample(),
+        convolve() and write_fits() as well as light_curve() process
+        such patterns without reading them into memory as a whole,
+        and Rayshooter shoots them in bands if given magpat_file.
+
+        Parameters:
+
+            filename         name of the file
+            mode             "w+" creates a new file filled with
+                             zeros, "r+" and "r" open an existing file
+                             for reading and writing or reading only
+
+        The other parameters are the same as for the constructor.
+        """
+        buf = numpy.memmap(filename, numpy.float32, mode,
+                           shape=(ypixels, xpixels))
+        return cls(xpixels, ypixels, lenses, region, buf,
+                   kappa_c=kappa_c, gamma=gamma, components=components)
+
+    def is_memmap(self):
+        """Return whether the pattern is backed by a memory mapped file."""
+        return self._mmap_base() is not None
+
+    def flush(self):
+        """Write changes of a memory mapped pattern to the file."""
+        base = self._mmap_base()
+        if base is not None:
+            base.flush()
+
+    def _mmap_base(self):
+        base = self
+        while base is not None:
+            if isinstance(base, (numpy.memmap, mmap.mmap)):
+                return base
+            base = getattr(base, "base", None)
+        return None
 
     def convolve(self, source_fft=None, source_radius=None,
                  profile_type="flat"):
@@ -72,33 +148,54 @@ class Magpat(numpy.ndarray):
 
         If source_fft is given, it is passed on to convolve(),
         otherwise it is created using the source_profile() function
-        with the given parameters.
+        with the given parameters.  Memory mapped patterns are
+        convolved by convolve_banded() instead if source_fft isn't
+        given, so they aren't read into memory as a whole.
         """
         # function level import to avoid circular dependency
         from . import lightcurve
+        if source_fft is None and self.is_memmap():
+            lightcurve.convolve_banded(self, source_radius, profile_type, self)
+            return
         if source_fft is None:
             source_fft = lightcurve.source_profile(
                 self, source_radius, profile_type)[1]
         lightcurve.convolve(self, source_fft, self)
 
-    def downsample(self, factor=2):
+    def downsample(self, factor=2, out=None):
         """Return a copy of the magpat downsampled by the given factor.
 
+        The pattern is processed in bands of rows, so memory mapped
+        patterns aren't read into memory as a whole.
+
         Parameters:
 
             factor           factor to downsample by; must be a factor of
                              the image dimensions along both axes
+            out              Magpat of the downsampled size to store the
+                             result in, e.g. a memory mapped one; by
+                             default a new Magpat is created
         """
         if any(dim % factor for dim in self.shape):
             raise ValueError("Can only downsample by factors "
                              "of the image domensions.")
         ypixels = self.shape[0] // factor
         xpixels = self.shape[1] // factor
-        buf = self.reshape(ypixels, factor, xpixels, factor)
-        buf = buf.mean(axis=3, dtype=self.dtype)
-        magpat = Magpat(xpixels, ypixels, self.lenses, self.region)
-        buf.mean(axis=1, out=magpat)
-        return magpat
+        if out is None:
+            out = Magpat(xpixels, ypixels, self.lenses, self.region,
+                         kappa_c=self.kappa_c, gamma=self.gamma,
+                         components=self.components)
+        src = self.view(numpy.ndarray)
+        dst = out.view(numpy.ndarray)
+        # Read about 16 MB of the pattern per band.
+        rows = max(1, 2**22 // (factor * self.shape[1]))
+        for j0 in range(0, ypixels, rows):
+            j1 = min(j0 + rows, ypixels)
+            buf = src[j0*factor:j1*factor].reshape(j1-j0, factor,
+                                                   xpixels, factor)
+            buf = buf.mean(axis=3, dtype=self.dtype)
+            buf.mean(axis=1, out=dst[j0:j1])
+        return out
 
     def write_fits(self, fits_output_file):
         """Save the magnification pattern to a FITS file.
@@ -113,6 +210,133 @@ class Magpat(numpy.ndarray):
     render_greyscale = libll.render_magpat_greyscale
     render_gradient = libll.render_magpat_gradient
 
+class DeflectionCache(object):
+
+    """Cache the deflected ray grids of the coarsest shooting levels.
+
+    A Rayshooter given a DeflectionCache lays out its two coarsest
+    levels on a grid that only depends on the shooting rectangle, not
+    on the density or the number of pixels: the coarsest patches are
+    squares, 75 of them along the shorter side of the rectangle.  The
+    density is then matched by the number of finer levels and by
+    adjusting refine_kernel, which gets within a few percent of the
+    requested density.  The cache stores the source plane coordinates
+    of the rays shot on the coarsest level and for each of its hit
+    patches, keyed by the lenses and the shooting rectangle, so later
+    runs with the same lenses -- with another density, resolution or
+    kernel, or by rayshoot_many() -- skip shooting these grids.  The
+    rectangle depends on the pattern region, so runs for another
+    region only share the entry if they need the same rectangle.  A
+    run gives the same pattern whether or not its grids were found in
+    the cache, but this pattern differs slightly from that of a run
+    without a cache, which fits the grid to the density instead.
+
+    Constructor:
+
+        DeflectionCache(max_bytes=2**30, directory=None)
+
+        max_bytes        the least recently used entries are dropped
+                         when the total size of the cached grids
+                         exceeds this number of bytes
+        directory        if given, the entries are also stored in this
+                         directory as .npy files.  They are memory
+                         mapped instead of being held in memory, and
+                         they are found again by other processes and
+                         after being dropped.
+    """
+
+    def __init__(self, max_bytes=2**30, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(rayshooter, rect):
+        """Return the cache key for a run of the given Rayshooter
+        shooting the rectangle rect."""
+        lenses = numpy.ascontiguousarray(rayshooter.magpat.lenses)
+        rs = rayshooter.rs
+        return hashlib.sha1(repr((
+            tuple(rect), rs.refine,
+            rayshooter.opening_angle, rayshooter.magpat.kappa_c,
+            rayshooter.magpat.gamma,
+            hashlib.sha1(rayshooter.magpat.components.tobytes()).hexdigest(),
+            hashlib.sha1(lenses.tobytes()).hexdigest())).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the entry for key or None.
+
+        An entry is a dictionary with the items "top" (the grid of
+        the coarsest level), "indices" (the sorted flat indices of the
+        patches with cached grids) and "grids" (their grids).
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = self._load(key)
+                if entry is None:
+                    return None
+                self.nbytes += self._size(entry)
+            self._entries[key] = entry
+            self._evict()
+            return entry
+
+    def put(self, key, entry):
+        """Store entry under key, dropping old entries if necessary."""
+        if self.directory:
+            entry = self._store(key, entry)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= self._size(old)
+            self._entries[key] = entry
+            self.nbytes += self._size(entry)
+            self._evict()
+
+    def clear(self):
+        """Drop all entries held in memory."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    @staticmethod
+    def _size(entry):
+        return sum(a.nbytes for a in entry.values())
+
+    def _evict(self):
+        # The most recently used entry is kept even if it is too large.
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            self.nbytes -= self._size(self._entries.popitem(last=False)[1])
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, "%s-%s.npy" % (key, name))
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        try:
+            return dict((name, numpy.load(self._path(key, name), "r"))
+                        for name in ("top", "indices", "grids"))
+        except IOError:
+            return None
+
+    def _store(self, key, entry):
+        # "indices" is written last, so a file set is only loaded when
+        # it is complete.
+        for name in ("top", "grids", "indices"):
+            tmp_path = self._path(key, name) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                numpy.save(f, entry[name])
+            os.rename(tmp_path, self._path(key, name))
+        return self._load(key)
+
 class Rayshooter(object):
 
     """Control a multi-threaded ray shooter.
@@ -121,7 +345,12 @@ class Rayshooter(object):
 
         Rayshooter(lenses, region, xpixels=1024, ypixels=1024,
                    density=100, num_threads=1, kernel="triangulated",
-                   refine=15, refine_kernel=25)
+                   refine=15, refine_kernel=25, opening_angle=None,
+                   far_field_angle=None, precision="double",
+                   checkpoint_path=None, checkpoint_interval=600,
+                   deflection_cache=None, magpat_file=None,
+                   band_rows=1024, tolerance=0.01, kappa_c=0.0, gamma=0.0,
+                   components=None, mask=None)
 
         lenses           a LensConfig instance or a list of triples
         region           a Rect instance or a tuple of coordinates
@@ -133,56 +362,459 @@ class Rayshooter(object):
                          that hit a single pattern pixel will be
                              rays = density x avg_mag
                          where avg_mag is the average magnification of
-                         the pixel.
+                         the pixel.  The "adaptive" kernel splits the
+                         cells of this grid where needed, so a density
+                         4 to 10 times lower than for the triangulated
+                         kernels gives a smaller error in less time,
+                         unless caustics cover most of the pattern (see
+                         tolerance).
         kernel           ray shooting kernel to use.  Possible values:
                              "simple"       -- Brute-force kernel
                              "bilinear"     -- Bilinear interpolation
                              "triangulated" -- Shoot triangles
+                             "triangulated_scanline"
+                                            -- Same as "triangulated",
+                                               but rasterises the
+                                               triangles by scanlines,
+                                               which is faster for
+                                               large triangles
+                             "adaptive"     -- Shoot triangles, refining
+                                               cells near caustics (see
+                                               tolerance)
         num_threads      number of ray shooting threads
         refine           factor by which to refine the shooting grid on
                          each level in x and y-direction
         refine_kernel    number of rays to use by the kernel in x and
-                         y-direction; meaningless for "triangulated"
+                         y-direction; meaningless for the triangulated
+                         kernels.  For "adaptive", the maximum number of
+                         subcells per cell in x and y-direction, rounded
+                         down to a power of two.  Only folded cells and
+                         cells next to lenses are split that often, so
+                         larger values than the default mostly cost
+                         time.
+        opening_angle    if given, compute the deflections with a tree
+                         code using this opening angle instead of
+                         summing over all lenses (see libll.LensTree);
+                         recommended for more than a few thousand
+                         lenses.  The error introduced by the tree code
+                         is logged and stored in the attribute
+                         tree_error after each run.
+        far_field_angle  if given, approximate the deflection of lenses
+                         far away from a shooting patch by a Taylor
+                         polynomial evaluated once per patch; a lens
+                         counts as far if the patch radius is less than
+                         far_field_angle times its distance.  0.3 is a
+                         sensible value.  Takes precedence over
+                         opening_angle below the top level.
+        precision        "double" or "single"; in single precision, the
+                         rays of the finest level are deflected using
+                         float arithmetic in coordinates relative to
+                         the current patch, which is about twice as
+                         fast for many lenses.  The deviation from the
+                         double precision pattern is small compared
+                         to the shot noise of a typical ray density.
+        checkpoint_path  if given, the hit patches of the coarsest level
+                         are shot in batches, and the state of the run
+                         is saved to this file (in NumPy's npz format)
+                         every checkpoint_interval seconds, when the
+                         run is cancelled and when it is finished.  An
+                         interrupted run can be continued by resume().
+        checkpoint_interval
+                         minimum time between two checkpoints in
+                         seconds
+        deflection_cache a DeflectionCache instance storing the ray
+                         grids of the two coarsest levels for reuse by
+                         later runs with the same lenses and shooting
+                         rectangle.  Only used by run() in double
+                         precision without far_field_angle,
+                         checkpoint_path and magpat_file.  The density
+                         is then matched within a few percent by
+                         adjusting refine_kernel; see DeflectionCache.
+        magpat_file      if given, the pattern is stored in this file
+                         and memory mapped (see Magpat.memmap), so it
+                         may be larger than the available memory.
+                         run() then shoots it in bands of band_rows
+                         rows, so only one band needs to be held in
+                         memory at a time.  The result is the same as
+                         that of a single run.
+        band_rows        number of rows per band for magpat_file
+        tolerance        for the "adaptive" kernel, the maximum
+                         deviation in pixels of the image of a cell
+                         from a parallelogram before it is split.
+                         Folded cells are always split.  The largest
+                         relative error of a pixel is about tolerance
+                         and the mean error a few percent of it, so
+                         tolerance is the error to aim for.  The
+                         kernel gains most if caustics cover a small
+                         part of the pattern; in dense star fields,
+                         where almost every cell is split, the
+                         "triangulated_scanline" kernel with a higher
+                         density is faster.
+        kappa_c          convergence of the smooth matter, e.g. dark
+                         matter in a lensing galaxy; this replaces
+                         modelling it by a large number of tiny lenses
+                         at the cost of O(1) per ray
+        gamma            external shear along the x-axis
+        components       analytic extended lens components like
+                         isothermal spheres, deflecting the rays in
+                         addition to the lenses (see ComponentConfig);
+                         each replaces the many point lenses otherwise
+                         needed to model a galaxy or dark matter clump
+        mask             if given, a boolean array of shape (ypixels,
+                         xpixels) marking the pixels needed, e.g. the
+                         bands around some light curve tracks (see
+                         source_mask()).  Only the lens plane patches
+                         that might hit a marked pixel are shot, so the
+                         cost scales with the marked area instead of
+                         the whole region.  The other pixels are
+                         incomplete.
     """
 
     def __init__(self, lenses, region, xpixels=1024, ypixels=1024,
                  density=100, num_threads=1, kernel="triangulated",
-                 refine=15, refine_kernel=25):
-        self.magpat = Magpat(xpixels, ypixels, lenses, region)
-        self.magpat.fill(0.0)
+                 refine=15, refine_kernel=25, opening_angle=None,
+                 far_field_angle=None, precision="double",
+                 checkpoint_path=None, checkpoint_interval=600,
+                 deflection_cache=None, magpat_file=None, band_rows=1024,
+                 tolerance=0.01, kappa_c=0.0, gamma=0.0, components=None,
+                 mask=None):
+        if magpat_file:
+            # A new memory mapped file is filled with zeros already.
+            self.magpat = Magpat.memmap(magpat_file, xpixels, ypixels,
+                                        lenses, region, kappa_c=kappa_c,
+                                        gamma=gamma, components=components)
+        else:
+            self.magpat = Magpat(xpixels, ypixels, lenses, region,
+                                 kappa_c=kappa_c, gamma=gamma,
+                                 components=components)
+            self.magpat.fill(0.0)
+        self.mask = mask
+        self.magpat.params.set_mask(mask)
+        self.magpat_file = magpat_file
+        self.band_rows = band_rows
         self.density = density
         self.num_threads = num_threads
+        self.opening_angle = opening_angle
+        self.tree_error = None
         self.rs = libll.BasicRayshooter(
-            self.magpat.params, kernel, refine, refine_kernel)
+            self.magpat.params, kernel, refine, refine_kernel,
+            far_field_angle or 0.0, precision, tolerance)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.deflection_cache = deflection_cache
         self.progress = []
+        self._resume_state = None
+        self._stop = False
+        self._frame_rs = None
+        self._progress_weight = 1.0
 
     def get_progress(self):
         """Return the progress of the currently running ray shooting."""
         if not self.progress:
             return 1.0
-        return sum(p.value for p in self.progress)
+        return self._progress_weight * sum(p.value for p in self.progress)
 
     def cancel(self):
-        """Cancel the currently running ray shooting function."""
-        self.rs.cancel()
+        """Cancel the currently running ray shooting function.
+
+        With checkpointing, the current batch of patches is finished
+        and a checkpoint is written before run() returns.
+        """
+        self._stop = True
+        if not self.checkpoint_path:
+            self.rs.cancel()
+        if self._frame_rs is not None:
+            self._frame_rs.cancel()
+
+    def resume(self, checkpoint_path=None):
+        """Continue an interrupted run from a checkpoint.
+
+        The Rayshooter must have been created with the same parameters
+        as the interrupted one.  The run continues with the first
+        unfinished patch and keeps writing checkpoints to
+        checkpoint_path, which defaults to the path the Rayshooter was
+        created with.  For the "simple" and "bilinear" kernels, the
+        resulting pattern is bit-identical to that of an uninterrupted
+        run.  The same holds for the triangulated kernels with a
+        single thread; with several threads, the order in which its
+        floating point contributions are added up varies between runs
+        anyway.
+        """
+        if checkpoint_path is not None:
+            self.checkpoint_path = checkpoint_path
+        with numpy.load(self.checkpoint_path) as f:
+            self._resume_state = dict(f)
+        return self.run()
 
     def run(self):
         """Actually shoot the rays and return the magnification pattern.
 
         The return value is a Magpat instance.
         """
-        self.progress = [libll.Progress(0.0) for j in range(self.num_threads)]
+        rect, xrays, yrays, levels = self._prepare_run()
+        try:
+            if self.checkpoint_path:
+                self._run_checkpointed(rect, xrays, yrays, levels)
+            elif self.magpat_file:
+                self._run_banded(rect, xrays, yrays, levels)
+            elif (self.deflection_cache is not None and
+                  not self.rs.far_field_angle and
+                  self.rs.precision == libll.all_precisions["double"]):
+                self._run_cached()
+            else:
+                self.rs.run(self.magpat, rect, xrays, yrays, levels,
+                            progress=self.progress[0],
+                            num_threads=self.num_threads)
+        finally:
+            self.rs.set_lens_tree(None)
+            self._resume_state = None
+        self.progress = []
+        return self.magpat
+
+    def run_progressive(self, first_fraction=1/64, seed=0):
+        """Shoot the rays, yielding estimates of the pattern on the way.
+
+        The hit patches of the coarsest level are shot in a random
+        order in rounds, each round doubling the number of patches
+        done; the first round shoots first_fraction of the patches.
+        After each round, a new Magpat instance is yielded containing
+        the pattern of the patches done so far, scaled by the inverse
+        fraction of patches done.  As the patches are a random sample,
+        this is an unbiased estimate of the final pattern.  The last
+        pattern yielded is self.magpat, which equals the pattern run()
+        would compute up to rounding.  The "simple" and "bilinear"
+        kernels count rays, so their patterns are bit-identical; the
+        other kernels add up their floating point contributions in a
+        different order.
+
+        Stop iterating or call cancel() to abort the run.
+
+        Parameters:
+
+            first_fraction   fraction of the patches shot in the first
+                             round
+            seed             seed for the random order of the patches
+        """
+        rect, xrays, yrays, levels = self._prepare_run()
+        try:
+            patches = libll.Patches(rect, levels - 1, xrays, yrays)
+            self.rs.get_subpatches(patches, self.num_threads)
+            raw = self._raw_magpat()
+            raw.fill(0)
+            indices = numpy.flatnonzero(patches.hit_array)
+            numpy.random.RandomState(seed).shuffle(indices)
+            batch = libll.Patches(patches.rect, patches.level,
+                                  hit=numpy.zeros_like(patches.hit_array))
+            done = 0
+            end = max(4 * self.num_threads,
+                      int(ceil(first_fraction * len(indices))))
+            while done < len(indices) and not self._stop:
+                end = min(end, len(indices))
+                self._shoot_patch_subset(batch, indices[done:end],
+                                         len(indices))
+                if self._stop:
+                    break
+                done = end
+                end *= 2
+                if done == len(indices):
+                    break
+                preview = Magpat.empty_like(self.magpat)
+                preview.view(numpy.uint32)[...] = self.magpat.view(
+                    numpy.uint32)
+                self.rs.finalise_subpatches(preview, patches,
+                                            self.num_threads)
+                preview *= len(indices) / done
+                yield preview
+            if done == len(indices):
+                self.rs.finalise_subpatches(self.magpat, patches,
+                                            self.num_threads)
+                yield self.magpat
+        finally:
+            self.rs.set_lens_tree(None)
+            self.progress = []
+
+    def _prepare_run(self):
+        self.progress = [libll.Progress(0.0)]
+        self._stop = False
+        self.rs.cancel_flag = False
         rect, xrays, yrays, levels = self.get_shooting_params()
         utils.logger.debug("Ray shooting rectangle: %s", rect)
         utils.logger.debug("Rays on the coarsest level: %i x %i", xrays, yrays)
         utils.logger.debug("Ray shooting levels: %i", levels)
-        if self.num_threads > 1:
-            self._run_threaded(rect, xrays, yrays, levels)
+        if self.opening_angle:
+            self.rs.set_lens_tree(libll.LensTree(
+                self.magpat.lenses, self.opening_angle))
+            self.tree_error = self.magpat.params.lens_tree_error(rect)
+            utils.logger.info("Lens tree deflection error: max %.3g pixels, "
+                              "mean %.3g pixels", *self.tree_error)
+        return rect, xrays, yrays, levels
+
+    def _raw_magpat(self):
+        # The buffer of self.magpat holds ray counts before the pattern
+        # is finalised, except for the triangulated kernel.
+        if self.rs.kernel in libll.area_kernels:
+            return self.magpat.view(numpy.ndarray)
+        return self.magpat.view(numpy.uint32).view(numpy.ndarray)
+
+    def _shoot_patch_subset(self, batch, indices, num_patches):
+        # Shoot the patches with the given flat indices into
+        # self.magpat.  Progress is counted relative to num_patches.
+        batch.hit_array.fill(0)
+        batch.hit_array.ravel()[indices] = 1
+        batch.num_patches = num_patches
+        self.rs.run_subpatches(self.magpat, batch, self.progress[0],
+                               self.num_threads)
+
+    def _checkpoint_meta(self, rect, xrays, yrays, levels):
+        lenses = numpy.ascontiguousarray(self.magpat.lenses)
+        rs = self.rs
+        return numpy.array(repr((
+            tuple(rect), xrays, yrays, levels, tuple(self.magpat.region),
+            self.magpat.shape, rs.kernel, rs.refine, rs.refine_kernel,
+            rs.far_field_angle, rs.precision, rs.tolerance,
+            self.opening_angle, self.magpat.kappa_c, self.magpat.gamma,
+            hashlib.sha1(self.magpat.components.tobytes()).hexdigest(),
+            hashlib.sha1(lenses.tobytes()).hexdigest(),
+            self.mask is not None and hashlib.sha1(
+                numpy.asarray(self.mask, bool).tobytes()).hexdigest())))
+
+    def _run_checkpointed(self, rect, xrays, yrays, levels):
+        patches = libll.Patches(rect, levels - 1, xrays, yrays)
+        self.rs.get_subpatches(patches, self.num_threads)
+        raw = self._raw_magpat()
+        meta = self._checkpoint_meta(rect, xrays, yrays, levels)
+        indices = numpy.flatnonzero(patches.hit_array)
+        done = 0
+        state = self._resume_state
+        if state is not None:
+            if state["meta"] != meta:
+                raise ValueError("Checkpoint %s does not match the "
+                                 "parameters of this run" %
+                                 self.checkpoint_path)
+            raw[...] = state["raw"]
+            done = int(state["done"])
+            utils.logger.info("Resuming from %s with %i of %i patches done",
+                              self.checkpoint_path, done, len(indices))
         else:
-            self.rs.run(self.magpat, rect, xrays, yrays, levels,
-                        progress=self.progress[0])
-        self.progress = []
-        return self.magpat
+            raw.fill(0)
+        # Batches are shot in the order of the patches, so a run
+        # resumed from a checkpoint adds up the same contributions in
+        # the same order as an uninterrupted one.
+        batch_size = max(16 * self.num_threads, len(indices) // 200)
+        batch = libll.Patches(patches.rect, patches.level,
+                              hit=numpy.zeros_like(patches.hit_array))
+        self.progress[0].value = done / max(len(indices), 1)
+        writer = None
+        last_checkpoint = time.time()
+        while done < len(indices) and not self._stop:
+            batch_indices = indices[done:done + batch_size]
+            self._shoot_patch_subset(batch, batch_indices, len(indices))
+            done += len(batch_indices)
+            if time.time() - last_checkpoint >= self.checkpoint_interval:
+                # Only copying the pattern holds up the shooting; the
+                # file is written in the background.  If the previous
+                # checkpoint is still being written, skip this one.
+                if writer is None or not writer.is_alive():
+                    writer = threading.Thread(
+                        target=self._write_checkpoint,
+                        args=(raw.copy(), done, meta))
+                    writer.start()
+                    last_checkpoint = time.time()
+        if writer is not None:
+            writer.join()
+        self._write_checkpoint(raw, done, meta)
+        if done < len(indices):
+            utils.logger.info("Ray shooting stopped with %i of %i patches "
+                              "done; checkpoint written to %s",
+                              done, len(indices), self.checkpoint_path)
+            return
+        self.rs.finalise_subpatches(self.magpat, patches, self.num_threads)
+
+    def _run_banded(self, rect, xrays, yrays, levels):
+        # All bands use the hit patches of the whole pattern.  After
+        # the first band, row_ranges tells which patches can hit a
+        # band, so each patch is mostly shot once or twice.
+        patches = libll.Patches(rect, levels - 1, xrays, yrays)
+        self.rs.get_subpatches(patches, self.num_threads)
+        row_ranges = numpy.full((xrays * yrays, 2), -1, numpy.intc)
+        ypixels = self.magpat.shape[0]
+        bands = range(0, ypixels, self.band_rows)
+        self.progress = [libll.Progress(0.0) for j0 in bands]
+        self._progress_weight = 1 / len(self.progress)
+        try:
+            for progress, j0 in zip(self.progress, bands):
+                if self._stop:
+                    break
+                band = self.magpat[j0:j0+self.band_rows]
+                band.fill(0.0)
+                self.rs.run_rows(band, patches, j0, row_ranges, progress,
+                                 self.num_threads)
+            self.magpat.flush()
+        finally:
+            self._progress_weight = 1.0
+
+    def _run_cached(self):
+        cache = self.deflection_cache
+        rect, xrays, yrays, levels, refine_kernel = self._cached_shooting_grid(
+            self._shooting_rect(self.magpat.lenses))
+        key = cache.key(self, rect)
+        patches = libll.Patches(rect, levels - 1, xrays, yrays)
+        # The patch grids are cached including the border rays shot
+        # above level 2, so the same entry serves runs of any number
+        # of levels.
+        grid_patches = libll.Patches(rect, max(levels - 1, 3), xrays, yrays)
+        entry = cache.get(key)
+        is_new = entry is None
+        if is_new:
+            entry = dict(top=self.rs.deflect_top_grid(patches),
+                         indices=numpy.empty(0, numpy.uint32),
+                         grids=numpy.empty((2, 0, 0)))
+        self.rs.get_subpatches_deflected(patches, entry["top"])
+        indices = numpy.flatnonzero(patches.hit_array).astype(numpy.uint32)
+        # The hit patches depend on the pattern region, so a cached
+        # entry might lack some of them.
+        missing = numpy.setdiff1d(indices, entry["indices"],
+                                  assume_unique=True)
+        utils.logger.debug("Deflection cache: %i of %i patches cached",
+                           len(indices) - len(missing), len(indices))
+        if is_new or len(missing):
+            new_grids = self.rs.deflect_patches(grid_patches, missing,
+                                                self.num_threads)
+            all_indices = numpy.concatenate([entry["indices"], missing])
+            order = all_indices.argsort()
+            grids = new_grids
+            if len(entry["indices"]):
+                grids = numpy.concatenate([entry["grids"], new_grids], 1)
+            entry = dict(top=entry["top"], indices=all_indices[order],
+                         grids=grids[:, order])
+            cache.put(key, entry)
+        grids = entry["grids"]
+        if len(indices) < len(entry["indices"]):
+            grids = grids[:, entry["indices"].searchsorted(indices)]
+        if levels - 1 <= 2:
+            side = self.rs.refine + 3
+            grids = grids.reshape(2, len(indices), side, side)
+            grids = grids[:, :, 1:-1, 1:-1].reshape(2, len(indices), -1)
+        utils.logger.debug("Cached shooting grid: %i x %i, %i levels, "
+                           "refine_kernel %i", xrays, yrays, levels,
+                           refine_kernel)
+        saved_refine_kernel = self.rs.refine_kernel
+        self.rs.refine_kernel = refine_kernel
+        try:
+            self.rs.run_deflected(self.magpat, patches, indices, grids,
+                                  self.progress[0], self.num_threads)
+            self.rs.finalise_subpatches(self.magpat, patches,
+                                        self.num_threads)
+        finally:
+            self.rs.refine_kernel = saved_refine_kernel
+
+    def _write_checkpoint(self, raw, done, meta):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            numpy.savez(f, raw=raw, done=done, meta=meta)
+        os.rename(tmp_path, self.checkpoint_path)
+        utils.logger.debug("Checkpoint with %i patches written to %s",
+                           done, self.checkpoint_path)
 
     def get_shooting_params(self):
         """Determine ray shooter parameters for given self.density
@@ -194,34 +826,36 @@ class Rayshooter(object):
         The ray density for magnification 1 is exactly self.density
         rays per pixel, with equal horizontal and vertical densities.
         """
-        lenses = self.magpat.lenses
+        return self._shooting_grid(self._shooting_rect(self.magpat.lenses))
+
+    def _shooting_rect(self, lenses):
+        # Return a lens plane rectangle covering all rays that hit the
+        # pattern for the given lenses.  Plummer spheres deflect at
+        # most like point lenses of the same mass, while isothermal
+        # spheres deflect by at most their Einstein radius.
         region = self.magpat.region
-        if lenses.size:
-            sqrt_mass = numpy.sqrt(lenses.mass)
-            tmp = numpy.subtract(lenses.x, sqrt_mass)
-            x0 = tmp.min()
-            numpy.subtract(x0, lenses.x, tmp)
-            numpy.divide(lenses.mass, tmp, tmp)
-            x0 = min(x0, region.x0 + tmp.sum())
-            tmp = numpy.subtract(lenses.y, sqrt_mass)
-            y0 = tmp.min()
-            numpy.subtract(y0, lenses.y, tmp)
-            numpy.divide(lenses.mass, tmp, tmp)
-            y0 = min(y0, region.y0 + tmp.sum())
-            tmp = numpy.add(lenses.x, sqrt_mass)
-            x1 = tmp.max()
-            numpy.subtract(x1, lenses.x, tmp)
-            numpy.divide(lenses.mass, tmp, tmp)
-            x1 = max(x1, region.x1 + tmp.sum())
-            tmp = numpy.add(lenses.y, sqrt_mass)
-            y1 = tmp.max()
-            numpy.subtract(y1, lenses.y, tmp)
-            numpy.divide(lenses.mass, tmp, tmp)
-            y1 = max(y1, region.y1 + tmp.sum())
-            rect = utils.rectangle(x0, y0, x1, y1)
-        else:
-            rect = ll.Rect(*region)
+        scale_x = 1.0 - self.magpat.kappa_c - self.magpat.gamma
+        scale_y = 1.0 - self.magpat.kappa_c + self.magpat.gamma
+        if not scale_x or not scale_y:
+            raise ValueError("The rays hitting the pattern are unbounded "
+                             "for kappa_c + |gamma| = 1")
+        components = self.magpat.components
+        plummer = components[components.type ==
+                             libll.component_types["plummer"]]
+        sis = components[components.type == libll.component_types["sis"]]
+        mass = numpy.concatenate([lenses.mass, plummer.strength])
+        x0, x1 = _shooting_interval(
+            numpy.concatenate([lenses.x, plummer.x]), mass,
+            region.x0, region.x1, scale_x, sis.x, sis.strength)
+        y0, y1 = _shooting_interval(
+            numpy.concatenate([lenses.y, plummer.y]), mass,
+            region.y0, region.y1, scale_y, sis.y, sis.strength)
+        return utils.rectangle(x0, y0, x1, y1)
 
+    def _shooting_grid(self, rect):
+        # Return (rect, xrays, yrays, levels) for the given shooting
+        # rectangle, slightly enlarging it to fit the ray grid.
+        region = self.magpat.region
         rays = sqrt(self.density) / self.rs.refine_kernel
         ypixels, xpixels = self.magpat.shape
         xraysf = rays * xpixels * rect.width / region.width
@@ -235,62 +869,172 @@ class Rayshooter(object):
         rect.height *= yrays/yraysf
         return rect, xrays, yrays, levels + 2
 
-    def _run_threaded(self, rect, xrays, yrays, levels):
-        num_threads = self.num_threads
-        patches = libll.Patches(rect, levels - 1, xrays, yrays)
-        y_indices = [j*yrays//num_threads for j in range(num_threads + 1)]
-        y_values =  [rect.y + j*(rect.height/yrays) for j in y_indices]
-        subpatches = []
-        for j in range(num_threads):
-            subrect = libll.Rect(rect.x, y_values[j], rect.width,
-                                 y_values[j+1] - y_values[j])
-            subhit = patches.hit_array[y_indices[j]:y_indices[j+1]]
-            subpatches.append(libll.Patches(subrect, levels - 1, hit=subhit))
-        threads = [threading.Thread(target=self.rs.get_subpatches,
-                                    args=(subpatches[j],))
-                   for j in range(1, num_threads)]
-        for t in threads:
-            t.start()
-        self.rs.get_subpatches(subpatches[0])
-        magpats = [self.magpat] + [numpy.zeros_like(self.magpat)
-                                   for j in range(1, num_threads)]
-        for t in threads:
-            t.join()
-        patches.num_patches = sum(p.num_patches for p in subpatches)
-        subdomains = self.rs.refine
-        x_indices = [i*xrays//subdomains for i in range(subdomains + 1)]
-        x_values =  [rect.x + i*(rect.width/xrays) for i in x_indices]
-        y_indices = [j*yrays//subdomains for j in range(subdomains + 1)]
-        y_values =  [rect.y + j*(rect.height/yrays) for j in y_indices]
-        queue = Queue()
-        for j in range(subdomains):
-            for i in range(subdomains):
-                subrect = libll.Rect(x_values[i], y_values[j],
-                                     x_values[i+1] - x_values[i],
-                                     y_values[j+1] - y_values[j])
-                queue.put((subrect, x_indices[i], x_indices[i+1],
-                           y_indices[j], y_indices[j+1]))
-        threads = [threading.Thread(target=self._run_queue,
-                                    args=(queue, magpats[j], patches, j))
-                   for j in range(1, num_threads)]
-        for t in threads:
-            t.start()
-        self._run_queue(queue, magpats[0], patches, 0)
-        for t in threads:
-            t.join()
-        self.rs.finalise_subpatches(magpats, patches)
-
-    def _run_queue(self, queue, magpat, patches, index):
-        hit = patches.hit_array
+    def _cached_shooting_grid(self, rect):
+        # Return (rect, xrays, yrays, levels, refine_kernel) for a run
+        # using the deflection cache.  The coarsest patches are squares
+        # only depending on rect; the density is matched by the number
+        # of levels and refine_kernel.
+        size = min(rect.width, rect.height) / 75
+        xrays = int(ceil(rect.width / size))
+        yrays = int(ceil(rect.height / size))
+        rect = libll.Rect(rect.x, rect.y, xrays * size, yrays * size)
+        region = self.magpat.region
+        ypixels, xpixels = self.magpat.shape
+        rays = size * sqrt(self.density * xpixels * ypixels /
+                           (region.width * region.height))
+        # Rounding the number of levels down keeps refine_kernel at
+        # least at its configured value, so no more rays are deflected
+        # than without a cache.
+        refine = self.rs.refine
+        levels = max(1, int(log(rays / self.rs.refine_kernel) / log(refine)))
+        refine_kernel = max(1, int(round(rays / refine**levels)))
+        return rect, xrays, yrays, levels + 2, refine_kernel
+
+    def _union_shooting_params(self, lens_configs):
+        # Shooting parameters covering the rays of all configurations
+        rects = [self._shooting_rect(lenses) for lenses in lens_configs]
+        return self._shooting_grid(utils.rectangle(
+            min(r.x0 for r in rects), min(r.y0 for r in rects),
+            max(r.x1 for r in rects), max(r.y1 for r in rects)))
+
+    def _static_field(self, rect, xrays, yrays, levels, scale=1.0):
+        # A StaticField for the lenses of self.magpat on the finest
+        # lattice of rays shot by the coarser levels, including the
+        # border rays of the top level.
+        factor = self.rs.refine**(levels - 2)
+        dx = rect.width / (xrays * factor)
+        dy = rect.height / (yrays * factor)
+        width = (xrays + 2) * factor + 1
+        height = (yrays + 2) * factor + 1
+        utils.logger.debug("Static field lattice: %i x %i", width, height)
+        tree = None
+        if self.opening_angle:
+            tree = libll.LensTree(self.magpat.lenses, self.opening_angle)
+        return libll.StaticField(
+            self.magpat.lenses, rect.x - factor*dx, rect.y - factor*dy,
+            dx, dy, width, height, tree, scale)
+
+    def _run_static(self, field, lenses, magpat, shooting_params):
+        # Shoot magpat for the given lenses on top of field.
+        ypixels, xpixels = magpat.shape
+        params = libll.MagpatParams(lenses, magpat.region, xpixels, ypixels,
+                                    magpat.kappa_c, magpat.gamma,
+                                    magpat.components)
+        params.set_static_field(field)
+        params.set_mask(self.mask)
+        rs = libll.BasicRayshooter(
+            params, self.rs.kernel, self.rs.refine, self.rs.refine_kernel,
+            tolerance=self.rs.tolerance)
+        self._frame_rs = rs
+        self.progress = [libll.Progress(0.0)]
         try:
-            while True:
-                rect, i0, i1, j0, j1 = queue.get(False)
-                subhit = numpy.ascontiguousarray(hit[j0:j1, i0:i1])
-                subpatches = libll.Patches(rect, patches.level, hit=subhit)
-                subpatches.num_patches = patches.num_patches
-                self.rs.run_subpatches(magpat, subpatches, self.progress[index])
-        except Empty:
-            pass
+            rs.run(magpat, *shooting_params, progress=self.progress[0],
+                   num_threads=self.num_threads)
+        finally:
+            self._frame_rs = None
+            self.progress = []
+        return magpat
+
+    def sweep(self, frames):
+        """Shoot a sequence of patterns in which only some lenses change.
+
+        The lenses passed to the constructor are static.  frames is a
+        sequence of lens configurations; for each of them, a Magpat
+        for the static lenses together with these lenses is yielded.
+        The deflection of the static lenses is computed only once for
+        each ray of a lattice shared by all frames, so a frame costs
+        about as much as shooting its own lenses.  This is useful for
+        a planet moving past a star, or a single star moving in a
+        cluster.  The shooting rectangle covers those of all frames.
+
+        Only the "bilinear" and triangulated kernels benefit fully,
+        since the rays of the "simple" kernel are off the lattice.
+        The patterns are shot in double precision and without far
+        field expansion.  Stop iterating or call cancel() to abort.
+        """
+        static = self.magpat.lenses
+        frames = [lensconfig.LensConfig(lenses) for lenses in frames]
+        configs = [lensconfig.LensConfig(numpy.concatenate([static, lenses]))
+                   for lenses in frames]
+        self._stop = False
+        shooting_params = self._union_shooting_params(configs)
+        field = self._static_field(*shooting_params)
+        ypixels, xpixels = self.magpat.shape
+        for lenses, config in zip(frames, configs):
+            magpat = Magpat(xpixels, ypixels, config, self.magpat.region,
+                            kappa_c=self.magpat.kappa_c,
+                            gamma=self.magpat.gamma,
+                            components=self.magpat.components)
+            magpat.fill(0.0)
+            self._run_static(field, lenses, magpat, shooting_params)
+            if self._stop:
+                break
+            yield magpat
+
+    def mass_sweep(self, scales):
+        """Shoot patterns for the lenses with all masses scaled.
+
+        For each factor in scales, a Magpat for the lenses passed to
+        the constructor with their masses multiplied by the factor is
+        yielded.  As the deflection is linear in the masses, the
+        deflection of the unscaled lenses is computed only once for
+        each ray of a lattice shared by all patterns and rescaled for
+        each of them.  The shooting rectangle covers those of all
+        factors.
+
+        The same restrictions as for sweep() apply.
+        """
+        scales = list(scales)
+        configs = []
+        for scale in scales:
+            lenses = lensconfig.LensConfig(self.magpat.lenses)
+            lenses.mass *= scale
+            configs.append(lenses)
+        self._stop = False
+        shooting_params = self._union_shooting_params(configs)
+        field = self._static_field(*shooting_params)
+        no_lenses = lensconfig.LensConfig(num_lenses=0)
+        ypixels, xpixels = self.magpat.shape
+        for scale, config in zip(scales, configs):
+            field.scale = scale
+            magpat = Magpat(xpixels, ypixels, config, self.magpat.region,
+                            kappa_c=self.magpat.kappa_c,
+                            gamma=self.magpat.gamma,
+                            components=self.magpat.components)
+            magpat.fill(0.0)
+            self._run_static(field, no_lenses, magpat, shooting_params)
+            if self._stop:
+                break
+            yield magpat
+
+def _shooting_interval(pos, mass, lo, hi, scale, sis_pos, sis_strength):
+    # Return an interval of lens plane coordinates along one axis
+    # covering all rays hitting [lo, hi] in the source plane if the
+    # lens equation along this axis is scale*x - alpha(x), where alpha
+    # is the deflection by point masses at the coordinates pos and by
+    # isothermal spheres at sis_pos.  The deflection outside the
+    # interval of the lenses is bounded by the sum of mass/distance
+    # and of the Einstein radii of the spheres.  A negative scale (for
+    # overfocusing smooth matter) flips the interval.
+    if scale < 0.0:
+        lo, hi = hi, lo
+    if not pos.size and not sis_pos.size:
+        return lo / scale, hi / scale
+    radius = numpy.concatenate([numpy.sqrt(mass / abs(scale)),
+                                sis_strength / abs(scale)])
+    centres = numpy.concatenate([pos, sis_pos])
+    sis_deflection = sis_strength.sum()
+    x0 = (centres - radius).min()
+    tmp = numpy.subtract(pos, x0)
+    numpy.divide(mass, tmp, tmp)
+    x0 = min(x0, (lo - numpy.copysign(tmp.sum() + sis_deflection, scale)) /
+             scale)
+    x1 = (centres + radius).max()
+    numpy.subtract(x1, pos, tmp)
+    numpy.divide(mass, tmp, tmp)
+    x1 = max(x1, (hi + numpy.copysign(tmp.sum() + sis_deflection, scale)) /
+             scale)
+    return x0, x1
 
 def rayshoot(*args, **kwargs):
     """Compute a magnification pattern by ray shooting.
@@ -312,3 +1056,184 @@ def rayshoot(*args, **kwargs):
     utils.run_with_progress_bar(
         threading.Thread(target=rs.run), "Rayshooting...", rs.get_progress)
     return rs.magpat
+
+def rayshoot_many(configs, workers=None):
+    """Compute many independent magnification patterns concurrently.
+
+    configs is an iterable of dictionaries of keyword arguments for the
+    Rayshooter constructor.  The patterns are computed by a pool of
+    worker threads, each running one Rayshooter at a time.  Unless a
+    configuration specifies num_threads, a single native thread is used
+    per pattern, which avoids the serial phases of a parallel run and
+    is most efficient for many small patterns.  The GIL is released
+    while shooting, so the throughput scales with the number of cores.
+
+    Returns an iterator over pairs (index, magpat) in the order the
+    patterns are finished, where index is the position of the
+    configuration in configs.  Closing the iterator early cancels the
+    remaining runs.  An exception raised by a run is re-raised by the
+    iterator.
+
+    Additional parameters:
+
+        workers          number of worker threads; defaults to the
+                         number of CPUs
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    jobs = queue.Queue()
+    num_jobs = 0
+    for job in enumerate(configs):
+        jobs.put(job)
+        num_jobs += 1
+    results = queue.Queue()
+    running = {}
+    lock = threading.Lock()
+    stopped = [False]
+
+    def worker():
+        while True:
+            try:
+                index, config = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                kwargs = dict(config)
+                kwargs.setdefault("num_threads", 1)
+                rs = Rayshooter(**kwargs)
+                with lock:
+                    if stopped[0]:
+                        return
+                    running[index] = rs
+                result = index, rs.run(), None
+            except Exception:
+                result = index, None, sys.exc_info()[1]
+            with lock:
+                running.pop(index, None)
+            results.put(result)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, num_jobs))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in range(num_jobs):
+            index, magpat, error = results.get()
+            if error is not None:
+                raise error
+            yield index, magpat
+    finally:
+        with lock:
+            stopped[0] = True
+            for rs in running.values():
+                rs.cancel()
+
+def rayshoot_mass_sweep(lenses, region, scales, *args, **kwargs):
+    """Compute magnification patterns for the lenses with scaled masses.
+
+    This is a convenience function that creates a Rayshooter instance
+    using the given parameters and returns the list of patterns
+    computed by its mass_sweep() method for the given scale factors.
+    """
+    rs = Rayshooter(lenses, region, *args, **kwargs)
+    return list(rs.mass_sweep(scales))
+
+def point_source_magpat(lenses, region, xpixels=1024, ypixels=1024,
+                        kappa_c=0.0, num_threads=1):
+    """Compute a magnification pattern by finding point source images.
+
+    Instead of shooting rays, the lens equation is solved for a point
+    source in the centre of each pixel, so the returned Magpat contains
+    the exact point source magnifications in the pixel centres.  This
+    is much faster than ray shooting for systems with only a few
+    lenses, like binary lenses, but the time per pixel grows with the
+    fourth power of the number of lenses.  See
+    libll.MagpatParams.point_source_images().
+
+    Parameters:
+
+        lenses           the lens configuration
+        region           the source plane rectangle of the pattern
+        xpixels, ypixels the resolution of the pattern
+        kappa_c          convergence of the smooth matter
+        num_threads      number of threads to use
+    """
+    magpat = Magpat(xpixels, ypixels, lenses, region, kappa_c=kappa_c)
+    region = magpat.region
+    x = region.x + (numpy.arange(xpixels) + 0.5) * (region.width / xpixels)
+    y = region.y + (numpy.arange(ypixels) + 0.5) * (region.height / ypixels)
+    x, y = numpy.meshgrid(x, y)
+    magpat[...] = magpat.params.point_source_images(
+        x, y, num_threads=num_threads)[3]
+    return magpat
+
+def source_mask(region, xpixels=1024, ypixels=1024, polygons=(), tracks=(),
+                width=0.0, pixels=None):
+    """Return a source plane mask for Rayshooter.
+
+    The result is a boolean array of shape (ypixels, xpixels) marking
+    the pixels of the pattern covered by the given shapes.  A pixel is
+    marked if any part of it might belong to a shape, so the marked
+    pixels of a ray shooting run with this mask are complete.
+
+    Parameters:
+
+        region           the source plane rectangle of the pattern
+        xpixels, ypixels the resolution of the pattern
+        polygons         a sequence of polygons, each given as a
+                         sequence of (x, y) vertices
+        tracks           a sequence of line segments (x0, y0, x1, y1),
+                         e.g. the light curves to extract later
+        width            half width of the bands around the tracks;
+                         usually the radius of the largest source
+                         profile the pattern is convolved with
+        pixels           a boolean array of shape (ypixels, xpixels)
+                         with further pixels to mark
+    """
+    region = libll.Rect(*region)
+    dx = region.width / xpixels
+    dy = region.height / ypixels
+    mask = numpy.zeros((ypixels, xpixels), bool)
+    if pixels is not None:
+        mask |= numpy.asarray(pixels, bool)
+    x = region.x + (numpy.arange(xpixels) + 0.5) * dx
+    y = region.y + (numpy.arange(ypixels) + 0.5) * dy
+    # Widening the bands by half a pixel diagonal marks all pixels they
+    # touch.
+    margin = 0.5 * sqrt(dx*dx + dy*dy)
+
+    def mark_band(x0, y0, x1, y1, radius):
+        i0 = max(int((min(x0, x1) - radius - region.x) / dx), 0)
+        i1 = min(int((max(x0, x1) + radius - region.x) / dx) + 1, xpixels)
+        j0 = max(int((min(y0, y1) - radius - region.y) / dy), 0)
+        j1 = min(int((max(y0, y1) + radius - region.y) / dy) + 1, ypixels)
+        if i0 >= i1 or j0 >= j1:
+            return
+        px = x[i0:i1] - x0
+        py = y[j0:j1, None] - y0
+        ux, uy = x1 - x0, y1 - y0
+        length = ux*ux + uy*uy
+        t = 0.0
+        if length:
+            t = numpy.clip((px*ux + py*uy) / length, 0.0, 1.0)
+        distance = (px - t*ux)**2 + (py - t*uy)**2
+        mask[j0:j1, i0:i1] |= distance <= radius*radius
+
+    for x0, y0, x1, y1 in tracks:
+        mark_band(x0, y0, x1, y1, width + margin)
+    for polygon in polygons:
+        vertices = numpy.asarray(polygon, float)
+        inside = numpy.zeros((ypixels, xpixels), bool)
+        for (x0, y0), (x1, y1) in zip(vertices,
+                                       numpy.roll(vertices, -1, 0)):
+            # Even-odd rule for the pixel centres, plus the pixels the
+            # edges pass through
+            if y0 != y1:
+                crosses = (y[:, None] >= min(y0, y1)) & (y[:, None] <
+                                                         max(y0, y1))
+                x_cross = x0 + (y[:, None] - y0) * ((x1 - x0) / (y1 - y0))
+                inside ^= crosses & (x < x_cross)
+            mark_band(x0, y0, x1, y1, margin)
+        mask |= inside
+    return mask
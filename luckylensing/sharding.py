@@ -0,0 +1,423 @@
+# Lucky Lensing Library (http://github.com/smarnach/luckylensing)
+# Copyright 2010 Sven Marnach
+
+"""Distribute a single ray shooting run over several processes or hosts.
+
+The hit patches of the coarsest shooting level are partitioned into
+shards.  Each shard is sent to a worker process, which shoots the
+rays of its patches and returns the raw (unnormalised) partial
+magnification pattern.  The coordinator adds up the partial patterns
+and normalises the sum once.  A shard that fails is sent again,
+possibly to a different worker; the other shards are not affected.
+
+Workers are started with
+
+    python -m luckylensing.sharding [--host HOST] [--port PORT]
+                                    [--threads N]
+
+and listen on a TCP socket.  Messages are pickled, so only run
+workers on trusted networks.
+
+Classes:
+
+ShardedRayshooter -- a Rayshooter distributing its work over workers
+
+Functions:
+
+rayshoot_sharded  -- generate a magnification pattern using workers
+serve             -- run a worker in the current process
+shoot_shard       -- compute the partial pattern of a single shard
+spawn_workers     -- start worker processes on the local host
+"""
+
+from __future__ import division, absolute_import, print_function
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import numpy
+from . import libll
+from . import utils
+from .magpat import Magpat, Rayshooter
+
+# Every message is preceded by its length as an unsigned 64-bit
+# integer in network byte order.
+_header = struct.Struct("!Q")
+
+def _send_message(sock, obj):
+    data = pickle.dumps(obj, 2)
+    sock.sendall(_header.pack(len(data)))
+    sock.sendall(data)
+
+def _receive_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise EOFError("Connection closed by peer")
+        received += n
+    return bytes(buf)
+
+def _receive_message(sock):
+    size, = _header.unpack(_receive_exactly(sock, _header.size))
+    return pickle.loads(_receive_exactly(sock, size))
+
+def shoot_shard(request, num_threads=1):
+    """Shoot the hit patches of a shard and return the raw pattern.
+
+    The request is a dictionary as built by
+    ShardedRayshooter.shard_requests().  The return value is a
+    dictionary containing the partial pattern as an array of uint32
+    ray counts or float32 magnifications (for the triangulated kernel)
+    under the key "raw", together with the normalisation metadata
+    needed to merge and finalise the shards.
+    """
+    region = libll.Rect(*request["region"])
+    magpat = Magpat(request["xpixels"], request["ypixels"],
+                    request["lenses"], region, kappa_c=request["kappa_c"],
+                    gamma=request["gamma"], components=request["components"])
+    magpat.fill(0.0)
+    mask = request.get("mask")
+    if mask is not None:
+        mask = numpy.unpackbits(mask)[:magpat.size].reshape(magpat.shape)
+        magpat.params.set_mask(mask)
+    rs = libll.BasicRayshooter(
+        magpat.params, request["kernel"], request["refine"],
+        request["refine_kernel"], request["far_field_angle"],
+        request["precision"], request["tolerance"])
+    if request["opening_angle"]:
+        rs.set_lens_tree(libll.LensTree(magpat.lenses,
+                                        request["opening_angle"]))
+    hit = numpy.ascontiguousarray(request["hit"], numpy.uint8)
+    patches = libll.Patches(libll.Rect(*request["rect"]), request["level"],
+                            hit=hit)
+    patches.num_patches = int(numpy.count_nonzero(hit))
+    rs.run_subpatches(magpat, patches, libll.Progress(0.0),
+                      request.get("num_threads") or num_threads)
+    rs.set_lens_tree(None)
+    if rs.kernel in libll.area_kernels:
+        raw = magpat.view(numpy.ndarray)
+    else:
+        raw = magpat.view(numpy.uint32).view(numpy.ndarray)
+    return dict(shard=request["shard"], raw=raw,
+                num_patches=patches.num_patches, kernel=rs.kernel,
+                rect=request["rect"], level=request["level"],
+                xrays=patches.xrays, yrays=patches.yrays)
+
+def serve(host="localhost", port=0, num_threads=1, ready=None):
+    """Run a shard worker serving requests on a TCP socket.
+
+    Parameters:
+
+        host             interface to listen on
+        port             port to listen on; 0 picks a free port
+        num_threads      number of ray shooting threads per shard
+        ready            if given, a function called with the actual
+                         port number once the socket accepts connections
+
+    This function never returns.  The connections are handled one at
+    a time; a coordinator can send any number of requests over a
+    single connection.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(5)
+    if ready is not None:
+        ready(server.getsockname()[1])
+    while True:
+        conn, address = server.accept()
+        utils.logger.debug("Shard worker: connection from %s:%i", *address)
+        try:
+            while True:
+                try:
+                    request = _receive_message(conn)
+                except EOFError:
+                    break
+                try:
+                    reply = shoot_shard(request, num_threads)
+                except Exception as e:
+                    reply = dict(shard=request.get("shard"),
+                                 error="%s: %s" % (type(e).__name__, e))
+                _send_message(conn, reply)
+        except socket.error as e:
+            utils.logger.warning("Shard worker: %s", e)
+        finally:
+            conn.close()
+
+def spawn_workers(num_workers, num_threads=1):
+    """Start worker processes on the local host.
+
+    Returns a list of the Popen instances of the processes and a list
+    of the (host, port) addresses they listen on.  The caller is
+    responsible for terminating the processes.  If a worker fails to
+    start, the processes started so far are terminated and
+    RuntimeError is raised.
+    """
+    processes = []
+    addresses = []
+    try:
+        for i in range(num_workers):
+            p = subprocess.Popen(
+                [sys.executable, "-m", "luckylensing.sharding",
+                 "--threads", str(num_threads)],
+                stdout=subprocess.PIPE, universal_newlines=True)
+            processes.append(p)
+            line = p.stdout.readline()
+            if not line:
+                raise RuntimeError("Shard worker %i exited before "
+                                   "reporting its port" % i)
+            words = line.split()
+            if not words or not words[-1].isdigit():
+                raise RuntimeError("Shard worker %i reported no port: %r" %
+                                   (i, line))
+            addresses.append(("localhost", int(words[-1])))
+    except BaseException:
+        for p in processes:
+            p.terminate()
+            p.wait()
+        raise
+    return processes, addresses
+
+class ShardedRayshooter(Rayshooter):
+
+    """Control a ray shooter distributing its work over worker processes.
+
+    Constructor:
+
+        ShardedRayshooter(workers, lenses, region, *args,
+                          num_shards=None, max_attempts=3, timeout=None,
+                          **kwargs)
+
+        workers          a list of (host, port) addresses of running
+                         workers, or the number of workers to spawn on
+                         the local host for the duration of run()
+        num_shards       number of shards to split the hit patches
+                         into; defaults to four times the number of
+                         workers.  The patches are dealt out to the
+                         shards in turn, so each shard gets patches
+                         from all over the shooting rectangle.
+        max_attempts     number of times a shard is sent to a worker
+                         before the run is given up
+        timeout          socket timeout in seconds for the connections
+                         to the workers; None waits forever
+
+        num_shards, max_attempts and timeout can only be given as
+        keyword arguments.  All other parameters are passed on to
+        Rayshooter, so the positional arguments after workers are the
+        same as for Rayshooter.  num_threads is used by the
+        coordinator to determine the hit patches and by spawned
+        workers for shooting.
+    """
+
+    def __init__(self, workers, lenses, region, *args, **kwargs):
+        self.num_shards = kwargs.pop("num_shards", None)
+        self.max_attempts = kwargs.pop("max_attempts", 3)
+        self.timeout = kwargs.pop("timeout", None)
+        Rayshooter.__init__(self, lenses, region, *args, **kwargs)
+        self.workers = workers
+        self.shards_done = 0
+        self.num_shards_total = 0
+        self.cancelled = False
+
+    def get_progress(self):
+        """Return the fraction of shards finished so far."""
+        if not self.num_shards_total:
+            return 1.0
+        return self.shards_done / self.num_shards_total
+
+    def cancel(self):
+        """Stop handing out shards to the workers."""
+        self.cancelled = True
+
+    def shard_requests(self, patches, num_shards):
+        """Split the hit patches into shards.
+
+        Returns a list of request dictionaries that can be passed on
+        to shoot_shard().
+        """
+        hit = patches.hit_array.ravel()
+        indices = numpy.flatnonzero(hit)
+        lenses = self.magpat.lenses.view(numpy.ndarray)
+        # The mask is sent as a packed bit array to keep the messages
+        # small.
+        mask = None
+        if self.mask is not None:
+            mask = numpy.packbits(numpy.asarray(self.mask, bool))
+        requests = []
+        for shard in range(num_shards):
+            shard_hit = numpy.zeros_like(patches.hit_array)
+            shard_hit.ravel()[indices[shard::num_shards]] = 1
+            requests.append(dict(
+                shard=shard, lenses=lenses, region=tuple(self.magpat.region),
+                kappa_c=self.magpat.kappa_c, gamma=self.magpat.gamma,
+                components=self.magpat.components.view(numpy.ndarray),
+                xpixels=self.magpat.shape[1], ypixels=self.magpat.shape[0],
+                kernel=self.rs.kernel, refine=self.rs.refine,
+                refine_kernel=self.rs.refine_kernel,
+                far_field_angle=self.rs.far_field_angle,
+                precision=self.rs.precision, tolerance=self.rs.tolerance,
+                mask=mask, opening_angle=self.opening_angle,
+                rect=tuple(patches.rect), level=patches.level,
+                hit=shard_hit, num_threads=None))
+        return requests
+
+    def run(self):
+        """Shoot the rays on the workers and return the pattern.
+
+        The return value is a Magpat instance.
+        """
+        self.cancelled = False
+        processes = []
+        workers = self.workers
+        if isinstance(workers, int):
+            processes, workers = spawn_workers(workers, self.num_threads)
+        try:
+            return self._run(workers)
+        finally:
+            for p in processes:
+                p.terminate()
+                p.wait()
+
+    def _run(self, workers):
+        rect, xrays, yrays, levels = self.get_shooting_params()
+        utils.logger.debug("Ray shooting rectangle: %s", rect)
+        utils.logger.debug("Rays on the coarsest level: %i x %i", xrays, yrays)
+        utils.logger.debug("Ray shooting levels: %i", levels)
+        patches = libll.Patches(rect, levels - 1, xrays, yrays)
+        if self.opening_angle:
+            self.rs.set_lens_tree(libll.LensTree(
+                self.magpat.lenses, self.opening_angle))
+        try:
+            self.rs.get_subpatches(patches, self.num_threads)
+        finally:
+            self.rs.set_lens_tree(None)
+        num_shards = min(self.num_shards or 4 * len(workers),
+                         max(patches.num_patches, 1))
+        requests = self.shard_requests(patches, num_shards)
+        self.num_shards_total = num_shards
+        self.shards_done = 0
+        if self.rs.kernel in libll.area_kernels:
+            raw = self.magpat.view(numpy.ndarray)
+        else:
+            raw = self.magpat.view(numpy.uint32).view(numpy.ndarray)
+        raw.fill(0)
+        queue = Queue()
+        for request in requests:
+            queue.put((request, 1))
+        state = dict(errors=[], lock=threading.Lock(), pending=num_shards)
+        threads = [threading.Thread(target=self._worker_loop,
+                                    args=(address, queue, raw, state))
+                   for address in workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if state["errors"]:
+            raise RuntimeError("Sharded ray shooting failed: " +
+                               "; ".join(state["errors"]))
+        if self.cancelled:
+            return self.magpat
+        if self.shards_done < num_shards:
+            raise RuntimeError("Sharded ray shooting failed: no workers "
+                               "left for %i shards" %
+                               (num_shards - self.shards_done))
+        self.rs.finalise_subpatches(self.magpat, patches, self.num_threads)
+        return self.magpat
+
+    def _worker_loop(self, address, queue, raw, state):
+        sock = None
+        try:
+            # Keep polling while other workers might still fail and
+            # return their shards to the queue.
+            while (state["pending"] and not self.cancelled and
+                   not state["errors"]):
+                try:
+                    request, attempt = queue.get(True, 0.1)
+                except Empty:
+                    continue
+                try:
+                    if sock is None:
+                        sock = socket.create_connection(address, self.timeout)
+                    _send_message(sock, request)
+                    reply = _receive_message(sock)
+                except (socket.error, EOFError) as e:
+                    utils.logger.warning("Shard %i failed on %s:%i: %s",
+                                         request["shard"], address[0],
+                                         address[1], e)
+                    self._retry(queue, request, attempt, state, str(e))
+                    # Give up on this worker, the others continue.
+                    return
+                if "error" in reply:
+                    utils.logger.warning("Shard %i failed on %s:%i: %s",
+                                         request["shard"], address[0],
+                                         address[1], reply["error"])
+                    self._retry(queue, request, attempt, state,
+                                reply["error"])
+                    continue
+                self._merge(raw, request, reply, state)
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def _retry(self, queue, request, attempt, state, error):
+        if attempt >= self.max_attempts:
+            with state["lock"]:
+                state["errors"].append("shard %i: %s" %
+                                       (request["shard"], error))
+                state["pending"] -= 1
+        else:
+            queue.put((request, attempt + 1))
+
+    def _merge(self, raw, request, reply, state):
+        with state["lock"]:
+            for key in ("kernel", "rect", "level"):
+                if reply[key] != request[key]:
+                    state["errors"].append(
+                        "shard %i returned %s %r instead of %r" %
+                        (request["shard"], key, reply[key], request[key]))
+                    return
+            raw += reply["raw"]
+            self.shards_done += 1
+            state["pending"] -= 1
+
+def rayshoot_sharded(workers, *args, **kwargs):
+    """Compute a magnification pattern using a ShardedRayshooter.
+
+    This is the sharded counterpart of magpat.rayshoot(); workers is
+    passed on to ShardedRayshooter.
+    """
+    verbose = kwargs.pop("verbose", 2)
+    rs = ShardedRayshooter(workers, *args, **kwargs)
+    if not verbose:
+        return rs.run()
+    utils.run_with_progress_bar(
+        threading.Thread(target=rs.run), "Rayshooting...", rs.get_progress)
+    return rs.magpat
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Serve shards of ray shooting runs.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+    def ready(port):
+        print("Shard worker listening on port", port)
+        sys.stdout.flush()
+    serve(args.host, args.port, args.threads, ready)
+
+if __name__ == "__main__":
+    main()